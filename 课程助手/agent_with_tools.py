@@ -1,51 +1,40 @@
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.agents import AgentExecutor, create_react_agent
-from langchain_core.runnables import RunnableWithMessageHistory
-from langchain_core.chat_history import InMemoryChatMessageHistory
+# 注意：LangChain / Chroma / Tavily 等重量级依赖都在用到时才导入，
+# 保证导入本模块（以及 Gradio 首屏）足够快，没用到的组件不会被加载
 import os
+import logging
 from dotenv import load_dotenv
-from intention import IntentionRecognizer
 load_dotenv(r"课程助手/lna.env")
-from my_tools import ToolManager
-from rag_process import RAGProcess
 import uuid
-from history_management import HistoryManager
-class AgentRouter:
-    # 类变量，存储所有会话的历史
-    store = {}
-    intent_recognizer = IntentionRecognizer()#意图识别
-    my_rag = RAGProcess()
-    intention=''
-    def __init__(self, session_id:str):
-        self.session_id = session_id if session_id else str(uuid.uuid4())
-        self.llm = ChatOpenAI(
-            model="qwen-max",
-            api_key=os.getenv("DASHSCOPE_API_KEY"),
-            openai_api_base="https://dashscope.aliyuncs.com/compatible-mode/v1",
-            streaming=True
-        )
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from lazy_loader import LazyComponent
+from chain_registry import ChainRegistry
+from tracing import span, trace_stream, metrics
+from state_backend import get_state_backend
+from cancellation import cancellable
+from scheduler import scheduling, BULK
+from web_cache import web_cache, session_stream, format_results, DIRECT_COVERAGE
+
+logger = logging.getLogger(__name__)
 
-        # 1. 定义各种 Prompt
-        self.prompts = {
-            "normal": ChatPromptTemplate.from_messages([
-                ("system", """你是一个优秀的聊天助手，根据用户的提问和历史对话回答用户问题，
+NORMAL_SYSTEM_PROMPT = """你是一个优秀的聊天助手，根据用户的提问和历史对话回答用户问题，
                  如果历史对话中的信息能够回答用户问题，你需要使用历史对话中的信息。
                  如果回答不了用户问题请一定要按照下面提示回答用户：
                  1.当用户的问题涉及实时信息或者需要联网搜索时，你需要提醒用户切换模式，如：请选择联网搜索模式，我将为您搜索相关信息。
                  2.当用户问题涉及到课程相关内容时，你需要提醒用户切换模式，如：请选择课程咨询模式，我将为您查询相关课程内容。
                  3.当用户提及上传的文件内容时，你需要提醒用户请先上传文件，如：请选择上传文件模式并上传文件，我才能为您查询文件内容。
                  三个模式名称不能改变，其他话术可以随机应变。
-                 """),
-                MessagesPlaceholder(variable_name="chat_history"),
-                ("user", "{input}"),
-            ]),
-            "search": ChatPromptTemplate.from_template("""
+                 """
+
+SEARCH_PROMPT_TEMPLATE = """
                 你是一名经验丰富的智能助手，擅长帮助用户高效完成各种任务。你拥有以下强大的工具能力：
                 {tools}  # ← 必须添加：工具列表（由 LangChain 自动注入）
                 可用工具名称：{tool_names}  # ← 必须添加：工具名列表
                 ## 🔍 工具使用指南
                 **搜索信息时：**
+                - 追问本会话之前查过的新闻、网页 → 先使用 `web_cache_search`，找不到再联网
                 - 最新新闻、实时信息 → 使用 `search_tool`
                 - 特定网页内容 → 使用 `web_scraping`
                 **时间处理时：**
@@ -66,26 +55,150 @@ class AgentRouter:
                 chat_history: {chat_history}
                 Question: {input}
                 Thought:{agent_scratchpad}
-                """),
-        }
+                """
 
-        # 2. 创建各种工具和执行器
-        self.tools = ToolManager().get_tools()
-        self.agent_executor = self._create_agent_executor()
-        # 3. 创建 RunnableWithMessageHistory 用于 Agent
-        self.agent_with_history = RunnableWithMessageHistory(
-            self.agent_executor,
-            get_session_history=self.get_session_history,
-            input_messages_key="input",
-            history_messages_key="chat_history",
-        )
-        #从本地加载对话记录
-        self.history = self.get_session_history(self.session_id)
-        for item in HistoryManager().get_solo_history(self.session_id):
-            self.history.add_user_message(item['user_question'])
-            self.history.add_ai_message(item['ai_response'])
+REPEAT_SYSTEM_PROMPT = "你是一个优秀的助手，你需要一字不落的完整复述用户的内容，不允许增加或减少或修改任何内容。"
+
+WEB_FOLLOWUP_SYSTEM_PROMPT = """
+你是一名智能助手。下面是本会话之前联网获取的网页和搜索结果，请据此回答用户的追问，并在回答末尾注明引用的来源链接。
+如果这些内容不足以回答，请明确说明需要重新联网搜索。
+{context}
+"""
+
+
+def _build_intent_recognizer():
+    from intention import IntentionRecognizer
+    return IntentionRecognizer()
+
+
+def _build_rag():
+    from rag_process import RAGProcess
+    return RAGProcess()
+
+
+def _build_tools():
+    from my_tools import ToolManager
+    from web_cache import with_web_cache
+    # 联网工具的结果写入会话缓存，并提供缓存检索工具
+    return with_web_cache(ToolManager().get_tools())
+
+
+def _build_prompts():
+    from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+    return {
+        "normal": ChatPromptTemplate.from_messages([
+            ("system", NORMAL_SYSTEM_PROMPT),
+            MessagesPlaceholder(variable_name="chat_history"),
+            ("user", "{input}"),
+        ]),
+        "search": ChatPromptTemplate.from_template(SEARCH_PROMPT_TEMPLATE),
+        "repeat": ChatPromptTemplate.from_messages([
+            ("system", REPEAT_SYSTEM_PROMPT),
+            ("user", "{input}"),
+        ]),
+        "web_followup": ChatPromptTemplate.from_messages([
+            ("system", WEB_FOLLOWUP_SYSTEM_PROMPT),
+            MessagesPlaceholder(variable_name="chat_history"),
+            ("user", "{input}"),
+        ]),
+    }
+
+
+class AgentRouter:
+    # 会话历史与路由元数据保存在状态后端（见 state_backend.py），多个进程共享
+    # 以下组件第一次使用时才构造，所有会话共享
+    intent_recognizer = LazyComponent(_build_intent_recognizer)#意图识别
+    my_rag = LazyComponent(_build_rag)
+    tools = LazyComponent(_build_tools)
+    intention=''
+    last_speculation = None
+    # 投机检索：意图尚未确定时提前做 query embedding + 课程库 top-k 检索
+    speculative = os.getenv("SPECULATIVE_RETRIEVAL", "1") == "1"
+    _speculation_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative")
+    # 累计统计：命中/丢弃次数与节省的总时延(毫秒)
+    speculation_stats = {"hits": 0, "misses": 0, "saved_ms": 0.0}
+    _stats_lock = threading.Lock()
+    # 意图识别模型返回的数字 -> 意图名称
+    intent_code_map = {"1": "normal", "2": "rag", "3": "search", "4": "upload"}
+    # 预编译的 Prompt / Chain / Agent，所有会话共享，只构建一次
+    chains = ChainRegistry()
+    def __init__(self, session_id:str):
+        from llm_registry import get_chat_model
+        from history_management import HistoryManager
+        self.session_id = session_id if session_id else str(uuid.uuid4())
+        # 共享的模型客户端（连接池复用），不在每个会话里重新构造
+        self.llm = get_chat_model("qwen-max", streaming=True)
+
+        # 1. 各种 Prompt（预编译，所有会话共享）
+        self.prompts = self.chains.get("prompts", _build_prompts)
+
+        # 2. 工具和 Agent 执行器只在联网搜索时才创建（见 agent_with_history）
+        #从本地加载对话记录：状态后端里还没有这个会话时才从历史库导入一次
+        with span("history_hydrate"):
+            self.history = self.get_session_history(self.session_id)
+            if not self.history.messages:
+                from langchain_core.messages import AIMessage, HumanMessage
+                messages = []
+                for item in HistoryManager().get_solo_history(self.session_id):
+                    messages.append(HumanMessage(content=item['user_question']))
+                    messages.append(AIMessage(content=item['ai_response']))
+                # 多个进程可能同时打开同一会话：只有一个导入生效，不会重复
+                get_state_backend().seed_messages(self.session_id, messages)
+
+    @classmethod
+    def warm_up(cls, components=("rag", "intent", "tools", "llm"), background: bool = False):
+        """
+        预热钩子：提前构造指定组件（打开 Chroma、创建 embedding 客户端、加载工具、建立模型连接），
+        避免第一个用户请求承担冷启动开销。background=True 时在后台线程执行并立即返回线程。
+        """
+        def _run():
+            for name in components:
+                start = time.perf_counter()
+                if name == "rag":
+                    cls.my_rag.warm_up()
+                elif name == "intent":
+                    cls.intent_recognizer
+                elif name == "tools":
+                    cls.tools
+                elif name == "llm":
+                    from llm_registry import get_chat_model, prewarm_connections
+                    get_chat_model("qwen-max", streaming=True)
+                    prewarm_connections()
+                else:
+                    logger.warning("[warmup] 未知组件: %s", name)
+                    continue
+                logger.info("[warmup] %s 预热完成，耗时 %.1fms", name, (time.perf_counter() - start) * 1000)
+
+        if background:
+            thread = threading.Thread(target=_run, name="warmup", daemon=True)
+            thread.start()
+            return thread
+        _run()
+
+    @classmethod
+    def loaded_components(cls) -> dict:
+        """返回各共享组件是否已经加载"""
+        return {name: cls.__dict__[name].loaded for name in ("intent_recognizer", "my_rag", "tools")}
+
+    @property
+    def agent_executor(self):
+        return self.chains.get(("search", "executor"), self._create_agent_executor)
+
+    @property
+    def agent_with_history(self):
+        """RunnableWithMessageHistory 用于 Agent，会话 ID 通过 config 传入，所有会话共享同一个实例"""
+        def build():
+            from langchain_core.runnables import RunnableWithMessageHistory
+            return RunnableWithMessageHistory(
+                self.agent_executor,
+                get_session_history=AgentRouter.get_session_history_by_id,
+                input_messages_key="input",
+                history_messages_key="chat_history",
+            )
+        return self.chains.get(("search", "agent"), build)
 
     def _create_agent_executor(self):
+        from langchain.agents import AgentExecutor, create_react_agent
         agent = create_react_agent(
             llm=self.llm,
             tools=self.tools,
@@ -93,22 +206,24 @@ class AgentRouter:
         )
         return AgentExecutor(agent=agent, tools=self.tools, verbose=False,handle_parsing_errors=True)
 
+    @classmethod
+    def get_session_history_by_id(cls, session_id):
+        return get_state_backend().get_history(session_id)
+
     def get_session_history(self, session_id):
-        if session_id not in self.store:
-            self.store[session_id] = InMemoryChatMessageHistory()
-        return self.store[session_id]
+        return self.get_session_history_by_id(session_id)
 
     def _handle_normal_stream(self, input_dict: dict):#2.0版本
         """处理普通对话"""
         history = self.get_session_history(self.session_id)
         # 先添加用户消息
         history.add_user_message(input_dict["input"])
-        chain = self.prompts["normal"] | self.llm
+        chain = self.chains.get(("normal", "chain"), lambda: self.prompts["normal"] | self.llm)
         response = ""
-        for chunk in chain.stream({
+        for chunk in trace_stream("llm", chain.stream({
             "input": input_dict["input"],
             "chat_history": history.messages
-        }):
+        }), mode="normal"):
             content = chunk.content
             if content:
                 response += content
@@ -116,28 +231,42 @@ class AgentRouter:
         history.add_ai_message(response)
 
     def _handle_search_stream(self, input_dict: dict):
-        """处理联网搜索"""
+        """处理联网搜索：本会话缓存的网页内容足以回答追问时直接回答，否则进入 ReAct Agent"""
+        if DIRECT_COVERAGE > 0:
+            results, coverage = web_cache.search(self.session_id, input_dict["input"])
+            if results and coverage >= DIRECT_COVERAGE:
+                metrics.inc("web_cache_direct")
+                yield from self._answer_from_web_cache(input_dict["input"], results)
+                return
         config = {"configurable": {"session_id": self.session_id}}
         # 使用 stream 模式
+        tool_name, tool_start = None, None
         # try:
-        for event in self.agent_with_history.stream(
+        # 设置当前会话：Agent 调用的联网工具把结果写入本会话的缓存
+        for event in session_stream(self.agent_with_history.stream(
             {"input": input_dict["input"]},
             config=config
-        ):
-            #调试：打印 event 结构（第一次运行时打开）
-            print(f"Event keys: {list(event.keys())}")
-            print(f"Event: {event}")
+        ), self.session_id):
+            #调试：打印 event 结构（LOG_LEVEL=DEBUG 时输出）
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Event keys: %s", list(event.keys()))
+                logger.debug("Event: %s", event)
 
             # 1. 判断是否是工具调用开始：检查 'actions' 字段
             if "actions" in event and event["actions"]:
                 action = event["actions"][0]
                 tool_name = getattr(action, "tool", "未知工具")
+                tool_start = time.perf_counter()
                 yield f"\n🔍 正在调用工具：{tool_name}\n"
                 continue
 
             # 2. 判断是否是工具调用结束：检查 'steps' 中的 Observation
             if "steps" in event and event["steps"]:
                 step = event["steps"][0]
+                if tool_start is not None:
+                    # 工具调用耗时：从 actions 事件到 steps 事件
+                    metrics.observe("tool_call", (time.perf_counter() - tool_start) * 1000, tool=tool_name)
+                    tool_start = None
                 if hasattr(step, "tool_output") or hasattr(step, "observation"):
                     result=step.observation
                     # print(f"查询结果：{result}")
@@ -146,20 +275,35 @@ class AgentRouter:
             # 3. 判断是否是 LLM 生成中：检查 'messages' 中的 AIMessageChunk
             if "output" in event:
                 result = event["output"]
-                prompt = ChatPromptTemplate.from_messages([
-                ("system", "你是一个优秀的助手，你需要一字不落的完整复述用户的内容，不允许增加或减少或修改任何内容。"),
-                ("user", "{input}"),
-                ])
-                chain = prompt | self.llm
-                for chunk in chain.stream({"input": result}):
+                chain = self.chains.get(("search", "repeat"), lambda: self.prompts["repeat"] | self.llm)
+                for chunk in trace_stream("llm", chain.stream({"input": result}), mode="search"):
                     yield chunk.content
         # except Exception as e:
         #     yield f"\n❌ 搜索过程中发生错误：{str(e)}"
+
+    def _answer_from_web_cache(self, query: str, results):
+        """用缓存的网页内容回答追问：一次模型调用，不联网、不进入 ReAct 循环"""
+        history = self.get_session_history(self.session_id)
+        chain = self.chains.get(("search", "web_followup"), lambda: self.prompts["web_followup"] | self.llm)
+        yield "📄 使用本会话已获取的网页内容回答...\n\n"
+        response = ""
+        for chunk in trace_stream("llm", chain.stream({
+            "input": query,
+            "context": format_results(results),
+            "chat_history": history.messages,
+        }), mode="search_cached"):
+            if chunk.content:
+                response += chunk.content
+                yield chunk.content
+        history.add_user_message(query)
+        history.add_ai_message(response)
         
     
     def _handle_rag_stream(self, input_dict: dict):
         """处理RAG流式输出（这里需要你集成你的向量数据库）"""
-        answer = self.my_rag.answer_question(input_dict['input'],self.session_id,'course')
+        answer = self.my_rag.answer_question(input_dict['input'],self.session_id,'course',
+                                             prefetched_docs=input_dict.get("prefetched_docs"),
+                                             session_id=self.session_id)
         for chunk in answer:
             if chunk["type"] == "rag":
                 yield chunk["content"]
@@ -170,51 +314,137 @@ class AgentRouter:
     def _handle_upload_stream(self, input_dict: dict):
         """处理文件上传流式输出"""
         upload_files = input_dict.get("upload") if input_dict.get("upload") else []
+        token = input_dict.get("cancel_token")
         len_files = len(upload_files)
         for index,doc in enumerate(upload_files):
+            if token is not None and token.cancelled:
+                return
             yield f"正在上传第{index+1}/{len_files}个文件\n"
-            upload_result = self.my_rag.upload_document(doc,self.session_id)
+            # 文件入库是批量工作，调度优先级低于交互式对话
+            with scheduling(priority=BULK):
+                upload_result = self.my_rag.upload_document(doc,self.session_id, cancel_token=token)
+            if upload_result.get('cancelled'):
+                return
             yield upload_result['message'] + '\n'
         if not self.my_rag.get_user_documents(self.session_id):
             yield "请先上传文件！\n"
             return
-        answer = self.my_rag.answer_question(input_dict['input'], self.session_id, 'user')
+        # 问题针对上传的表格时生成 SQL 查询表格，否则检索上传的文档
+        table = self.my_rag.route_user_question(input_dict['input'], self.session_id)
+        if table is not None:
+            answer = self.my_rag.answer_from_table(input_dict['input'], self.session_id, table, session_id=self.session_id)
+        else:
+            answer = self.my_rag.answer_question(input_dict['input'], self.session_id, 'user', session_id=self.session_id)
         for chunk in answer:
+            if chunk['type'] == 'sql':
+                yield f"🧮 查询表格：`{chunk['content']}`\n\n"
             if chunk['type'] == 'answer':
                 yield chunk['answer']
             # elif chunk['type'] == 'sources':
             #     yield chunk['sources']              
         # yield "流式传输测试中\n"
 
+    def _speculative_retrieve(self, query: str):
+        """投机执行：对问题做 embedding 并检索课程知识库 top-k，返回 (文档列表, 耗时秒)"""
+        start = time.perf_counter()
+        with span("vector_search", store="course", speculative="true"):
+            # 与 RAG 链检索课程库时的 k 一致，结果可以直接复用
+            docs = self.my_rag.search("course", query, k=self.my_rag.retrieval.course_k)
+        return docs, time.perf_counter() - start
+
+    def _resolve_intent(self, input_dict: dict) -> str:
+        """确定意图：界面已指定则直接使用，'auto' 时调用意图识别模型"""
+        intent = input_dict["intention"]
+        if intent != "auto":
+            return intent
+        with span("intent"):
+            code = self.intent_recognizer.choice_intent(input_dict.get("upload") or None, input_dict["message"])
+        return self.intent_code_map.get(str(code).strip(), "normal")
+
+    def _collect_speculation(self, future, intent: str):
+        """意图确定后处理投机任务：需要时取回检索结果，否则取消/丢弃，并记录节省的时延"""
+        if future is None:
+            return None
+        if intent != "rag":
+            # 意图不需要检索：尚未开始则直接取消，已在运行则丢弃结果
+            future.cancel()
+            with self._stats_lock:
+                self.speculation_stats["misses"] += 1
+            self.last_speculation = {"used": False, "saved_ms": 0.0}
+            logger.debug("投机检索已丢弃，意图为: %s", intent)
+            return None
+        wait_start = time.perf_counter()
+        try:
+            docs, retrieval_time = future.result()
+        except Exception as e:
+            # 投机失败不影响正常流程，回退到常规检索
+            logger.warning("投机检索失败，回退常规检索: %s", e)
+            return None
+        waited = time.perf_counter() - wait_start
+        # 被意图识别"遮住"的检索时间即为节省的时延
+        saved_ms = max(retrieval_time - waited, 0.0) * 1000
+        with self._stats_lock:
+            self.speculation_stats["hits"] += 1
+            self.speculation_stats["saved_ms"] += saved_ms
+        self.last_speculation = {
+            "used": True,
+            "retrieval_ms": retrieval_time * 1000,
+            "waited_ms": waited * 1000,
+            "saved_ms": saved_ms,
+        }
+        metrics.inc("speculation_saved_ms", saved_ms)
+        logger.debug("投机检索命中，检索耗时 %.1fms，节省 %.1fms", retrieval_time * 1000, saved_ms)
+        return docs
+
     def chat_stream(self,input_dict:dict):
         """
         统一的聊天入口，支持流式输出（返回生成器）
+        input_dict["intention"] 为 'auto' 时先识别意图；开启投机模式时，
+        意图识别与课程库的 embedding + 检索并行进行。
         """
+        # 0. 意图未定且可能走 RAG 时，提前启动检索
+        future = None
+        speculative = input_dict.get("speculative", self.speculative)
+        if speculative and input_dict["intention"] == "auto" and not input_dict.get("upload"):
+            # 在当前上下文中执行，检索的 embedding 调用仍记在本用户名下
+            future = self._speculation_pool.submit(contextvars.copy_context().run,
+                                                   self._speculative_retrieve, input_dict["message"])
+
         # 1. 识别意图
-        intent = input_dict["intention"]
+        intent = self._resolve_intent(input_dict)
         self.intention = intent
-        print(f"[DEBUG] 意图识别为: {intent}")
+        logger.debug("意图识别为: %s", intent)
+        metrics.inc("turns", intent=intent)
+        token = input_dict.get("cancel_token")
+        if token is not None and token.cancelled:
+            # 意图识别期间本轮已被取消：投机检索不再取回，直接结束
+            if future is not None:
+                future.cancel()
+            return
+        prefetched_docs = self._collect_speculation(future, intent)
         
-        # 2. 根据意图调用对应的处理函数（流式）
+        # 2. 根据意图调用对应的处理函数（流式）；取消时关闭处理函数的生成器，上游模型/工具调用随之停止
         if intent == "normal":
             # ✅ 使用 yield from 把 _handle_normal 的每个 token 透传出去
-            yield from self._handle_normal_stream({"input": input_dict["message"]})
+            yield from cancellable(self._handle_normal_stream({"input": input_dict["message"]}), token, stage=intent)
 
         elif intent == "search":
             # 这里可以先 yield "正在搜索..."，再流式返回最终答案
             # yield "正在联网查询..."
-            yield from self._handle_search_stream({"input": input_dict["message"]})
+            yield from cancellable(self._handle_search_stream({"input": input_dict["message"]}), token, stage=intent)
 
         elif intent == "rag":
             # yield "正在从知识库查找信息...\n"           
-            yield from self._handle_rag_stream({"input": input_dict["message"]})
+            yield from cancellable(self._handle_rag_stream({"input": input_dict["message"], "prefetched_docs": prefetched_docs}),
+                                   token, stage=intent)
 
         elif intent == "upload":
             yield "正在处理上传的文件，请稍等...\n"
-            yield from self._handle_upload_stream({"input": input_dict["message"],"upload":input_dict["upload"]})
+            yield from cancellable(self._handle_upload_stream({"input": input_dict["message"],"upload":input_dict["upload"],
+                                                               "cancel_token": token}), token, stage=intent)
 
         else:
-            yield from self._handle_normal_stream({"input": input_dict["message"]})
+            yield from cancellable(self._handle_normal_stream({"input": input_dict["message"]}), token, stage=intent)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,9 @@
 from agent_with_tools import AgentRouter
+from tracing import span
 class AIRespond:
     def __init__(self,chat_id):
-        self.router = AgentRouter(chat_id)  # 初始化路由器，传入会话ID
+        with span("router_setup"):
+            self.router = AgentRouter(chat_id)  # 初始化路由器，传入会话ID
     def _route_intent(self, intention,upload=[]) -> str:
         """
             intention:用户输入的意图
@@ -16,17 +18,20 @@ class AIRespond:
         intent_map = {
             "联网搜索": "search",
             "课程咨询": "rag",
-            "文件上传": "upload"  # 对应文件上传
+            "文件上传": "upload",  # 对应文件上传
+            "自动识别": "auto"  # 由意图识别模型决定，期间投机检索课程库
         }
         
         # 返回对应的意图名称，如果无法识别则默认为 normal
         return intent_map.get(intent_code, "normal")
     
-    def respond_stream(self, upload, message,choice):
+    def respond_stream(self, upload, message,choice, cancel_token=None):
         """
         流式响应：返回一个生成器，逐步产出 token
         供 Gradio 的 chatbot 使用
+        cancel_token: 本轮的取消令牌（见 cancellation.py），一直传到模型、工具和文件入库调用
         """
         intention = self._route_intent(choice,upload)
-        for token in self.router.chat_stream({"intention":intention,"upload":upload,"message":message}):
+        for token in self.router.chat_stream({"intention":intention,"upload":upload,"message":message,
+                                              "cancel_token":cancel_token}):
             yield token  # 把每个 token 向上传递给 Gradio       
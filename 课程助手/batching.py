@@ -0,0 +1,139 @@
+"""
+并发检索的微批处理。
+多个学生同时提问时，把几毫秒内到达的查询攒成一批：一次批量 embedding 请求 + 一次批量向量检索，
+再把结果分发回各自等待的调用方。单个请求最多多等 max_wait_ms（RETRIEVAL_BATCH_WAIT_MS，默认 5ms）。
+"""
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from tracing import metrics
+
+DEFAULT_MAX_WAIT_MS = float(os.getenv("RETRIEVAL_BATCH_WAIT_MS", "5"))
+DEFAULT_MAX_BATCH = int(os.getenv("RETRIEVAL_BATCH_SIZE", "32"))
+
+
+class MicroBatcher:
+    """
+    通用微批调度器：submit(item) 返回 Future；后台线程在第一个请求到达后最多等待 max_wait_ms，
+    或攒满 max_batch 个请求，然后调用 fn(items) -> results（与 items 一一对应）。
+    results 中的某一项是异常对象时，只有对应的调用方收到这个异常。
+    """
+    def __init__(self, fn, max_batch: int = DEFAULT_MAX_BATCH, max_wait_ms: float = DEFAULT_MAX_WAIT_MS,
+                 name: str = "batch"):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self._items = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name=f"{name}-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        with self._cond:
+            self._items.append((item, future))
+            self._cond.notify()
+        return future
+
+    def __call__(self, item):
+        """同步调用：提交并等待结果"""
+        return self.submit(item).result()
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+            deadline = time.monotonic() + self.max_wait
+            while len(self._items) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, self._items = self._items[:self.max_batch], self._items[self.max_batch:]
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._take_batch()
+            items = [item for item, _ in batch]
+            metrics.inc(f"{self.name}_batches")
+            metrics.inc(f"{self.name}_batched_items", len(items))
+            try:
+                results = self.fn(items)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+def embed_queries(embeddings, texts):
+    """批量计算查询向量：后端有 embed_queries 时一次批量计算，否则逐条 embed_query，保持查询语义"""
+    batched = getattr(embeddings, "embed_queries", None)
+    if batched is not None:
+        return batched(texts)
+    return [embeddings.embed_query(t) for t in texts]
+
+
+class BatchedSearch:
+    """
+    向量库的批量检索：一批查询先用一次 embed_queries 计算查询向量（与逐条 embed_query 的结果一致；
+    后端不支持批量查询时退回逐条计算），
+    支持 similarity_search_by_vectors 的库（紧凑课程索引）按 filter 分组后一次矩阵检索，
+    其他库（Chroma）逐个按向量检索，仍然共享那一次批量 embedding。
+    """
+    def __init__(self, store, embeddings, name: str = "retrieval", **batcher_kwargs):
+        self.store = store
+        self.embeddings = embeddings
+        self.batcher = MicroBatcher(self._run_batch, name=name, **batcher_kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, filter: dict = None):
+        return self.batcher((query, k, filter))
+
+    def _embed(self, queries):
+        """批量计算查询向量；整批失败时逐条重算，出错的那条得到异常对象，不连累同批的其他查询"""
+        try:
+            return embed_queries(self.embeddings, queries)
+        except Exception:
+            if len(queries) == 1:
+                raise
+        vectors = []
+        for query in queries:
+            try:
+                vectors.append(self.embeddings.embed_query(query))
+            except Exception as e:
+                vectors.append(e)
+        return vectors
+
+    def _run_batch(self, items):
+        vectors = self._embed([query for query, _, _ in items])
+        results = [vector if isinstance(vector, Exception) else None for vector in vectors]
+        if not hasattr(self.store, "similarity_search_by_vectors"):
+            for i, (vector, (_, k, filter)) in enumerate(zip(vectors, items)):
+                if results[i] is None:
+                    try:
+                        results[i] = self.store.similarity_search_by_vector(vector, k=k, filter=filter)
+                    except Exception as e:
+                        results[i] = e
+            return results
+        groups = {}
+        for i, (_, _, filter) in enumerate(items):
+            if results[i] is None:
+                groups.setdefault(tuple(sorted((filter or {}).items())), []).append(i)
+        for key, indexes in groups.items():
+            k_max = max(items[i][1] for i in indexes)
+            try:
+                hits = self.store.similarity_search_by_vectors([vectors[i] for i in indexes], k_max, dict(key) or None)
+            except Exception as e:
+                # 一组检索失败只影响这一组（同一个 filter）的调用方
+                hits = [e] * len(indexes)
+            for i, row in zip(indexes, hits):
+                results[i] = row if isinstance(row, Exception) else [doc for doc, _ in row[:items[i][1]]]
+        return results
@@ -0,0 +1,73 @@
+"""
+微批检索基准：N 个并发学生同时检索课程库，对比逐个检索与微批检索的吞吐和延迟。
+假 embedding 每次调用带固定往返延迟（--embed-latency-ms），模拟远程 embedding 服务。
+    python 课程助手/benchmarks/bench_batching.py --users 32 --rounds 10 --wait-ms 2 5 10
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from batching import BatchedSearch
+from bench_course_index import make_corpus
+from course_index import CompactVectorIndex
+from fake_embeddings import HashEmbeddings
+from load_test import load_questions, percentile
+
+
+def run(search, users: int, rounds: int, questions):
+    latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(users)
+
+    def student(i):
+        barrier.wait()
+        for r in range(rounds):
+            start = time.perf_counter()
+            search(questions[(i + r) % len(questions)], 6)
+            with lock:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=student, args=(i,)) for i in range(users)]
+    wall = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - wall
+    return {"qps": round(len(latencies) / wall, 1), "p50_ms": round(percentile(latencies, .5), 1),
+            "p99_ms": round(percentile(latencies, .99), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="微批检索基准")
+    parser.add_argument("--users", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--docs", type=int, default=2000)
+    parser.add_argument("--embed-latency-ms", type=float, default=30)
+    parser.add_argument("--wait-ms", type=float, nargs="+", default=[2, 5, 10])
+    args = parser.parse_args()
+
+    embeddings = HashEmbeddings(dim=1536, latency_ms=args.embed_latency_ms)
+    index = CompactVectorIndex(os.path.join(tempfile.mkdtemp(prefix="batching_bench_"), "index"), embeddings)
+    index.add_documents(make_corpus(args.docs))
+    index.persist()
+    questions = load_questions()
+
+    print("逐个检索:", run(lambda q, k: index.similarity_search(q, k=k), args.users, args.rounds, questions))
+    # 单个请求也走批处理时的额外等待（没有并发可合并）
+    for wait in args.wait_ms:
+        batched = BatchedSearch(index, embeddings, name=f"bench_{wait}", max_wait_ms=wait)
+        single = run(lambda q, k: batched.similarity_search(q, k=k), 1, args.rounds, questions)
+        print(f"微批 wait={wait}ms:", run(lambda q, k: batched.similarity_search(q, k=k),
+                                         args.users, args.rounds, questions), "单用户:", single)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+微基准：对比 RAG 链"每次请求重新构建"与"预编译复用"的每轮 Python 开销。
+使用假模型和固定检索结果，不访问网络，只测量 LangChain 链构建与调度本身的耗时。
+    python 课程助手/benchmarks/bench_chain_overhead.py --turns 200
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.documents import Document
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.runnables import RunnableLambda
+from langchain.chains import create_retrieval_chain
+from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain.prompts import ChatPromptTemplate
+
+from chain_registry import ChainRegistry, get_configurable
+from rag_process import RAG_SYSTEM_PROMPT
+
+DOCS = [Document(page_content=f"课程资料片段 {i}：大模型应用开发。" * 20, metadata={"user_id": "u1"})
+        for i in range(6)]
+ANSWER = "这是一个用于基准测试的固定回答。"
+
+
+def fake_llm():
+    return FakeListChatModel(responses=[ANSWER])
+
+
+def build_chain(retriever):
+    prompt = ChatPromptTemplate.from_messages([("system", RAG_SYSTEM_PROMPT), ("human", "{input}")])
+    return create_retrieval_chain(retriever, create_stuff_documents_chain(fake_llm(), prompt))
+
+
+def run_rebuild(turns: int):
+    """旧方式：每轮都重新构建 prompt、stuff 链和检索链，user_id 通过闭包捕获"""
+    for i in range(turns):
+        user_id = f"u{i % 10}"
+        retriever = RunnableLambda(lambda _, uid=user_id: [d for d in DOCS if uid])
+        chain = build_chain(retriever)
+        for _ in chain.stream({"input": "课程的主要目标是什么？"}):
+            pass
+
+
+def run_registry(turns: int):
+    """新方式：链只构建一次，user_id 通过 config 传入"""
+    registry = ChainRegistry()
+
+    def retrieve(inputs, config):
+        return [d for d in DOCS if get_configurable(config, "user_id")]
+
+    for i in range(turns):
+        chain = registry.get(("rag", "user"), lambda: build_chain(RunnableLambda(retrieve)))
+        config = {"configurable": {"user_id": f"u{i % 10}"}}
+        for _ in chain.stream({"input": "课程的主要目标是什么？"}, config=config):
+            pass
+
+
+def measure(fn, turns: int) -> float:
+    fn(5)  # 预热导入与缓存
+    start = time.perf_counter()
+    fn(turns)
+    return (time.perf_counter() - start) / turns * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG 链每轮开销微基准")
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+    rebuild_us = measure(run_rebuild, args.turns)
+    registry_us = measure(run_registry, args.turns)
+    print(f"每轮重新构建: {rebuild_us:10.1f} µs/轮")
+    print(f"预编译复用:   {registry_us:10.1f} µs/轮")
+    print(f"节省:         {rebuild_us - registry_us:10.1f} µs/轮 ({(1 - registry_us / rebuild_us) * 100:.1f}%)")
+
+
+if __name__ == "__main__":
+    main()
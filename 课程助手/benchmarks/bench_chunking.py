@@ -0,0 +1,66 @@
+"""
+分块基准：通用 RecursiveCharacterTextSplitter(1000, 200) 与结构感知分块的对比。
+以 课程咨询QA.txt 为语料：每个问题改写成学生的问法作为查询，对应答案整段出现在检索结果中即为命中。
+统计块数、embedding 字符数（embedding 成本）与 recall@k。
+    python 课程助手/benchmarks/bench_chunking.py --k 3
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, APP_DIR)
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+
+from chunkers import StructureAwareSplitter
+from course_index import CompactVectorIndex
+from fake_embeddings import HashEmbeddings
+
+QA_PATH = os.path.join(APP_DIR, "local_course", "课程咨询QA.txt")
+
+
+def load_pairs(text):
+    return re.findall(r"问题[：:]\s*(.*?)\s*答案[：:]\s*(.*?)(?=\n\s*问题[：:]|\Z)", text, re.S)
+
+
+def evaluate(name, splitter, doc, pairs, k):
+    chunks = splitter.split_documents([doc])
+    embeddings = HashEmbeddings(dim=512)
+    index = CompactVectorIndex(os.path.join(tempfile.mkdtemp(prefix="chunk_bench_"), name), embeddings)
+    index.add_documents(chunks)
+    index.persist()
+    hits = 0
+    for question, answer in pairs:
+        query = "请问" + question.rstrip("？?")
+        results = index.similarity_search(query, k=k)
+        hits += any(answer.strip() in d.page_content for d in results)
+    return {
+        "chunks": len(chunks),
+        "embedded_chars": sum(len(c.page_content) for c in chunks),
+        "avg_chunk_chars": round(sum(len(c.page_content) for c in chunks) / max(len(chunks), 1), 1),
+        f"recall@{k}": round(hits / len(pairs), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分块基准")
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    with open(QA_PATH, encoding="utf-8") as f:
+        text = f.read()
+    doc = Document(page_content=text, metadata={"source": QA_PATH})
+    pairs = load_pairs(text)
+    baseline = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    for name, splitter in (("recursive_1000_200", baseline), ("structured", StructureAwareSplitter(baseline))):
+        print(name, evaluate(name, splitter, doc, pairs, args.k))
+
+
+if __name__ == "__main__":
+    main()
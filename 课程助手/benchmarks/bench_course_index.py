@@ -0,0 +1,113 @@
+"""
+课程库检索基准：Chroma 与紧凑 mmap 索引（float32 / int8）的单查询延迟、批量吞吐、内存与召回对比。
+使用确定性的假 embedding，不访问网络。
+    python 课程助手/benchmarks/bench_course_index.py --docs 5000 --queries 200 --dim 1536
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import numpy as np
+from langchain_core.documents import Document
+
+from course_index import CompactVectorIndex
+from fake_embeddings import HashEmbeddings
+from load_test import load_questions, percentile
+
+
+def make_corpus(n: int, seed: int = 0):
+    """用课程 QA 的问题拼出 n 个不同的文本块"""
+    rng = random.Random(seed)
+    questions = load_questions()
+    docs = []
+    for i in range(n):
+        text = "；".join(rng.sample(questions, min(4, len(questions)))) + f"（第{i}节）"
+        docs.append(Document(page_content=text, metadata={"source": "course_knowledge_base", "chunk": i}))
+    return docs
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def time_queries(store, queries, k):
+    latencies = []
+    for q in queries:
+        start = time.perf_counter()
+        store.similarity_search(q, k=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {"p50_ms": round(percentile(latencies, .5), 3), "p95_ms": round(percentile(latencies, .95), 3)}
+
+
+def recall(results, truth, k):
+    hits = sum(len({d.metadata["chunk"] for d in r[:k]} & t) for r, t in zip(results, truth))
+    return round(hits / (k * len(truth)), 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="课程库检索基准")
+    parser.add_argument("--docs", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=1536, help="与 DashScope text-embedding-v1 相同")
+    parser.add_argument("--k", type=int, default=6)
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--skip-chroma", action="store_true")
+    args = parser.parse_args()
+
+    embeddings = HashEmbeddings(dim=args.dim)
+    docs = make_corpus(args.docs)
+    queries = [q + "？" for q in random.Random(1).choices(load_questions(), k=args.queries)]
+    query_vectors = embeddings.embed_documents(queries)
+    workdir = tempfile.mkdtemp(prefix="course_index_bench_")
+    report = {}
+
+    # 精确结果（float32 暴力检索）作为召回基准
+    exact = CompactVectorIndex(os.path.join(workdir, "float32"), embeddings, "float32")
+    before = rss_mb()
+    exact.add_documents(docs)
+    exact.persist()
+    truth = [{d.metadata["chunk"] for d, _ in r} for r in exact.similarity_search_by_vectors(query_vectors, args.k)]
+
+    for dtype in ("float32", "int8"):
+        index = exact if dtype == "float32" else CompactVectorIndex(os.path.join(workdir, dtype), embeddings, dtype)
+        if dtype != "float32":
+            index.add_documents(docs)
+            index.persist()
+        row = {"index_mb": round(index.memory_bytes() / 2 ** 20, 2), "single": time_queries(index, queries, args.k)}
+        for batch in args.batch:
+            start = time.perf_counter()
+            for i in range(0, len(query_vectors), batch):
+                index.similarity_search_by_vectors(query_vectors[i:i + batch], args.k)
+            row[f"batch{batch}_qps"] = round(len(query_vectors) / (time.perf_counter() - start), 1)
+        results = [[d for d, _ in r] for r in index.similarity_search_by_vectors(query_vectors, args.k)]
+        row["recall@k"] = recall(results, truth, args.k)
+        report[f"compact_{dtype}"] = row
+    report["compact_rss_growth_mb"] = round(rss_mb() - before, 1)
+
+    if not args.skip_chroma:
+        from langchain.vectorstores import Chroma
+        before = rss_mb()
+        chroma = Chroma(persist_directory=os.path.join(workdir, "chroma"), embedding_function=embeddings)
+        for i in range(0, len(docs), 1000):
+            chroma.add_documents(docs[i:i + 1000])
+        row = {"single": time_queries(chroma, queries, args.k)}
+        results = [chroma.similarity_search_by_vector(v, k=args.k) for v in query_vectors]
+        row["recall@k"] = recall(results, truth, args.k)
+        row["rss_growth_mb"] = round(rss_mb() - before, 1)
+        report["chroma"] = row
+
+    # 单查询延迟里包含 embedding（假 embedding 的计算量对两种存储相同）
+    for name, row in report.items():
+        print(f"{name}: {row}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+embedding 后端基准：查询 embedding 的延迟分位数与批量入库的吞吐。
+语料为 local_course 的问答对（入库时重复到 --docs 条，每条加编号避免缓存）。
+    python 课程助手/benchmarks/bench_embeddings.py --backends hash,local,dashscope
+    python 课程助手/benchmarks/bench_embeddings.py --backends local --simulate-remote-ms 120   # 加一个模拟远程 API 的对照
+local 需要 EMBEDDING_MODEL_DIR 下有模型，dashscope 需要 DASHSCOPE_API_KEY，不满足时跳过。
+"""
+import argparse
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, APP_DIR)
+
+from chunkers import parse_qa_pairs
+from embedding_backends import backend_name, get_embeddings
+from fake_embeddings import HashEmbeddings
+from load_test import percentile
+
+QA_PATH = os.path.join(APP_DIR, "local_course", "课程咨询QA.txt")
+REMOTE_BATCH = 25  # DashScope 每次请求最多 25 条文本
+
+
+class SimulatedRemote(HashEmbeddings):
+    """模拟远程 API：每个请求一次往返，批量 embedding 按 REMOTE_BATCH 拆成多个请求"""
+    def embed_documents(self, texts):
+        vectors = []
+        for i in range(0, len(texts), REMOTE_BATCH):
+            vectors.extend(super().embed_documents(texts[i:i + REMOTE_BATCH]))
+        return vectors
+
+
+def load_corpus():
+    with open(QA_PATH, encoding="utf-8") as f:
+        pairs = parse_qa_pairs(f.read())
+    return [q for q, _ in pairs], [f"问题：{q}\n答案：{a}" for q, a in pairs]
+
+
+def bench(name, embeddings, queries, chunks, args):
+    embeddings.embed_query("预热")
+    latencies = []
+    for i in range(args.queries):
+        start = time.perf_counter()
+        embeddings.embed_query(f"{queries[i % len(queries)]}（{i}）")
+        latencies.append((time.perf_counter() - start) * 1000)
+    docs = [f"{chunks[i % len(chunks)]}\n编号 {i}" for i in range(args.docs)]
+    start = time.perf_counter()
+    for i in range(0, len(docs), args.ingest_batch):
+        embeddings.embed_documents(docs[i:i + args.ingest_batch])
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} 查询 p50={percentile(latencies, 0.5):7.1f}ms  p95={percentile(latencies, 0.95):7.1f}ms  "
+          f"入库 {len(docs) / elapsed:8.1f} 块/秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="embedding 后端基准")
+    parser.add_argument("--backends", default="hash,local,dashscope")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--docs", type=int, default=2000, help="入库的块数")
+    parser.add_argument("--ingest-batch", type=int, default=256, help="每次 embed_documents 的块数（与写入协调器一组相当）")
+    parser.add_argument("--simulate-remote-ms", type=float, default=0,
+                        help="额外测一个每次调用有固定往返延迟的模拟远程后端")
+    args = parser.parse_args()
+
+    queries, chunks = load_corpus()
+    for backend in [b.strip() for b in args.backends.split(",") if b.strip()]:
+        try:
+            embeddings = get_embeddings(backend)
+        except Exception as e:
+            print(f"{backend:<28} 跳过：{e}")
+            continue
+        if backend == "dashscope" and not os.getenv("DASHSCOPE_API_KEY"):
+            print(f"{backend:<28} 跳过：没有 DASHSCOPE_API_KEY")
+            continue
+        bench(backend_name(embeddings), embeddings, queries, chunks, args)
+    if args.simulate_remote_ms:
+        remote = SimulatedRemote(dim=512, latency_ms=args.simulate_remote_ms)
+        bench(f"模拟远程({args.simulate_remote_ms:.0f}ms 往返)", remote, queries, chunks, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+模型网关基准：两个本地假模型服务（主服务注入长尾延迟和失败，备用服务正常），
+对比直接调用主服务与经过网关（重试 + 熔断 + 对冲）时的首 token 延迟分位数和失败率。
+    python 课程助手/benchmarks/bench_gateway.py --calls 200 --concurrency 8 --slow-rate 0.1 --fail-rate 0.05
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, APP_DIR)
+
+from fake_llm_server import start_fake_llm_server
+from load_test import percentile
+
+
+def run_calls(llm, calls: int, concurrency: int):
+    """并发发起流式调用，返回 (首 token 毫秒列表, 失败次数)"""
+    ttfts, failures = [], 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal failures
+        start = time.perf_counter()
+        try:
+            for _ in llm.stream(f"第 {i} 个问题：这门课讲什么？"):
+                with lock:
+                    ttfts.append((time.perf_counter() - start) * 1000)
+                break
+        except Exception:
+            with lock:
+                failures += 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(calls)))
+    return ttfts, failures
+
+
+def report(name, ttfts, failures, calls):
+    print(f"{name:<8} p50={percentile(ttfts, 0.5):7.0f}ms  p95={percentile(ttfts, 0.95):7.0f}ms  "
+          f"p99={percentile(ttfts, 0.99):7.0f}ms  失败率={failures / calls:.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模型网关基准")
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--ttft-ms", type=float, default=100)
+    parser.add_argument("--slow-rate", type=float, default=0.1, help="主服务长尾请求的比例")
+    parser.add_argument("--slow-ms", type=float, default=3000)
+    parser.add_argument("--fail-rate", type=float, default=0.05, help="主服务失败的比例")
+    args = parser.parse_args()
+
+    primary = start_fake_llm_server(ttft_ms=args.ttft_ms, tokens_per_sec=200, answer_tokens=20,
+                                    fail_rate=args.fail_rate, slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    secondary = start_fake_llm_server(ttft_ms=args.ttft_ms * 1.5, tokens_per_sec=200, answer_tokens=20)
+    # 必须在导入应用模块之前设置
+    os.environ["DASHSCOPE_BASE_URL"] = primary.url
+    os.environ["DASHSCOPE_API_KEY"] = "offline-benchmark"
+    os.environ["DEEPSEEK_BASE_URL"] = secondary.url
+    os.environ["deepseek_api_key"] = "offline-benchmark"
+    os.environ.setdefault("GATEWAY_HEDGE_MIN_SAMPLES", "10")
+    os.environ.setdefault("GATEWAY_BACKOFF_BASE", "0.05")
+    os.environ.setdefault("SCHEDULER", "0")
+
+    from llm_registry import get_chat_model, get_provider_model, registry_stats
+
+    direct = get_provider_model("qwen-max", streaming=True, max_retries=0)
+    ttfts, failures = run_calls(direct, args.calls, args.concurrency)
+    report("direct", ttfts, failures, args.calls)
+
+    gateway = get_chat_model("qwen-max", streaming=True)
+    run_calls(gateway, 20, args.concurrency)  # 预热：积累主服务的首 token 样本
+    ttfts, failures = run_calls(gateway, args.calls, args.concurrency)
+    report("gateway", ttfts, failures, args.calls)
+    print("服务状态:", registry_stats().get("providers"))
+    print(f"请求数: 主服务 {primary.requests}，备用服务 {secondary.requests}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+基准：聊天记录搜索，FTS5 全文索引 vs LIKE 扫描。
+生成 --turns 轮对话（文本取自 local_course 的问答对随机拼接），分给 --users 个用户，
+其中"访客"共用一个 user_id，占 --guest-share 比例的记录。
+    python 课程助手/benchmarks/bench_history_search.py --turns 1000000
+输出建索引耗时、数据库大小，以及普通用户、访客（只搜自己的几个会话）和整个访客桶（最重的情况）搜索的 p50/p95 延迟。
+"""
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, APP_DIR)
+
+from chunkers import parse_qa_pairs
+from load_test import percentile
+
+QA_PATH = os.path.join(APP_DIR, "local_course", "课程咨询QA.txt")
+
+
+def generate(db_path, args, pairs):
+    rng = random.Random(0)
+    conn = sqlite3.connect(db_path)
+    conn.execute("""CREATE TABLE chat_history (user_id TEXT NOT NULL, chat_id TEXT NOT NULL,
+                    user_question TEXT NOT NULL, ai_response TEXT NOT NULL, last_response_date DATE NOT NULL)""")
+    today = datetime.date.today()
+    batch = []
+    for i in range(args.turns):
+        user = "访客" if rng.random() < args.guest_share else f"user{rng.randrange(args.users)}"
+        question, answer = rng.choice(pairs)
+        answer = answer + rng.choice(pairs)[1]
+        batch.append((user, f"{user}-{rng.randrange(args.turns // args.users // 5 + 1)}", question, answer,
+                      (today - datetime.timedelta(days=rng.randrange(365))).isoformat()))
+        if len(batch) >= 10000:
+            conn.executemany("INSERT INTO chat_history VALUES (?, ?, ?, ?, ?)", batch)
+            batch = []
+    conn.executemany("INSERT INTO chat_history VALUES (?, ?, ?, ?, ?)", batch)
+    conn.commit()
+    conn.close()
+
+
+def sample_queries(pairs, count):
+    """从问题里取 2~4 个字的片段作为查询"""
+    rng = random.Random(1)
+    queries = []
+    while len(queries) < count:
+        question = rng.choice(pairs)[0]
+        length = rng.randint(2, 4)
+        if len(question) > length:
+            start = rng.randrange(len(question) - length)
+            queries.append(question[start:start + length])
+    return queries
+
+
+def bench(manager, user_id, queries, repeat, chat_ids=None):
+    latencies = []
+    for i in range(repeat):
+        query = queries[i % len(queries)]
+        start = time.perf_counter()
+        manager.count_search_sessions(user_id, query, chat_ids)
+        manager.search_sessions(user_id, query, 0, 10, chat_ids)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天记录搜索基准")
+    parser.add_argument("--turns", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--guest-share", type=float, default=0.1)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    with open(QA_PATH, encoding="utf-8") as f:
+        pairs = parse_qa_pairs(f.read())
+    workdir = tempfile.mkdtemp(prefix="bench_history_")
+    db_path = os.path.join(workdir, "history.db")
+    start = time.perf_counter()
+    generate(db_path, args, pairs)
+    print(f"生成 {args.turns} 轮对话: {time.perf_counter() - start:.1f}s，{os.path.getsize(db_path) / 1e6:.0f}MB")
+
+    os.environ["HISTORY_DB_URI"] = f"sqlite:///{db_path}"
+    from history_management import HistoryManager
+    start = time.perf_counter()
+    manager = HistoryManager()  # 首次打开时建立全文索引
+    print(f"建立全文索引: {time.perf_counter() - start:.1f}s，数据库 {os.path.getsize(db_path) / 1e6:.0f}MB")
+
+    queries = sample_queries(pairs, 50)
+    guest_chats = [f"访客-{i}" for i in range(5)]
+    for fts in (True, False):
+        manager.fts = fts
+        # 界面上的访客只搜索自己本次创建的会话；不带会话过滤的"访客"相当于一个拥有全部访客记录的极端用户
+        for label, user_id, chat_ids in (("普通用户", "user7", None), ("访客(5个会话)", "访客", guest_chats),
+                                         ("整个访客桶", "访客", None)):
+            latencies = bench(manager, user_id, queries, args.queries if fts else max(args.queries // 10, 5), chat_ids)
+            print(f"{'FTS5' if fts else 'LIKE':<5} {label:<10} p50={percentile(latencies, 0.5):8.2f}ms  "
+                  f"p95={percentile(latencies, 0.95):8.2f}ms  （计数 + 第一页）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+多进程吞吐压测：同样数量的并发学生，分别用 1/2/4… 个应用进程处理，对比吞吐与延迟。
+会话状态在共享的 SQLite 状态后端里，stateless 路由下同一个学生的每一轮都会换一个进程处理，
+结束时校验每个会话的消息条数，确认历史没有因为跨进程而丢失。
+
+    python 课程助手/benchmarks/bench_multiprocess.py --processes 1 2 4 --users 16 --turns 4 --routing stateless
+    python 课程助手/benchmarks/bench_multiprocess.py --processes 1 4 --mode rag --routing sticky
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from load_test import REPO_DIR, load_questions, percentile, setup_offline_env
+
+
+def _fake_llm_process(args, url_queue):
+    """假模型服务放在独立进程，避免和压测进程抢 GIL"""
+    from fake_llm_server import start_fake_llm_server
+    server = start_fake_llm_server(ttft_ms=args.ttft_ms, tokens_per_sec=args.tps, answer_tokens=args.answer_tokens)
+    url_queue.put(server.url)
+    while True:
+        time.sleep(3600)
+
+
+def _worker(args, workdir, llm_url, tasks, results):
+    """应用进程：每收到一批 (user, turn) 就用线程并发处理，模拟一个进程同时服务多个请求"""
+    os.chdir(REPO_DIR)
+    setup_offline_env(args, workdir, llm_url=llm_url, load_documents=False)
+    from agent_with_tools import AgentRouter
+    questions = load_questions()
+
+    def turn(user_idx, turn_idx, out):
+        start = time.perf_counter()
+        ttft = None
+        router = AgentRouter(f"mp-{args.run_id}-{user_idx}")
+        question = questions[(user_idx + turn_idx) % len(questions)]
+        try:
+            for token in router.chat_stream({"intention": args.mode, "message": question, "upload": None}):
+                if ttft is None and token:
+                    ttft = time.perf_counter() - start
+        except Exception as e:
+            out.append({"error": repr(e)})
+            return
+        latency = time.perf_counter() - start
+        out.append({"latency": latency, "ttft": ttft if ttft is not None else latency, "pid": os.getpid()})
+
+    while True:
+        batch = tasks.get()
+        if batch is None:
+            break
+        out = []
+        threads = [threading.Thread(target=turn, args=(u, t, out)) for u, t in batch]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        results.put(out)
+
+
+def run(args, processes: int, workdir: str, llm_url: str):
+    ctx = mp.get_context("spawn")
+    os.environ["STATE_DB_PATH"] = os.path.join(workdir, f"session_state_{processes}.db")
+    args.run_id = f"p{processes}"
+    task_queues = [ctx.Queue() for _ in range(processes)]
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_worker, args=(args, workdir, llm_url, q, results), daemon=True)
+               for q in task_queues]
+    for w in workers:
+        w.start()
+
+    # 预热：每个进程先跑一轮不计时的请求（导入模块、打开向量库、建立连接）
+    for q in task_queues:
+        q.put([(-1, 0)])
+    for _ in task_queues:
+        results.get()
+
+    records = []
+    wall_start = time.perf_counter()
+    for turn_idx in range(args.turns):
+        batches = [[] for _ in range(processes)]
+        for user_idx in range(args.users):
+            # sticky：学生固定在一个进程；stateless：每一轮换一个进程
+            offset = 0 if args.routing == "sticky" else turn_idx
+            batches[(user_idx + offset) % processes].append((user_idx, turn_idx))
+        busy = 0
+        for q, batch in zip(task_queues, batches):
+            if batch:
+                q.put(batch)
+                busy += 1
+        for _ in range(busy):
+            records.extend(results.get())
+    wall = time.perf_counter() - wall_start
+
+    for q in task_queues:
+        q.put(None)
+    for w in workers:
+        w.join(timeout=10)
+
+    ok = [r for r in records if "latency" in r]
+    summary = {
+        "processes": processes,
+        "turns": len(ok),
+        "errors": len(records) - len(ok),
+        "wall_s": round(wall, 3),
+        "throughput_turns_per_s": round(len(ok) / wall, 3) if wall else 0.0,
+        "latency_p50_ms": round(percentile([r["latency"] * 1000 for r in ok], .5), 1),
+        "latency_p95_ms": round(percentile([r["latency"] * 1000 for r in ok], .95), 1),
+        "ttft_p50_ms": round(percentile([r["ttft"] * 1000 for r in ok], .5), 1),
+        "pids": len({r["pid"] for r in ok}),
+    }
+    if args.mode == "normal":
+        summary["history_consistent"] = check_history(args)
+    return summary
+
+
+def check_history(args) -> bool:
+    """普通对话每轮写入用户和助手各一条消息，跨进程后条数必须完整"""
+    from state_backend import SQLiteStateBackend
+    backend = SQLiteStateBackend(os.environ["STATE_DB_PATH"])
+    expected = 2 * args.turns
+    return all(len(backend.get_messages(f"mp-{args.run_id}-{u}")) == expected for u in range(args.users))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多进程吞吐压测")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--users", type=int, default=16, help="并发学生数")
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--mode", choices=["normal", "rag", "auto"], default="normal")
+    parser.add_argument("--routing", choices=["sticky", "stateless"], default="stateless")
+    parser.add_argument("--ttft-ms", type=float, default=100)
+    parser.add_argument("--tps", type=float, default=200)
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--embed-latency-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    os.chdir(REPO_DIR)
+    workdir = tempfile.mkdtemp(prefix="course_mp_bench_")
+    ctx = mp.get_context("spawn")
+    url_queue = ctx.Queue()
+    llm_proc = ctx.Process(target=_fake_llm_process, args=(args, url_queue), daemon=True)
+    llm_proc.start()
+    llm_url = url_queue.get()
+
+    # 父进程建好课程库，子进程只读打开
+    setup_offline_env(args, workdir, llm_url=llm_url, load_documents=True)
+
+    rows = [run(args, p, workdir, llm_url) for p in args.processes]
+    llm_proc.terminate()
+    print(json.dumps(rows, ensure_ascii=False, indent=2))
+    base = rows[0]["throughput_turns_per_s"] or 1.0
+    for row in rows:
+        print(f"{row['processes']} 个进程: {row['throughput_turns_per_s']} 轮/秒 "
+              f"(x{row['throughput_turns_per_s'] / base:.2f}), p95 {row['latency_p95_ms']}ms")
+
+
+if __name__ == "__main__":
+    main()
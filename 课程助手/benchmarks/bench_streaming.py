@@ -0,0 +1,94 @@
+"""
+基准：对比旧的"逐 token 推送完整 chat_history + 20 个按钮更新"与新的"合帧 + 只改最后一条消息"，
+统计每个回答发送的字节数和服务端序列化 CPU 时间。使用模拟时钟，不需要启动 Gradio。
+    python 课程助手/benchmarks/bench_streaming.py --history 40 --tokens 600 --rate 40 --fps 15
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stream_coalescer import stream_to_message
+
+MAX_SESSIONS = 10
+UPDATE = {"__type__": "update"}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_history(n: int):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": "历史消息内容。" * 60} for i in range(n)]
+
+
+def make_tokens(n: int, rate: float, clock: FakeClock):
+    """按 rate token/秒 产出 token，其中夹杂空格和换行"""
+    pieces = ["大模型", "应用", " ", "开发", "\n", "课程", "。"]
+    for i in range(n):
+        clock.now += 1.0 / rate
+        yield pieces[i % len(pieces)]
+
+
+def run_old(history, tokens):
+    """旧实现：每个非空白 token 都推送全部输出；Gradio 整体序列化"""
+    occupied = [[0] * MAX_SESSIONS for _ in range(3)]
+    chat_history = history + [{"role": "assistant", "content": ""}]
+    bot_response = ""
+    frames, sent = 0, 0
+    for token in tokens:
+        if token and token.strip():
+            bot_response += token
+            chat_history[-1] = {"role": "assistant", "content": bot_response}
+            payload = [{"text": "", "files": []}, chat_history, occupied, "chat-id"] + [UPDATE] * (2 * MAX_SESSIONS)
+            sent += len(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+            frames += 1
+    return frames, sent, bot_response
+
+
+def run_new(history, tokens, fps, clock):
+    """新实现：合帧后只输出输入框与聊天窗口；按 Gradio 的增量协议，只有最后一条消息的增量上线"""
+    chat_history = history + [{"role": "assistant", "content": ""}]
+    frames, sent, text = 0, 0, ""
+    for text, delta in stream_to_message(tokens, max_fps=fps, clock=clock):
+        chat_history[-1] = {"role": "assistant", "content": text}
+        diff = [UPDATE, [["append", [len(chat_history) - 1, "content"], delta]]]
+        sent += len(json.dumps(diff, ensure_ascii=False).encode("utf-8"))
+        frames += 1
+    return frames, sent, text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="流式输出字节数与 CPU 基准")
+    parser.add_argument("--history", type=int, default=40, help="已有历史消息条数")
+    parser.add_argument("--tokens", type=int, default=600, help="回答 token 数")
+    parser.add_argument("--rate", type=float, default=40, help="模型输出速率 token/秒")
+    parser.add_argument("--fps", type=float, default=15, help="合帧帧率")
+    args = parser.parse_args()
+    history = make_history(args.history)
+
+    clock = FakeClock()
+    cpu = time.process_time()
+    old_frames, old_bytes, old_text = run_old(history, make_tokens(args.tokens, args.rate, clock))
+    old_cpu = (time.process_time() - cpu) * 1000
+
+    clock = FakeClock()
+    cpu = time.process_time()
+    new_frames, new_bytes, new_text = run_new(history, make_tokens(args.tokens, args.rate, clock), args.fps, clock)
+    new_cpu = (time.process_time() - cpu) * 1000
+
+    print(f"{'':8}{'帧数':>8}{'发送字节':>14}{'CPU(ms)':>10}{'回答长度':>10}")
+    print(f"{'旧实现':8}{old_frames:>8}{old_bytes:>14}{old_cpu:>10.1f}{len(old_text):>10}")
+    print(f"{'新实现':8}{new_frames:>8}{new_bytes:>14}{new_cpu:>10.1f}{len(new_text):>10}")
+    print(f"字节减少 {(1 - new_bytes / old_bytes) * 100:.1f}%，旧实现丢失空白字符 {len(new_text) - len(old_text)} 个")
+
+
+if __name__ == "__main__":
+    main()
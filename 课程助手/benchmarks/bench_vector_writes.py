@@ -0,0 +1,107 @@
+"""
+向量库写入基准：并发上传时，每次上传各自 add_documents + persist 与经过写入协调器（分组提交）的对比。
+统计上传吞吐、单次上传延迟和 persist 次数，并检查 read-your-writes：每次上传返回后立即按 user_id 检索，必须能查到。
+    python 课程助手/benchmarks/bench_vector_writes.py --store chroma --uploads 64 --concurrency 16
+    python 课程助手/benchmarks/bench_vector_writes.py --store compact    # 不依赖 chromadb
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, APP_DIR)
+
+from langchain_core.documents import Document
+
+from fake_embeddings import HashEmbeddings
+from load_test import percentile
+from write_coordinator import VectorWriteCoordinator, _write
+
+
+class CountingPersist:
+    """统计 persist 次数的代理"""
+    def __init__(self, store):
+        self._store = store
+        self.persists = 0
+        self._lock = threading.Lock()
+
+    def persist(self):
+        with self._lock:
+            self.persists += 1
+        persist = getattr(self._store, "persist", None)
+        if persist is not None:
+            persist()
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
+
+
+def open_store(kind: str, embeddings):
+    path = tempfile.mkdtemp(prefix=f"vector_writes_{kind}_")
+    if kind == "compact":
+        from course_index import CompactVectorIndex
+        return CountingPersist(CompactVectorIndex(os.path.join(path, "index"), embeddings))
+    from langchain.vectorstores import Chroma
+    return CountingPersist(Chroma(persist_directory=path, embedding_function=embeddings))
+
+
+def make_upload(i: int, chunks: int):
+    user_id = f"student{i}"
+    return user_id, [Document(page_content=f"{user_id} 的实验报告第 {j} 段：卷积神经网络的训练与调参记录 {i * chunks + j}。",
+                              metadata={"user_id": user_id, "original_file": f"report{i}.pdf"}) for j in range(chunks)]
+
+
+def run(mode: str, args):
+    embeddings = HashEmbeddings(dim=256)
+    store = open_store(args.store, embeddings)
+    coordinator = VectorWriteCoordinator(store, embeddings, name=f"bench_{mode}") if mode == "group" else None
+    direct_lock = threading.Lock()  # 直接写入时 embedding 并行计算，写入 + persist 作为一个整体串行执行
+    latencies, violations = [], 0
+    stats_lock = threading.Lock()
+
+    def upload(i):
+        nonlocal violations
+        user_id, docs = make_upload(i, args.chunks)
+        start = time.perf_counter()
+        if coordinator is not None:
+            coordinator.add_documents(docs)
+        else:
+            vectors = embeddings.embed_documents([d.page_content for d in docs])
+            ids = [str(uuid.uuid4()) for _ in docs]
+            with direct_lock:
+                _write(store, docs, vectors, ids)
+                store.persist()
+        elapsed = (time.perf_counter() - start) * 1000
+        found = store.similarity_search(docs[0].page_content, k=1, filter={"user_id": user_id})
+        with stats_lock:
+            latencies.append(elapsed)
+            violations += not found
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(upload, range(args.uploads)))
+    wall = time.perf_counter() - start
+    print(f"{mode:<7} 吞吐={args.uploads / wall:7.1f} 次上传/秒  p50={percentile(latencies, 0.5):7.1f}ms  "
+          f"p95={percentile(latencies, 0.95):7.1f}ms  persist={store.persists:4d}  read-your-writes 失败={violations}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量库分组提交基准")
+    parser.add_argument("--store", choices=["chroma", "compact"], default="chroma")
+    parser.add_argument("--uploads", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--chunks", type=int, default=20, help="每次上传的文档块数")
+    args = parser.parse_args()
+    for mode in ("direct", "group"):
+        run(mode, args)
+
+
+if __name__ == "__main__":
+    main()
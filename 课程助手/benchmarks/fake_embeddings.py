@@ -0,0 +1,45 @@
+"""
+确定性的离线 embedding：把文本的字符二元组哈希到固定维度并做 L2 归一化（与 embedding_backends 的 hash 后端相同）。
+同样的文本永远得到同样的向量，字面相近的文本向量也相近，足以让检索结果有意义，且不访问网络。
+这里额外支持模拟远程调用的延迟和调用计数。
+"""
+import time
+
+try:
+    from langchain_core.embeddings import Embeddings
+except ImportError:  # 只跑纯 Python 部分时不强制依赖 LangChain
+    Embeddings = object
+
+from embedding_backends import hash_embed
+
+
+class HashEmbeddings(Embeddings):
+    def __init__(self, dim: int = 256, latency_ms: float = 0.0):
+        """
+        :param dim: 向量维度
+        :param latency_ms: 每次调用额外的模拟延迟（模拟远程 embedding 服务的往返）
+        """
+        self.dim = dim
+        self.latency_ms = latency_ms
+        self.calls = 0
+        self.texts = 0
+
+    def _sleep(self):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def embed_documents(self, texts):
+        self._sleep()
+        self.calls += 1
+        self.texts += len(texts)
+        return [hash_embed(t, self.dim) for t in texts]
+
+    def embed_query(self, text):
+        self._sleep()
+        self.calls += 1
+        self.texts += 1
+        return hash_embed(text, self.dim)
+
+    def embed_queries(self, texts):
+        """批量查询：与 embed_documents 一样一次往返"""
+        return self.embed_documents(texts)
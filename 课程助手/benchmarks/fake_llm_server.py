@@ -0,0 +1,153 @@
+"""
+本地的 OpenAI 兼容假模型服务，用于离线基准测试和故障注入。
+支持 POST /v1/chat/completions（流式与非流式）和 GET /v1/models，可配置：
+    ttft_ms          首 token 延迟
+    tokens_per_sec   输出速率
+    answer_tokens    每个回答的 token 数
+    fail_rate        按概率返回 500（故障注入）
+    extra_latency_ms 额外的固定延迟（模拟慢服务）
+    slow_rate        按概率在首 token 前再等待 slow_ms（模拟长尾延迟）
+单独运行：python 课程助手/benchmarks/fake_llm_server.py --port 18080 --ttft-ms 300 --tps 40
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOKENS = ["本课程", "围绕", "大模型", "应用", "开发", "，", "讲解", " LangChain ", "与", "RAG", "。", "\n"]
+
+
+def default_responder(messages) -> str:
+    """根据请求内容给出确定性的回答：意图识别返回编号，ReAct Agent 先调用一次工具再给出最终答案"""
+    prompt = "\n".join(str(m.get("content", "")) for m in messages)
+    if "意图识别" in prompt:
+        return "2"
+    if "ReAct" in prompt:
+        if "Observation:" in prompt.split("Question:")[-1]:
+            return "Thought: 我现在可以给出最终答案了\nFinal Answer: 根据搜索结果，这是假的最终回答。"
+        return "Thought: 需要搜索\nAction: tavily_search\nAction Input: 课程 最新消息"
+    return None
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持 keep-alive，便于验证连接复用
+    server_version = "FakeLLM/1.0"
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._json(200, {"object": "list", "data": [{"id": "qwen-max", "object": "model"}]})
+        else:
+            self._json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        cfg = self.server.config
+        self.server.requests += 1
+        if cfg["extra_latency_ms"]:
+            time.sleep(cfg["extra_latency_ms"] / 1000)
+        if random.random() < cfg["fail_rate"]:
+            self._json(500, {"error": {"message": "injected failure", "type": "server_error"}})
+            return
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._json(404, {"error": "not found"})
+            return
+        text = cfg["responder"](body.get("messages", []))
+        tokens = [text] if text is not None else [TOKENS[i % len(TOKENS)] for i in range(cfg["answer_tokens"])]
+        model = body.get("model", "qwen-max")
+        time.sleep(cfg["ttft_ms"] / 1000)
+        if random.random() < cfg["slow_rate"]:
+            time.sleep(cfg["slow_ms"] / 1000)
+        if body.get("stream"):
+            self._stream(model, tokens, cfg["tokens_per_sec"])
+        else:
+            time.sleep(max(len(tokens) - 1, 0) / cfg["tokens_per_sec"])
+            content = "".join(tokens)
+            self._json(200, {
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            })
+
+    def _stream(self, model, tokens, tokens_per_sec):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(1.0 / tokens_per_sec)
+                self._chunk(model, {"role": "assistant", "content": token} if i == 0 else {"content": token}, None)
+            self._chunk(model, {}, "stop")
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端取消了请求
+            self.server.cancelled += 1
+            self.close_connection = True
+
+    def _chunk(self, model, delta, finish_reason):
+        data = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        self._write_chunk(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, payload: bytes):
+        self.wfile.write(f"{len(payload):X}\r\n".encode() + payload + b"\r\n")
+        self.wfile.flush()
+
+    def _json(self, status, data):
+        payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_llm_server(port: int = 0, ttft_ms: float = 200, tokens_per_sec: float = 50,
+                          answer_tokens: int = 120, fail_rate: float = 0.0, extra_latency_ms: float = 0,
+                          responder=None, slow_rate: float = 0.0, slow_ms: float = 0):
+    """在后台线程启动假模型服务，返回 server，server.url 为 OpenAI 兼容的 base_url"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeLLMHandler)
+    server.daemon_threads = True
+    server.requests = 0
+    server.cancelled = 0
+
+    def respond(messages):
+        return (responder or default_responder)(messages)
+
+    server.config = {
+        "ttft_ms": ttft_ms, "tokens_per_sec": tokens_per_sec, "answer_tokens": answer_tokens,
+        "fail_rate": fail_rate, "extra_latency_ms": extra_latency_ms, "responder": respond,
+        "slow_rate": slow_rate, "slow_ms": slow_ms,
+    }
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    threading.Thread(target=server.serve_forever, name="fake-llm", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的假模型服务")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--ttft-ms", type=float, default=200)
+    parser.add_argument("--tps", type=float, default=50, help="每秒输出 token 数")
+    parser.add_argument("--tokens", type=int, default=120, help="每个回答的 token 数")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--extra-latency-ms", type=float, default=0)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--slow-ms", type=float, default=0)
+    args = parser.parse_args()
+    srv = start_fake_llm_server(args.port, args.ttft_ms, args.tps, args.tokens, args.fail_rate, args.extra_latency_ms,
+                                slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    print(f"假模型服务已启动: {srv.url}  (Ctrl+C 退出)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        srv.shutdown()
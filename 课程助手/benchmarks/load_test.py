@@ -0,0 +1,244 @@
+"""
+离线端到端压测：假模型服务 + 确定性假 embedding + 桩工具，完全不访问网络。
+模拟 N 个学生并发提问，统计吞吐、p50/p95/p99 延迟与首 token 时间、进程内存，结果保存为 JSON 便于对比。
+
+    python 课程助手/benchmarks/load_test.py --scenario router --mode rag --users 20 --turns 5
+    python 课程助手/benchmarks/load_test.py --scenario rag --users 10
+    python 课程助手/benchmarks/load_test.py --scenario upload --users 5 --turns 2
+    python 课程助手/benchmarks/load_test.py --scenario gradio --users 8      # 需要 gradio_client
+    python 课程助手/benchmarks/load_test.py --compare results/a.json results/b.json
+
+场景：
+    router  AgentRouter.chat_stream（--mode normal/rag/search/auto）
+    rag     RAGProcess.answer_question
+    upload  RAGProcess.upload_document
+    gradio  通过 gradio_client 按界面的顺序调用 start_turn（每个学生第一轮新建会话）和 respond 事件
+"""
+import argparse
+import datetime
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+REPO_DIR = os.path.dirname(APP_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+sys.path.insert(0, APP_DIR)
+
+from fake_llm_server import start_fake_llm_server
+from fake_embeddings import HashEmbeddings
+
+
+def load_questions():
+    """从课程 QA 文件中取出问题作为压测输入"""
+    path = os.path.join(APP_DIR, "local_course", "课程咨询QA.txt")
+    with open(path, encoding="utf-8") as f:
+        return [line.strip()[3:] for line in f if line.startswith("问题：")]
+
+
+def setup_offline_env(args, workdir, llm_url=None, load_documents=True):
+    """
+    启动假模型服务并把应用的模型地址、embedding、工具、历史库都指向离线实现。
+    llm_url 不为空时复用已有的假模型服务；load_documents=False 时直接打开已建好的课程库（多进程压测的子进程）。
+    """
+    server = None
+    if llm_url is None:
+        server = start_fake_llm_server(ttft_ms=args.ttft_ms, tokens_per_sec=args.tps, answer_tokens=args.answer_tokens)
+        llm_url = server.url
+    # 必须在导入应用模块之前设置（llm_registry 在导入时读取默认地址）
+    os.environ["DASHSCOPE_BASE_URL"] = llm_url
+    os.environ["DASHSCOPE_API_KEY"] = "offline-benchmark"
+    os.environ["HISTORY_DB_URI"] = f"sqlite:///{os.path.join(workdir, 'history.db')}"
+    os.environ.setdefault("STATE_DB_PATH", os.path.join(workdir, "session_state.db"))
+    os.environ.setdefault("TRACE_SAMPLE_RATE", "1")
+
+    from agent_with_tools import AgentRouter
+    from rag_process import RAGProcess
+    from stub_tools import get_stub_tools
+
+    rag = RAGProcess(persist_directory=os.path.join(workdir, "kb"),
+                     upload_directory=os.path.join(workdir, "uploads"),
+                     embeddings=HashEmbeddings(latency_ms=args.embed_latency_ms))
+    if load_documents:
+        rag.load_course_documents(os.path.join(APP_DIR, "local_course"))
+    AgentRouter.__dict__["my_rag"].set(rag)
+    AgentRouter.__dict__["tools"].set(get_stub_tools())
+    return server, rag
+
+
+def make_turn_fn(args, rag, workdir, questions):
+    """返回 turn(user_idx, turn_idx) -> token 迭代器"""
+    if args.scenario == "router":
+        from agent_with_tools import AgentRouter
+
+        def turn(user_idx, turn_idx):
+            router = AgentRouter(f"bench-{user_idx}")
+            question = questions[(user_idx + turn_idx) % len(questions)]
+            return router.chat_stream({"intention": args.mode, "message": question, "upload": None})
+        return turn
+
+    if args.scenario == "rag":
+        def turn(user_idx, turn_idx):
+            question = questions[(user_idx + turn_idx) % len(questions)]
+            for chunk in rag.answer_question(question, f"bench-{user_idx}", "course"):
+                if chunk["type"] == "answer":
+                    yield chunk["answer"]
+        return turn
+
+    if args.scenario == "upload":
+        def turn(user_idx, turn_idx):
+            path = os.path.join(workdir, f"upload_{user_idx}_{turn_idx}.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("\n\n".join(questions) * args.upload_repeat)
+            result = rag.upload_document(path, f"bench-{user_idx}")
+            yield result["message"]
+        return turn
+
+    if args.scenario == "gradio":
+        from gradio_client import Client
+        import 界面
+        demo = 界面.main_interface()
+        demo.queue(default_concurrency_limit=args.users)
+        demo.launch(prevent_thread_lock=True, server_name="127.0.0.1", server_port=args.gradio_port, share=False)
+        url = f"http://127.0.0.1:{args.gradio_port}/"
+        clients = {}
+        lock = threading.Lock()
+
+        def turn(user_idx, turn_idx):
+            with lock:
+                if user_idx not in clients:
+                    clients[user_idx] = Client(url, verbose=False)
+            question = questions[(user_idx + turn_idx) % len(questions)]
+            message = {"text": question, "files": []}
+            # 与界面相同：先 start_turn（没有会话时新建，会话ID保存在该客户端的会话状态中），再流式回答
+            clients[user_idx].predict(message, api_name="/start_turn")
+            job = clients[user_idx].submit(message, [], api_name="/respond")
+            for output in job:
+                yield output
+        return turn
+
+    raise ValueError(f"未知场景: {args.scenario}")
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(round(q * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def run_load(turn_fn, users: int, turns: int):
+    """users 个线程各执行 turns 轮，返回 (每轮记录列表, 总墙钟秒数)"""
+    records, errors = [], []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(users)
+
+    def student(user_idx):
+        start_barrier.wait()
+        for turn_idx in range(turns):
+            start = time.perf_counter()
+            ttft = None
+            try:
+                for token in turn_fn(user_idx, turn_idx):
+                    if ttft is None and token:
+                        ttft = time.perf_counter() - start
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+                continue
+            latency = time.perf_counter() - start
+            with lock:
+                records.append({"latency": latency, "ttft": ttft if ttft is not None else latency})
+
+    threads = [threading.Thread(target=student, args=(i,)) for i in range(users)]
+    wall_start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return records, errors, time.perf_counter() - wall_start
+
+
+def summarize(records, errors, wall):
+    latencies = [r["latency"] * 1000 for r in records]
+    ttfts = [r["ttft"] * 1000 for r in records]
+    return {
+        "turns": len(records),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "wall_s": round(wall, 3),
+        "throughput_turns_per_s": round(len(records) / wall, 3) if wall else 0.0,
+        "latency_ms": {q: round(percentile(latencies, v), 1) for q, v in (("p50", .5), ("p95", .95), ("p99", .99))},
+        "ttft_ms": {q: round(percentile(ttfts, v), 1) for q, v in (("p50", .5), ("p95", .95), ("p99", .99))},
+        # Linux 下 ru_maxrss 单位为 KB
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def save_result(args, summary, extra):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    name = f"{stamp}_{args.scenario}" + (f"_{args.mode}" if args.scenario == "router" else "") + ".json"
+    path = os.path.join(RESULTS_DIR, name)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"args": vars(args), "summary": summary, **extra}, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def compare(paths):
+    """并排对比多次压测结果"""
+    rows = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        s = data["summary"]
+        rows.append((os.path.basename(path), s["throughput_turns_per_s"], s["latency_ms"]["p50"],
+                     s["latency_ms"]["p95"], s["latency_ms"]["p99"], s["ttft_ms"]["p50"], s["max_rss_mb"], s["errors"]))
+    print(f"{'结果文件':<40}{'吞吐/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'TTFT50':>9}{'RSS MB':>9}{'错误':>6}")
+    for row in rows:
+        print(f"{row[0]:<40}{row[1]:>9}{row[2]:>9}{row[3]:>9}{row[4]:>9}{row[5]:>9}{row[6]:>9}{row[7]:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="课程助手离线压测")
+    parser.add_argument("--scenario", choices=["router", "rag", "upload", "gradio"], default="router")
+    parser.add_argument("--mode", choices=["normal", "rag", "search", "auto"], default="rag", help="router 场景的意图")
+    parser.add_argument("--users", type=int, default=10, help="并发学生数")
+    parser.add_argument("--turns", type=int, default=5, help="每个学生的提问轮数")
+    parser.add_argument("--ttft-ms", type=float, default=200, help="假模型首 token 延迟")
+    parser.add_argument("--tps", type=float, default=50, help="假模型输出速率 token/秒")
+    parser.add_argument("--answer-tokens", type=int, default=120)
+    parser.add_argument("--embed-latency-ms", type=float, default=20, help="假 embedding 每次调用的延迟")
+    parser.add_argument("--upload-repeat", type=int, default=1, help="upload 场景文件内容重复次数")
+    parser.add_argument("--gradio-port", type=int, default=17860)
+    parser.add_argument("--compare", nargs="+", help="对比已保存的结果文件")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare)
+        return
+
+    os.chdir(REPO_DIR)  # 应用内的相对路径以仓库根目录为基准
+    workdir = tempfile.mkdtemp(prefix="course_bench_")
+    server, rag = setup_offline_env(args, workdir)
+    questions = load_questions()
+    turn_fn = make_turn_fn(args, rag, workdir, questions)
+
+    records, errors, wall = run_load(turn_fn, args.users, args.turns)
+    summary = summarize(records, errors, wall)
+
+    from tracing import metrics
+    path = save_result(args, summary, {"stages": metrics.snapshot(), "fake_llm_requests": server.requests})
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    print(f"结果已保存: {path}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+联网搜索模式用的桩工具：名称与真实工具一致，返回固定内容并模拟网络延迟，不访问外网。
+"""
+import time
+
+from langchain.tools import tool
+
+NETWORK_LATENCY_S = 0.05
+
+
+@tool
+def tavily_search(query: str) -> str:
+    """搜索最新新闻与实时信息（桩实现）"""
+    time.sleep(NETWORK_LATENCY_S)
+    return f"[桩搜索] 关于“{query}”的结果：课程将于下周开放新的实战项目模块。来源：https://example.com/news/1"
+
+
+@tool
+def web_scraping(url: str, extract_text: bool = True) -> str:
+    """抓取指定网页的内容（桩实现）"""
+    time.sleep(NETWORK_LATENCY_S)
+    return f"[桩网页] {url} 的正文：这是一段用于离线基准测试的网页内容。"
+
+
+@tool
+def datetime_operations(operation: str, date_string: str = "", format_string: str = "%Y-%m-%d %H:%M:%S",
+                        days_offset: int = 0) -> str:
+    """执行日期时间相关操作（桩实现）"""
+    return "2025-01-01 00:00:00"
+
+
+@tool
+def get_realtime_weather(city: str) -> str:
+    """查询指定城市的实时天气（桩实现）"""
+    time.sleep(NETWORK_LATENCY_S)
+    return f"{city}: ☀️ +20°C"
+
+
+def get_stub_tools():
+    from web_cache import with_web_cache
+    return with_web_cache([tavily_search, web_scraping, datetime_operations, get_realtime_weather])
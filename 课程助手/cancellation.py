@@ -0,0 +1,262 @@
+"""
+对话轮次的协作式取消。
+学生关闭页面、发送新消息（同一会话"最新一轮优先"）或删除会话时，取消令牌被置位；
+cancellable 在后台线程里推进流式输出，调用方同时等待下一个 token 和取消信号，上游卡住时也能立即结束；
+本轮发出的模型 HTTP 响应登记在令牌上（共享 httpx 客户端的 response 钩子），取消时关闭连接，
+阻塞在读取上的后台线程随即出错退出，生成器链被关闭，模型停止生成，调度槽位释放。
+ReAct 循环不再进入下一步，文件上传在下一个阶段开始前停止。
+取消次数按原因记录到指标 turns_cancelled，节省的剩余工作（已中断的流式输出个数）记录到 cancelled_streams。
+"""
+import contextvars
+import logging
+from contextlib import contextmanager
+import queue
+import socket
+import threading
+import time
+
+from tracing import begin_trace, metrics
+
+logger = logging.getLogger(__name__)
+# 当前线程正在为哪一轮推进流式输出（在 cancellable 的后台线程里设置）
+_current = contextvars.ContextVar("cancel_token", default=None)
+_DONE = object()
+
+
+class TurnCancelled(Exception):
+    """当前轮次已被取消"""
+
+
+class CancelToken:
+    def __init__(self, session_id: str = None, record: bool = True):
+        """:param record: 取消时是否计入 turns_cancelled（网关内部的单次请求令牌不计入）"""
+        self.session_id = session_id
+        self.record = record
+        self.client = None
+        self.reason = None
+        self.cancelled_at = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self.cancelled_at = time.perf_counter()
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        if self.record:
+            metrics.inc("turns_cancelled", reason=reason)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug("取消回调失败: %s", e)
+
+    def on_cancel(self, callback):
+        """取消时调用 callback（已取消则立即调用）"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise TurnCancelled(self.reason)
+
+
+def current_token():
+    """当前线程正在推进的轮次的取消令牌（不在 cancellable 中时为 None）"""
+    return _current.get()
+
+
+@contextmanager
+def bound(token: CancelToken):
+    """在此上下文中发出的模型 HTTP 响应登记到 token 上，token 取消时关闭"""
+    reset = _current.set(token)
+    try:
+        yield token
+    finally:
+        _current.reset(reset)
+
+
+def _close(stream):
+    close = getattr(stream, "close", None)
+    if close is not None:
+        close()
+
+
+def _check_each(stream, token: CancelToken, stage: str):
+    try:
+        for item in stream:
+            if token.cancelled:
+                metrics.inc("cancelled_streams", stage=stage)
+                break
+            yield item
+    finally:
+        _close(stream)
+
+
+def cancellable(stream, token: CancelToken, stage: str = "stream"):
+    """
+    包装生成器：底层生成器在后台线程中推进（继承当前的 contextvars），调用方同时等待下一项和取消信号，
+    取消后立即返回；后台线程在下一项到达（或连接被关闭）时停止并关闭底层生成器（GeneratorExit 沿调用链向下传播）。
+    已经在本轮的后台线程里时（嵌套调用）只在每项之间检查令牌。token 为 None 时原样透传。
+    """
+    if token is None:
+        yield from stream
+        return
+    if _current.get() is token:
+        yield from _check_each(stream, token, stage)
+        return
+    items = queue.Queue()
+    stopped = threading.Event()
+
+    def pump():
+        _current.set(token)
+        begin_trace()  # 一轮对话是一条链路：这一轮的 span 一起采样或一起跳过
+        error = None
+        try:
+            for item in stream:
+                if token.cancelled or stopped.is_set():
+                    break
+                items.put((item, None))
+        except Exception as e:
+            # 取消导致的连接错误不再上抛
+            error = None if token.cancelled else e
+        finally:
+            try:
+                _close(stream)
+            except Exception as e:
+                logger.debug("关闭被取消的流失败: %s", e)
+            items.put((_DONE, error))
+
+    token.on_cancel(lambda: items.put((_DONE, None)))
+    threading.Thread(target=contextvars.copy_context().run, args=(pump,), name=f"turn-{stage}", daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if token.cancelled:
+                metrics.inc("cancelled_streams", stage=stage)
+                return
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def abort_on_cancel(response):
+    """
+    httpx 的 response 钩子：把本轮发出的响应登记到取消令牌上。
+    取消时先 shutdown 套接字，让阻塞在读取上的线程立即出错返回（只 close 不会唤醒另一个线程里的 recv），
+    响应由读取它的线程在生成器关闭时正常关闭。
+    """
+    token = _current.get()
+    if token is None:
+        return
+
+    def abort():
+        if response.is_closed:
+            # 已经读完的响应：连接可能已回到连接池被其他请求使用，不能再关
+            return
+        stream = response.extensions.get("network_stream")
+        sock = stream.get_extra_info("socket") if stream is not None else None
+        if sock is None:
+            response.close()
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    token.on_cancel(abort)
+
+
+class TurnRegistry:
+    """
+    记录每个会话正在进行的轮次，同一会话开始新一轮时取消上一轮（最新一轮优先）。
+    client 为浏览器会话标识（Gradio 的 session_hash），页面关闭时取消它名下的所有轮次。
+    """
+    def __init__(self):
+        self._turns = {}    # session_id -> CancelToken
+        self._clients = {}  # client -> {session_id}
+        self._lock = threading.Lock()
+
+    def start(self, session_id: str, client: str = None) -> CancelToken:
+        token = CancelToken(session_id)
+        token.client = client
+        with self._lock:
+            previous = self._turns.get(session_id)
+            self._turns[session_id] = token
+            if client is not None:
+                self._clients.setdefault(client, set()).add(session_id)
+        if previous is not None:
+            previous.cancel("superseded")
+        return token
+
+    def finish(self, session_id: str, token: CancelToken):
+        """本轮结束：移除登记；该会话没有新的轮次时，也从浏览器会话的记录中移除"""
+        with self._lock:
+            if self._turns.get(session_id) is token:
+                del self._turns[session_id]
+            sessions = self._clients.get(token.client)
+            if sessions is not None and session_id not in self._turns:
+                sessions.discard(session_id)
+                if not sessions:
+                    del self._clients[token.client]
+
+    def cancel_session(self, session_id: str, reason: str = "deleted"):
+        with self._lock:
+            token = self._turns.pop(session_id, None)
+        if token is not None:
+            token.cancel(reason)
+
+    def cancel_client(self, client: str, reason: str = "closed") -> set:
+        """取消浏览器会话名下所有进行中的轮次，返回这些会话ID"""
+        with self._lock:
+            sessions = self._clients.pop(client, set())
+        for session_id in sessions:
+            self.cancel_session(session_id, reason)
+        return sessions
+
+    def active(self) -> int:
+        with self._lock:
+            return len(self._turns)
+
+    def memory_report(self) -> dict:
+        from memory_accounting import approx_size
+        with self._lock:
+            clients = {c: set(s) for c, s in self._clients.items()}
+            active = len(self._turns)
+        return {"bytes": approx_size(clients), "items": active, "clients": len(clients),
+                "client_sessions": sum(len(s) for s in clients.values())}
+
+    def evict(self, pressure: float) -> dict:
+        """清理没有进行中轮次的浏览器会话记录（页面关闭事件没有送达时，这些记录不会被 cancel_client 移除）"""
+        with self._lock:
+            idle = [c for c, sessions in self._clients.items() if not any(s in self._turns for s in sessions)]
+            for client in idle:
+                del self._clients[client]
+        return {"clients": len(idle)}
+
+
+# 进程内共享的轮次登记表
+turns = TurnRegistry()
+
+
+def _register_memory():
+    from memory_accounting import memory
+    memory.register("turns", turns.memory_report, evict=turns.evict)
+
+
+_register_memory()
@@ -0,0 +1,46 @@
+"""
+预编译的 Prompt / Chain 注册表。
+Prompt、RAG 检索链、ReAct Agent 等 Runnable 按 key（如 (模式, 来源)）只构建一次并复用，
+每次请求不同的参数（user_id 过滤条件、投机检索结果等）通过 config["configurable"] 传入，而不是闭包捕获。
+"""
+import threading
+import time
+
+
+class ChainRegistry:
+    """线程安全的 Runnable 缓存：get(key, builder) 首次调用 builder 构建，之后直接返回"""
+    def __init__(self):
+        self._chains = {}
+        # 可重入锁：构建某个链时可能需要先取出另一个链（如 Agent 依赖执行器）
+        self._lock = threading.RLock()
+        # key -> 构建耗时(毫秒)，调试用
+        self.build_ms = {}
+
+    def get(self, key, builder):
+        chain = self._chains.get(key)
+        if chain is not None:
+            return chain
+        with self._lock:
+            if key not in self._chains:
+                start = time.perf_counter()
+                self._chains[key] = builder()
+                self.build_ms[key] = (time.perf_counter() - start) * 1000
+            return self._chains[key]
+
+    def clear(self):
+        with self._lock:
+            self._chains.clear()
+            self.build_ms.clear()
+
+    def __contains__(self, key):
+        return key in self._chains
+
+    def __len__(self):
+        return len(self._chains)
+
+
+def get_configurable(config, name: str, default=None):
+    """从 RunnableConfig 中读取 configurable 参数"""
+    if not config:
+        return default
+    return config.get("configurable", {}).get(name, default)
@@ -0,0 +1,210 @@
+"""
+按文件类型和结构选择的分块器，替代所有文档共用的 RecursiveCharacterTextSplitter(1000, 200)。
+    QAPairChunker          FAQ 文件（问题：/答案：），一问一答为一块，不会在问答中间切断
+    HeadingChunker         带标题的文档（Markdown #、第X章、一、1.1 等），按章节切分，块前带标题路径
+    TableChunker           CSV（CSVLoader 每行一个文档），多行合并为一块
+    ChineseSentenceChunker 中文正文，按 。！？； 等句子边界打包，重叠整句
+其他文本回退到原来的 RecursiveCharacterTextSplitter。
+各分块器的大小由环境变量配置（见下方常量）。
+"""
+import os
+import re
+
+QA_MAX_CHARS = int(os.getenv("CHUNK_QA_MAX_CHARS", "800"))
+SECTION_CHARS = int(os.getenv("CHUNK_SECTION_CHARS", "1200"))
+TABLE_ROWS = int(os.getenv("CHUNK_TABLE_ROWS", "20"))
+SENTENCE_CHARS = int(os.getenv("CHUNK_SENTENCE_CHARS", "500"))
+SENTENCE_OVERLAP = int(os.getenv("CHUNK_SENTENCE_OVERLAP", "1"))  # 重叠的句子数
+
+_QA_BLOCK = re.compile(r"问题[：:]\s*(.*?)\s*答案[：:]\s*(.*?)(?=\n\s*问题[：:]|\Z)", re.S)
+# 标题独占一行、长度有限且不以句号等结尾；数字编号至少两级（1.1、2.3.1），
+# 单级的 "1 xxx" 与列表项、"30 分钟" 之类的数量无法区分，不当作标题
+_HEADING = re.compile(
+    r"^[ \t]*(?:#{1,6}[ \t]+\S.{0,60}"
+    r"|第[一二三四五六七八九十百0-9]{1,4}[章节部分篇][^\n。！？；]{0,40}"
+    r"|[一二三四五六七八九十]{1,3}、[^\n。！？；，,]{1,30}"
+    r"|\d{1,2}(?:\.\d{1,2}){1,3}[ \t]+[^\s\d][^\n。！？；，,;!?]{0,30})[ \t]*$", re.M)
+# 句子结束处：句末标点（连同其后的空白）、换行，或英文句号后的空白
+_SENTENCE_END = re.compile(r"[。！？；!?;\n]+[ \t\r\n]*|\.[ \t\r\n]+")
+_CJK = re.compile(r"[㐀-鿿]")
+
+
+def _doc(text: str, metadata: dict, **extra):
+    from langchain_core.documents import Document
+    return Document(page_content=text, metadata={**metadata, **extra})
+
+
+def parse_qa_pairs(text: str):
+    """从 FAQ 文本中解析出 [(问题, 答案)]"""
+    return [(q.strip(), a.strip()) for q, a in _QA_BLOCK.findall(text)]
+
+
+def sentence_pieces(text: str):
+    """按句子切开，每句带上其后的换行和空格，"".join(结果) == text"""
+    pieces, start = [], 0
+    for m in _SENTENCE_END.finditer(text):
+        pieces.append(text[start:m.end()])
+        start = m.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+
+def split_sentences(text: str):
+    return [s for s in (p.strip() for p in sentence_pieces(text)) if s]
+
+
+class ChineseSentenceChunker:
+    """按句子边界打包到 chunk_chars 以内，相邻块重叠 overlap 个整句；句子之间的换行和空格保持原样"""
+    name = "sentence"
+
+    def __init__(self, chunk_chars: int = SENTENCE_CHARS, overlap: int = SENTENCE_OVERLAP):
+        self.chunk_chars = chunk_chars
+        self.overlap = overlap
+
+    def split_text(self, text: str):
+        chunks, current = [], []
+        for sentence in sentence_pieces(text):
+            # 超长的单句直接按长度切开
+            while len(sentence) > self.chunk_chars:
+                chunks.append(sentence[:self.chunk_chars])
+                sentence = sentence[self.chunk_chars:]
+            if current and len("".join(current)) + len(sentence) > self.chunk_chars:
+                chunks.append("".join(current))
+                current = current[-self.overlap:] if self.overlap else []
+                if len("".join(current)) + len(sentence) > self.chunk_chars:
+                    current = []
+            current.append(sentence)
+        if current:
+            chunks.append("".join(current))
+        # 块首尾的空白没有意义；只剩空白的块丢弃
+        return [c for c in (chunk.strip() for chunk in chunks) if c]
+
+    def split_documents(self, documents):
+        return [_doc(chunk, d.metadata, chunk_type=self.name) for d in documents for chunk in self.split_text(d.page_content)]
+
+
+class QAPairChunker:
+    """一问一答为一块；答案过长时按句子切开，每块都带上问题"""
+    name = "qa"
+
+    def __init__(self, max_chars: int = QA_MAX_CHARS):
+        self.max_chars = max_chars
+
+    @staticmethod
+    def detect(text: str) -> bool:
+        return len(_QA_BLOCK.findall(text)) >= 2
+
+    def split_documents(self, documents):
+        chunks = []
+        for d in documents:
+            for question, answer in parse_qa_pairs(d.page_content):
+                text = f"问题：{question}\n答案：{answer}"
+                if len(text) <= self.max_chars:
+                    chunks.append(_doc(text, d.metadata, chunk_type=self.name, question=question))
+                    continue
+                sentences = ChineseSentenceChunker(max(self.max_chars - len(question) - 10, 100), overlap=0)
+                for part in sentences.split_text(answer):
+                    chunks.append(_doc(f"问题：{question}\n答案：{part}", d.metadata, chunk_type=self.name, question=question))
+        return chunks
+
+
+class HeadingChunker:
+    """按标题切分章节，块前加上标题；章节过长时按句子继续切分"""
+    name = "section"
+
+    def __init__(self, section_chars: int = SECTION_CHARS):
+        self.section_chars = section_chars
+
+    @staticmethod
+    def detect(text: str) -> bool:
+        return len(_HEADING.findall(text)) >= 2
+
+    def split_documents(self, documents):
+        chunks = []
+        for d in documents:
+            text = d.page_content
+            starts = [m.start() for m in _HEADING.finditer(text)]
+            bounds = ([0] if not starts or starts[0] > 0 else []) + starts + [len(text)]
+            for start, end in zip(bounds, bounds[1:]):
+                section = text[start:end].strip()
+                if not section:
+                    continue
+                heading = section.split("\n", 1)[0].strip() if start in starts else ""
+                if len(section) <= self.section_chars:
+                    chunks.append(_doc(section, d.metadata, chunk_type=self.name, heading=heading))
+                    continue
+                body = section[len(heading):] if heading else section
+                sentences = ChineseSentenceChunker(max(self.section_chars - len(heading) - 1, 100))
+                for part in sentences.split_text(body):
+                    chunks.append(_doc(f"{heading}\n{part}" if heading else part, d.metadata,
+                                       chunk_type=self.name, heading=heading))
+        return chunks
+
+
+class TableChunker:
+    """CSV 行合并：同一文件连续 rows 行为一块"""
+    name = "table"
+
+    def __init__(self, rows: int = TABLE_ROWS):
+        self.rows = rows
+
+    def split_documents(self, documents):
+        chunks, group = [], []
+
+        def flush():
+            if group:
+                chunks.append(_doc("\n\n".join(g.page_content for g in group), group[0].metadata,
+                                   chunk_type=self.name, rows=len(group)))
+                group.clear()
+
+        for d in documents:
+            if group and (len(group) >= self.rows or group[0].metadata.get("source") != d.metadata.get("source")):
+                flush()
+            group.append(d)
+        flush()
+        return chunks
+
+
+class StructureAwareSplitter:
+    """按文档来源和结构为每个文档选择分块器，接口与 LangChain 的 TextSplitter.split_documents 相同"""
+    def __init__(self, fallback=None):
+        self.qa = QAPairChunker()
+        self.section = HeadingChunker()
+        self.table = TableChunker()
+        self.sentence = ChineseSentenceChunker()
+        self._fallback = fallback
+
+    @property
+    def fallback(self):
+        if self._fallback is None:
+            from langchain.text_splitter import RecursiveCharacterTextSplitter
+            self._fallback = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+        return self._fallback
+
+    def choose(self, doc):
+        source = str(doc.metadata.get("source", "")).lower()
+        text = doc.page_content
+        if source.endswith(".csv"):
+            return self.table
+        if QAPairChunker.detect(text):
+            return self.qa
+        if HeadingChunker.detect(text):
+            return self.section
+        if text and len(_CJK.findall(text)) / len(text) > 0.3:
+            return self.sentence
+        return self.fallback
+
+    def split_documents(self, documents):
+        # 保持文档顺序；连续使用同一分块器的文档一起处理（CSV 的多行需要合并）
+        chunks, run, run_chunker = [], [], None
+        for d in documents:
+            chunker = self.choose(d)
+            if run and chunker is not run_chunker:
+                chunks.extend(run_chunker.split_documents(run))
+                run = []
+            run_chunker = chunker
+            run.append(d)
+        if run:
+            chunks.extend(run_chunker.split_documents(run))
+        return chunks
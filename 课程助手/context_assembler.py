@@ -0,0 +1,162 @@
+"""
+按 token 预算组装 RAG 上下文（放进 create_stuff_documents_chain 之前）。
+    1. 合并同一文件中相邻/重叠的文本块（chunk_overlap 造成的重复部分只保留一次）
+    2. 用 MinHash 估计相似度，去掉近似重复的块（课程库与用户库的同一段内容等）
+    3. MMR：在相关性（检索排名）与多样性之间取舍排序
+    4. 按 CONTEXT_TOKEN_BUDGET 截断
+每轮的统计（输入/输出块数与 token 数、节省的 token 数）带上会话ID按 INFO 写日志，累计值记录到指标 context_tokens_saved。
+"""
+import logging
+import os
+import re
+import zlib
+
+import numpy as np
+
+from tracing import metrics
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+NUM_PERM = 64
+SHINGLE = 3
+MIN_OVERLAP = 20  # 至少重叠这么多字符才认为两个块相邻
+
+_CJK = re.compile(r"[㐀-鿿豈-﫿]")
+# MinHash 的线性置换 (a * x + b) mod p，固定种子保证各进程结果一致
+_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(2024)
+_PERM_A = _rng.randint(1, _PRIME, size=(NUM_PERM, 1), dtype=np.int64)
+_PERM_B = _rng.randint(0, _PRIME, size=(NUM_PERM, 1), dtype=np.int64)
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估计 token 数：中文约 1 字 1 token，其他字符约 4 个 1 token"""
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def minhash(text: str):
+    """字符 3-gram 的 MinHash 签名（每个 shingle 只哈希一次，再用 NUM_PERM 个线性置换向量化计算）"""
+    shingles = {text[i:i + SHINGLE] for i in range(max(len(text) - SHINGLE + 1, 1))}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) & _PRIME for s in shingles), dtype=np.int64,
+                         count=len(shingles))
+    return ((_PERM_A * hashes[None, :] + _PERM_B) % _PRIME).min(axis=1)
+
+
+def similarity(a, b) -> float:
+    """两个 MinHash 签名的 Jaccard 相似度估计"""
+    return float(np.mean(a == b))
+
+
+def _with_text(doc, text: str):
+    from langchain_core.documents import Document
+    return Document(page_content=text, metadata=dict(doc.metadata))
+
+
+# 混合检索把 source 改写成的库名，不能区分文件（原来的文件路径保存在 source_file）
+_STORE_LABELS = ("course_knowledge_base", "user_uploaded")
+
+
+def _source_key(doc):
+    """块所属的文件：上传ID、上传文件名或原始文件路径；无法确定时返回 None（不与其他块合并）"""
+    meta = doc.metadata
+    key = meta.get("upload_id") or meta.get("original_file") or meta.get("source_file") or meta.get("source")
+    return None if key in _STORE_LABELS else key
+
+
+def _overlap(a: str, b: str) -> int:
+    """a 的结尾与 b 的开头重叠的最大长度"""
+    for size in range(min(len(a), len(b)), MIN_OVERLAP - 1, -1):
+        if a.endswith(b[:size]):
+            return size
+    return 0
+
+
+def merge_adjacent(docs):
+    """合并同一文件中首尾重叠的块，合并后的块保留排名靠前那一块的位置"""
+    merged = []
+    for doc in docs:
+        key = _source_key(doc)
+        for i, kept in enumerate(merged):
+            if key is None or _source_key(kept) != key:
+                continue
+            a, b = kept.page_content, doc.page_content
+            if b in a:
+                break
+            if a in b:
+                merged[i] = _with_text(doc, b)
+                break
+            tail, head = _overlap(a, b), _overlap(b, a)
+            if tail:
+                merged[i] = _with_text(kept, a + b[tail:])
+                break
+            if head:
+                merged[i] = _with_text(kept, b + a[head:])
+                break
+        else:
+            merged.append(doc)
+    return merged
+
+
+def assemble_context(docs, budget: int = None, dedup_threshold: float = DEDUP_THRESHOLD,
+                     mmr_lambda: float = MMR_LAMBDA, session_id: str = None):
+    """
+    :param docs: 检索结果（按相关性排序）
+    :param budget: token 预算，默认 CONTEXT_TOKEN_BUDGET
+    :param session_id: 会话ID，提供时本轮统计按 INFO 写日志（离线评估时不提供，只写 DEBUG）
+    :return: (组装后的文档列表, 统计信息)
+    """
+    budget = budget or CONTEXT_TOKEN_BUDGET
+    before = sum(estimate_tokens(d.page_content) for d in docs)
+    merged = merge_adjacent(docs)
+
+    # 去重：与排名更靠前的块近似重复时丢弃
+    signatures, unique = [], []
+    for doc in merged:
+        sig = minhash(doc.page_content)
+        if any(similarity(sig, s) >= dedup_threshold for s in signatures):
+            continue
+        signatures.append(sig)
+        unique.append(doc)
+
+    # MMR：相关性用检索排名近似（第 1 名为 1.0），多样性用与已选块的最大相似度
+    n = len(unique)
+    relevance = [1.0 - i / max(n, 1) for i in range(n)]
+    remaining, order = list(range(n)), []
+    while remaining:
+        best = max(remaining, key=lambda i: mmr_lambda * relevance[i] - (1 - mmr_lambda) * max(
+            (similarity(signatures[i], signatures[j]) for j in order), default=0.0))
+        order.append(best)
+        remaining.remove(best)
+
+    # 按预算装入；最后一块放不下时截断
+    selected, used = [], 0
+    for i in order:
+        doc = unique[i]
+        tokens = estimate_tokens(doc.page_content)
+        if used + tokens <= budget:
+            selected.append(doc)
+            used += tokens
+            continue
+        room = budget - used
+        if room >= 100:
+            text = doc.page_content
+            while text and estimate_tokens(text) > room:
+                text = text[:int(len(text) * room / estimate_tokens(text)) - 1]
+            selected.append(_with_text(doc, text))
+            used += estimate_tokens(text)
+        break
+
+    stats = {"chunks_in": len(docs), "chunks_out": len(selected),
+             "tokens_in": before, "tokens_out": used, "tokens_saved": before - used}
+    metrics.inc("context_tokens_saved", stats["tokens_saved"])
+    metrics.inc("context_tokens", used)
+    if session_id is not None:
+        logger.info("上下文组装 会话=%s: %d 块 %d token -> %d 块 %d token，节省 %d token", session_id,
+                    stats["chunks_in"], before, stats["chunks_out"], used, stats["tokens_saved"])
+    else:
+        logger.debug("上下文组装: %s", stats)
+    return selected, stats
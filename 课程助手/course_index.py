@@ -0,0 +1,271 @@
+"""
+课程知识库的紧凑向量索引（只读为主的小库）。
+把课程库的 embedding 导出成一个连续的 NumPy 矩阵（float32，或按行量化的 int8），
+以 mmap 方式打开，多个进程共享操作系统页缓存中的同一份数据；top-k 用一次矩阵乘法完成。
+
+对外提供与 RAGProcess 使用到的 Chroma 接口一致的方法：
+    similarity_search / similarity_search_with_score / similarity_search_by_vector / add_documents / persist
+另外提供批量接口 similarity_search_by_vectors，一次矩阵乘法处理多个查询。
+
+目录结构：
+    vectors.npy   (N, dim) float32 或 int8，行已 L2 归一化
+    scales.npy    int8 时每行的反量化系数
+    docs.jsonl    每行一个文档 {"page_content", "metadata"}
+    meta.json     维度、数据类型、文档数，以及导出时 Chroma 课程库的版本标记（source）
+写文件用带进程号和随机后缀的临时文件再原子替换，多个进程同时导出互不覆盖临时文件；
+其他进程改写索引后，检索时发现 meta.json 变化会自动重新加载。
+int8 索引按块反量化到预先分配的 float32 缓冲区再做矩阵乘法，不会每次查询把整个矩阵转换成 float64。
+"""
+import hashlib
+import json
+import os
+import threading
+import uuid
+
+import numpy as np
+
+INDEX_DTYPES = ("float32", "int8")
+SCORE_BLOCK_ROWS = 2048  # int8 索引每次反量化的行数（缓冲区 2048 × 维度 × 4 字节，每个线程一份）
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _quantize(matrix: np.ndarray):
+    """按行对称量化到 int8，返回 (int8 矩阵, 每行系数)"""
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.clip(np.round(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def _matches(metadata: dict, filter: dict) -> bool:
+    return all(metadata.get(key) == value for key, value in filter.items())
+
+
+def source_stamp(chroma_store) -> str:
+    """Chroma 库内容的版本标记（文档数 + 全部 ID 的摘要），重新入库后会变化"""
+    ids = sorted(chroma_store._collection.get(include=[])["ids"])
+    return f"{len(ids)}:{hashlib.md5(chr(0).join(ids).encode('utf-8')).hexdigest()}"
+
+
+class CompactVectorIndex:
+    def __init__(self, index_dir: str, embedding_function, dtype: str = "float32"):
+        """
+        :param index_dir: 索引目录
+        :param embedding_function: 与建库时相同的 embedding 模型
+        :param dtype: 新建索引时使用的存储类型，'float32' 或 'int8'；已有索引以 meta.json 为准
+        """
+        if dtype not in INDEX_DTYPES:
+            raise ValueError(f"不支持的索引类型: {dtype}")
+        self.index_dir = index_dir
+        self.embedding_function = embedding_function
+        self.dtype = dtype
+        self.source_stamp = None
+        self._lock = threading.Lock()
+        self._buffers = threading.local()
+        # (数据类型, 矩阵, 反量化系数, 文档列表)：整体替换，检索时取一次快照，不会读到新旧混合的数组
+        self._state = (dtype, None, None, [])
+        self._meta_mtime = None
+        # add_documents 之后尚未 persist 的内容
+        self._pending_vectors = []
+        self._pending_docs = []
+        if os.path.exists(os.path.join(index_dir, "meta.json")):
+            self._load()
+
+    @property
+    def _docs(self):
+        return self._state[3]
+
+    # ---------- 读写文件 ----------
+    def _load(self):
+        meta_path = os.path.join(self.index_dir, "meta.json")
+        mtime = os.stat(meta_path).st_mtime_ns
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        dtype = meta["dtype"]
+        # mmap 只读打开：多个进程映射同一个文件时共享物理内存
+        vectors = np.load(os.path.join(self.index_dir, "vectors.npy"), mmap_mode="r")
+        scales = np.load(os.path.join(self.index_dir, "scales.npy")) if dtype == "int8" else None
+        with open(os.path.join(self.index_dir, "docs.jsonl"), encoding="utf-8") as f:
+            docs = [json.loads(line) for line in f]
+        self.dtype, self.source_stamp = dtype, meta.get("source")
+        self._state = (dtype, vectors, scales, docs)
+        self._meta_mtime = mtime
+
+    def reload(self):
+        """重新读取磁盘上的索引（其他进程或 export_from_chroma 改写之后）"""
+        with self._lock:
+            if os.path.exists(os.path.join(self.index_dir, "meta.json")):
+                self._load()
+
+    def _refresh(self):
+        """meta.json 被其他进程替换过时重新加载（一次 stat，开销可以忽略）"""
+        try:
+            mtime = os.stat(os.path.join(self.index_dir, "meta.json")).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._meta_mtime:
+            with self._lock:
+                if mtime != self._meta_mtime:
+                    self._load()
+
+    def persist(self):
+        """把新增的文档合并进矩阵并写回磁盘（写临时文件后替换，正在读取的进程不受影响）"""
+        with self._lock:
+            if not self._pending_vectors:
+                return
+            new = _normalize(np.asarray(self._pending_vectors, dtype=np.float32))
+            _, old_vectors, _, old_docs = self._state
+            old = self._dequantized() if old_vectors is not None else np.zeros((0, new.shape[1]), np.float32)
+            matrix = np.vstack([old, new])
+            docs = old_docs + self._pending_docs
+            os.makedirs(self.index_dir, exist_ok=True)
+            if self.dtype == "int8":
+                vectors, scales = _quantize(matrix)
+                self._save_npy("scales.npy", scales)
+            else:
+                vectors = matrix.astype(np.float32)
+            self._save_npy("vectors.npy", vectors)
+            tmp = self._tmp_path("docs.jsonl")
+            with open(tmp, "w", encoding="utf-8") as f:
+                for doc in docs:
+                    f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+            os.replace(tmp, os.path.join(self.index_dir, "docs.jsonl"))
+            tmp = self._tmp_path("meta.json")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"dtype": self.dtype, "dim": int(matrix.shape[1]), "count": len(docs),
+                           "source": self.source_stamp}, f)
+            os.replace(tmp, os.path.join(self.index_dir, "meta.json"))
+            self._pending_vectors, self._pending_docs = [], []
+            self._load()
+
+    def _tmp_path(self, name: str) -> str:
+        """本进程本次写入专用的临时文件名（保留扩展名，np.save 不会再追加 .npy）"""
+        base, ext = os.path.splitext(name)
+        return os.path.join(self.index_dir, f"{base}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp{ext}")
+
+    def _save_npy(self, name: str, array: np.ndarray):
+        tmp = self._tmp_path(name)
+        np.save(tmp, array)
+        os.replace(tmp, os.path.join(self.index_dir, name))
+
+    def _dequantized(self) -> np.ndarray:
+        dtype, vectors, scales, _ = self._state
+        if dtype == "int8":
+            return vectors.astype(np.float32) * scales[:, None]
+        return np.asarray(vectors, dtype=np.float32)
+
+    # ---------- 写入 ----------
+    def add_documents(self, documents):
+        """与 Chroma 相同：计算 embedding 后加入索引，调用 persist() 后生效"""
+        texts = [doc.page_content for doc in documents]
+        return self.add_embeddings(documents, self.embedding_function.embed_documents(texts))
+
+    def add_embeddings(self, documents, vectors):
+        """加入已经算好 embedding 的文档（写入协调器在调用方线程里计算 embedding）"""
+        with self._lock:
+            start = len(self._state[3]) + len(self._pending_docs)
+            self._pending_vectors.extend(vectors)
+            self._pending_docs.extend({"page_content": doc.page_content, "metadata": dict(doc.metadata)}
+                                      for doc in documents)
+        return [str(start + i) for i in range(len(documents))]
+
+    def rollback(self):
+        """丢弃尚未 persist 的新增内容（分组提交失败后逐个重试前调用，避免重复加入）"""
+        with self._lock:
+            self._pending_vectors, self._pending_docs = [], []
+
+    # ---------- 检索 ----------
+    def __len__(self):
+        return len(self._state[3])
+
+    def _buffer(self, dim: int) -> np.ndarray:
+        """本线程的反量化缓冲区（SCORE_BLOCK_ROWS × dim，float32），首次使用时分配"""
+        buffer = getattr(self._buffers, "array", None)
+        if buffer is None or buffer.shape[1] != dim:
+            buffer = self._buffers.array = np.empty((SCORE_BLOCK_ROWS, dim), dtype=np.float32)
+        return buffer
+
+    def _scores(self, queries: np.ndarray, state) -> np.ndarray:
+        """queries: (Q, dim) 已归一化，返回 (Q, N) 余弦相似度"""
+        dtype, vectors, scales, _ = state
+        if dtype != "int8":
+            return queries @ vectors.T
+        # int8 直接参与矩阵乘法时 numpy 会把整个矩阵转换成 float64；按块转换成 float32 再走 BLAS
+        scores = np.empty((queries.shape[0], vectors.shape[0]), dtype=np.float32)
+        buffer = self._buffer(vectors.shape[1])
+        for start in range(0, vectors.shape[0], SCORE_BLOCK_ROWS):
+            block = vectors[start:start + SCORE_BLOCK_ROWS]
+            rows = buffer[:len(block)]
+            np.copyto(rows, block, casting="unsafe")
+            np.matmul(queries, rows.T, out=scores[:, start:start + len(block)])
+        scores *= scales[None, :]
+        return scores
+
+    def similarity_search_by_vectors(self, embeddings, k: int = 4, filter: dict = None):
+        """批量检索：一次矩阵乘法处理多个查询，返回每个查询的 [(Document, 距离)]，距离 = 1 - 余弦相似度"""
+        from langchain_core.documents import Document
+        self._refresh()
+        state = self._state
+        _, vectors, _, docs = state
+        if vectors is None or not len(docs):
+            return [[] for _ in embeddings]
+        queries = _normalize(np.asarray(embeddings, dtype=np.float32))
+        scores = self._scores(queries, state)
+        if filter:
+            mask = np.array([_matches(d["metadata"], filter) for d in docs])
+            scores[:, ~mask] = -np.inf
+        k = min(k, scores.shape[1])
+        # argpartition 先取出前 k 个（O(N)），再只对这 k 个排序
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in enumerate(top):
+            order = candidates[np.argsort(-scores[row, candidates])]
+            hits = []
+            for i in order:
+                if np.isneginf(scores[row, i]):
+                    continue
+                doc = docs[i]
+                hits.append((Document(page_content=doc["page_content"], metadata=dict(doc["metadata"])),
+                             float(1.0 - scores[row, i])))
+            results.append(hits)
+        return results
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, filter: dict = None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vectors([embedding], k, filter)[0]]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: dict = None, **kwargs):
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_by_vectors([embedding], k, filter or kwargs.get("where"))[0]
+
+    def similarity_search(self, query: str, k: int = 4, filter: dict = None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter, **kwargs)]
+
+    def memory_bytes(self) -> int:
+        """索引矩阵占用的字节数（mmap 部分由各进程共享）"""
+        _, vectors, scales, _ = self._state
+        if vectors is None:
+            return 0
+        return int(vectors.nbytes + (scales.nbytes if scales is not None else 0))
+
+
+def export_from_chroma(chroma_store, index_dir: str, embedding_function, dtype: str = "float32",
+                       stamp: str = None):
+    """
+    把 Chroma 课程库导出为紧凑索引（直接复用库中的 embedding，不重新计算），覆盖已有索引。
+    :param stamp: Chroma 库的版本标记（source_stamp），写进 meta.json，之后据此判断是否需要重新导出
+    """
+    data = chroma_store._collection.get(include=["embeddings", "documents", "metadatas"])
+    index = CompactVectorIndex(index_dir, embedding_function, dtype)
+    # 覆盖已有索引
+    index.dtype, index._state = dtype, (dtype, None, None, [])
+    index.source_stamp = stamp if stamp is not None else source_stamp(chroma_store)
+    index._pending_vectors = [list(v) for v in data["embeddings"]]
+    index._pending_docs = [{"page_content": text, "metadata": meta or {}}
+                           for text, meta in zip(data["documents"], data["metadatas"])]
+    index.persist()
+    return index
@@ -0,0 +1,248 @@
+"""
+上传 CSV 的结构化查询：CSV 不再逐行 embedding，而是导入按用户隔离的 SQLite 表（推断列类型），
+向量库里只存一条"表结构"文档用于判断问题是否与这张表有关。
+问到这张表时由模型生成 SQL，在只读、只允许访问该表的连接上执行（超过 CSV_QUERY_TIMEOUT 秒中止），再根据查询结果流式回答。
+入库成本只与列数有关，与行数无关；"平均分""有多少学生"这类聚合问题也能回答。
+"""
+import csv
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+CSV_DB_PATH = os.getenv("CSV_DB_PATH", "课程助手/user_tables.db")
+SAMPLE_ROWS = 1000      # 推断列类型时看的行数
+MAX_RESULT_ROWS = 50    # 返回给模型的最大行数
+INSERT_BATCH = 1000
+QUERY_TIMEOUT = float(os.getenv("CSV_QUERY_TIMEOUT", "2"))  # 模型生成的 SQL 最长执行秒数
+PROGRESS_STEPS = 10000  # 每执行这么多条虚拟机指令检查一次是否超时
+
+CSV_SQL_PROMPT = """
+你是 SQLite 专家。根据下面的表结构，为用户的问题写一条 SQLite 查询语句。
+只允许 SELECT，只能使用给出的表和列，列名和表名用双引号括起来。
+只输出 SQL 本身，不要解释，不要使用 ``` 代码块。
+{schema}
+"""
+
+CSV_ANSWER_PROMPT = """
+你是一个课程助手。用户对自己上传的表格提问，下面是执行的 SQL 和查询结果（JSON）。
+请根据查询结果简洁地回答问题，不要编造结果中没有的数据。
+SQL: {sql}
+结果: {rows}
+"""
+
+
+_SQL_FENCE = re.compile(r"```[ \t]*(?:sql|sqlite)?[ \t]*\n?(.*?)```", re.S | re.I)
+
+
+class QueryTooExpensive(Exception):
+    """模型生成的 SQL 执行超时"""
+
+
+def extract_sql(text: str) -> str:
+    """从模型输出中取出 SQL：有 ``` 代码块时取第一个代码块的内容，去掉末尾的分号"""
+    match = _SQL_FENCE.search(text)
+    sql = match.group(1) if match else text
+    return sql.strip().rstrip(";").strip()
+
+
+def _infer_type(values) -> str:
+    """根据样本值推断列类型：INTEGER / REAL / TEXT"""
+    kind = "INTEGER"
+    for value in values:
+        value = value.strip()
+        if not value:
+            continue
+        try:
+            int(value)
+            continue
+        except ValueError:
+            pass
+        try:
+            float(value)
+            kind = "REAL"
+        except ValueError:
+            return "TEXT"
+    return kind
+
+
+def _convert(value: str, kind: str):
+    value = value.strip()
+    if value == "":
+        return None
+    try:
+        if kind == "INTEGER":
+            return int(value)
+        if kind == "REAL":
+            return float(value)
+    except ValueError:
+        pass
+    return value
+
+
+def _column_names(header):
+    """表头清洗成合法且不重复的列名"""
+    names, seen = [], set()
+    for i, name in enumerate(header):
+        name = re.sub(r'["\s]+', "_", name.strip()) or f"col{i + 1}"
+        while name in seen:
+            name += "_"
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+class CSVTableStore:
+    def __init__(self, db_path: str = CSV_DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._conn().execute("""
+            CREATE TABLE IF NOT EXISTS csv_tables (
+                table_name TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                original_file TEXT NOT NULL,
+                columns TEXT NOT NULL,
+                row_count INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )""")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS idx_csv_tables_user ON csv_tables (user_id)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if os.path.dirname(self.db_path):
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def import_csv(self, file_path: str, user_id: str, original_file: str = None, cancel_token=None) -> dict:
+        """导入 CSV，返回表信息 {"table_name", "columns", "row_count", "original_file"}
+        cancel_token: 每批插入之后检查，取消时回滚整张表"""
+        original_file = original_file or os.path.basename(file_path)
+        with open(file_path, newline="", encoding="utf-8-sig") as f:
+            sample = f.read(64 * 1024)
+            f.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample)
+            except csv.Error:
+                dialect = csv.excel
+            reader = csv.reader(f, dialect)
+            header = next(reader, None)
+            if not header:
+                raise ValueError(f"CSV 文件为空: {original_file}")
+            names = _column_names(header)
+            head_rows = []
+            for row in reader:
+                head_rows.append(row)
+                if len(head_rows) >= SAMPLE_ROWS:
+                    break
+            types = [_infer_type([r[i] for r in head_rows if i < len(r)]) for i in range(len(names))]
+            digest = hashlib.md5(f"{user_id}:{original_file}:{time.time()}".encode("utf-8")).hexdigest()[:12]
+            table = f"csv_{digest}"
+            conn = self._conn()
+            columns_sql = ", ".join(f'"{n}" {t}' for n, t in zip(names, types))
+            conn.execute("BEGIN")
+            try:
+                conn.execute(f'CREATE TABLE "{table}" ({columns_sql})')
+                placeholders = ", ".join("?" * len(names))
+                insert = f'INSERT INTO "{table}" VALUES ({placeholders})'
+                count, batch = 0, []
+                for row in self._rows(head_rows, reader):
+                    row = (row + [""] * len(names))[:len(names)]
+                    batch.append([_convert(v, t) for v, t in zip(row, types)])
+                    if len(batch) >= INSERT_BATCH:
+                        conn.executemany(insert, batch)
+                        count += len(batch)
+                        batch = []
+                        if cancel_token is not None:
+                            cancel_token.raise_if_cancelled()
+                if batch:
+                    conn.executemany(insert, batch)
+                    count += len(batch)
+                columns = [{"name": n, "type": t} for n, t in zip(names, types)]
+                conn.execute("INSERT INTO csv_tables VALUES (?, ?, ?, ?, ?, ?)",
+                             (table, user_id, original_file, json.dumps(columns, ensure_ascii=False), count, time.time()))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return {"table_name": table, "columns": columns, "row_count": count, "original_file": original_file}
+
+    @staticmethod
+    def _rows(head_rows, reader):
+        yield from head_rows
+        yield from reader
+
+    def list_tables(self, user_id: str):
+        rows = self._conn().execute(
+            "SELECT table_name, original_file, columns, row_count FROM csv_tables WHERE user_id = ? ORDER BY created_at DESC",
+            (user_id,)).fetchall()
+        return [{"table_name": t, "original_file": f, "columns": json.loads(c), "row_count": n} for t, f, c, n in rows]
+
+    def get_table(self, table_name: str, user_id: str):
+        for table in self.list_tables(user_id):
+            if table["table_name"] == table_name:
+                return table
+        return None
+
+    def all_tables(self) -> dict:
+        """所有导入的表 {表名: 导入时间}"""
+        return dict(self._conn().execute("SELECT table_name, created_at FROM csv_tables").fetchall())
+
+    def drop_table(self, table_name: str):
+        """删除导入的表及其登记（表不存在时什么也不做）"""
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            conn.execute("DELETE FROM csv_tables WHERE table_name = ?", (table_name,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def schema_text(self, table: dict) -> str:
+        """表结构说明：用于建立路由用的 embedding，也作为生成 SQL 的上下文（附带几行示例）"""
+        sample = self._conn().execute(f'SELECT * FROM "{table["table_name"]}" LIMIT 3').fetchall()
+        columns = "，".join(f'{c["name"]}({c["type"]})' for c in table["columns"])
+        lines = [f'表 "{table["table_name"]}"：来自上传的文件 {table["original_file"]}，共 {table["row_count"]} 行。',
+                 f"列：{columns}"]
+        for row in sample:
+            lines.append("示例：" + json.dumps(dict(zip([c["name"] for c in table["columns"]], row)), ensure_ascii=False))
+        return "\n".join(lines)
+
+    def run_query(self, sql: str, table_name: str, limit: int = MAX_RESULT_ROWS, timeout: float = QUERY_TIMEOUT):
+        """
+        在只读连接上执行模型生成的 SQL：授权回调只允许 SELECT 和读取指定的表，其他操作一律拒绝；
+        执行超过 timeout 秒（多表自连接之类）时中止并抛出 QueryTooExpensive。
+        返回 (列名, 行列表)
+        """
+        sql = extract_sql(sql)
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=30)
+        deadline = time.monotonic() + timeout
+        # 返回非零值时 SQLite 中止当前语句（OperationalError: interrupted）
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_STEPS)
+
+        def authorizer(action, arg1, arg2, db_name, trigger):
+            if action in (sqlite3.SQLITE_SELECT, sqlite3.SQLITE_FUNCTION):
+                return sqlite3.SQLITE_OK
+            if action == sqlite3.SQLITE_READ and arg1 == table_name:
+                return sqlite3.SQLITE_OK
+            return sqlite3.SQLITE_DENY
+
+        conn.set_authorizer(authorizer)
+        try:
+            cursor = conn.execute(sql)
+            columns = [d[0] for d in cursor.description or []]
+            return columns, cursor.fetchmany(limit)
+        except sqlite3.OperationalError as e:
+            if time.monotonic() > deadline:
+                raise QueryTooExpensive(f"查询超过 {timeout:g} 秒仍未完成，已中止") from e
+            raise
+        finally:
+            conn.close()
@@ -0,0 +1,206 @@
+"""
+可替换的 embedding 后端，RAGProcess 按 EMBEDDING_BACKEND 选择：
+    dashscope  DashScope 远程 API（默认），调用经过调度器（见 scheduler.py）
+    local      本地 CPU 模型（ONNX Runtime），从 EMBEDDING_MODEL_DIR 加载 model.onnx 与 tokenizer.json，
+               按长度分批、多批并行推理，不经过网络
+    hash       确定性的离线 embedding（字符二元组哈希），用于测试和离线基准，没有语义能力
+不同后端（或同一后端的不同模型）的向量不能混在一个库里：向量库根目录下的 embedding.json 记录建库用的后端，
+与当前配置不一致时启动报错，需要先用 reembed.py 重新计算整个库：
+    python 课程助手/reembed.py --to local
+配置：
+    EMBEDDING_MODEL_DIR     本地模型目录（默认 课程助手/models/bge-small-zh-v1.5）
+    EMBEDDING_BATCH_SIZE    本地模型每批的文本数（默认 32）
+    EMBEDDING_THREADS       本地模型并行推理的批数（默认 min(4, CPU 核数)）
+    EMBEDDING_MAX_LENGTH    本地模型的最大 token 数（默认 512）
+    EMBEDDING_POOLING       本地模型的池化方式 cls / mean（默认 cls，bge 系列使用 cls）
+    EMBEDDING_QUERY_PREFIX  查询前加的指令（bge 中文模型建议"为这个句子生成表示以用于检索相关文章："）
+    EMBEDDING_DIM           hash 后端的维度（默认 512）
+查询与文档的 embedding 不一定相同（DashScope 的 text_type、本地模型的查询指令），
+批量计算查询向量要用 embed_queries，不能用 embed_documents。
+"""
+import functools
+import hashlib
+import json
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+BACKEND = os.getenv("EMBEDDING_BACKEND", "dashscope")
+MODEL_DIR = os.getenv("EMBEDDING_MODEL_DIR", "课程助手/models/bge-small-zh-v1.5")
+BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+THREADS = int(os.getenv("EMBEDDING_THREADS", str(min(4, os.cpu_count() or 1))))
+MAX_LENGTH = int(os.getenv("EMBEDDING_MAX_LENGTH", "512"))
+POOLING = os.getenv("EMBEDDING_POOLING", "cls")
+QUERY_PREFIX = os.getenv("EMBEDDING_QUERY_PREFIX", "")
+HASH_DIM = int(os.getenv("EMBEDDING_DIM", "512"))
+BACKENDS = ("dashscope", "local", "hash")
+MARKER = "embedding.json"
+
+
+def hash_embed(text: str, dim: int = HASH_DIM):
+    vec = [0.0] * dim
+    text = text or " "
+    grams = [text[i:i + 2] for i in range(max(len(text) - 1, 1))]
+    for gram in grams:
+        digest = hashlib.md5(gram.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % dim
+        vec[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+class HashEmbeddings:
+    """同样的文本永远得到同样的向量，字面相近的文本向量也相近，不访问网络"""
+    def __init__(self, dim: int = HASH_DIM):
+        self.dim = dim
+        self.backend_name = f"hash:{dim}"
+
+    def embed_documents(self, texts):
+        return [hash_embed(t, self.dim) for t in texts]
+
+    def embed_query(self, text):
+        return hash_embed(text, self.dim)
+
+    def embed_queries(self, texts):
+        return self.embed_documents(texts)
+
+
+class LocalOnnxEmbeddings:
+    def __init__(self, model_dir: str = MODEL_DIR, batch_size: int = BATCH_SIZE, threads: int = THREADS,
+                 max_length: int = MAX_LENGTH, pooling: str = POOLING, query_prefix: str = QUERY_PREFIX):
+        """
+        :param model_dir: 模型目录，包含 model.onnx（或 onnx/model.onnx）与 tokenizer.json
+        :param threads: 同时推理的批数；每批内部的算子线程数为 CPU 核数 / threads
+        """
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+        model_path = next((p for p in (os.path.join(model_dir, "model.onnx"), os.path.join(model_dir, "onnx", "model.onnx"))
+                           if os.path.exists(p)), None)
+        if model_path is None:
+            raise FileNotFoundError(f"{model_dir} 中没有 model.onnx，请先下载本地 embedding 模型")
+        if pooling not in ("cls", "mean"):
+            raise ValueError(f"不支持的池化方式: {pooling}")
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = max((os.cpu_count() or 1) // threads, 1)
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        pad_token = next((t for t in ("[PAD]", "<pad>") if self.tokenizer.token_to_id(t) is not None), None)
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id(pad_token) if pad_token else 0,
+                                      pad_token=pad_token or "[PAD]")
+        self.batch_size = batch_size
+        self.pooling = pooling
+        self.query_prefix = query_prefix
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="embed")
+        self.backend_name = f"local:{os.path.basename(os.path.normpath(model_dir))}:{pooling}"
+
+    def _embed_batch(self, texts):
+        import numpy as np
+        encodings = self.tokenizer.encode_batch(texts)
+        ids = np.array([e.ids for e in encodings], dtype=np.int64)
+        mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        feeds = {"input_ids": ids, "attention_mask": mask}
+        if "token_type_ids" in self._input_names:
+            feeds["token_type_ids"] = np.zeros_like(ids)
+        output = self.session.run(None, {k: v for k, v in feeds.items() if k in self._input_names})[0]
+        if output.ndim == 3:  # last_hidden_state: (批, token, 维度)
+            if self.pooling == "cls":
+                output = output[:, 0]
+            else:
+                weights = mask[:, :, None].astype(output.dtype)
+                output = (output * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+        norms = np.linalg.norm(output, axis=1, keepdims=True)
+        return output / np.maximum(norms, 1e-12)
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        # 按长度排序后分批，同一批的文本长度相近，padding 少；各批在线程池里并行推理
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        results = [None] * len(texts)
+        outputs = self._pool.map(lambda batch: self._embed_batch([texts[i] for i in batch]), batches)
+        for batch, vectors in zip(batches, outputs):
+            for i, vector in zip(batch, vectors):
+                results[i] = vector.tolist()
+        return results
+
+    def embed_query(self, text):
+        return self._embed_batch([self.query_prefix + text])[0].tolist()
+
+    def embed_queries(self, texts):
+        """批量计算查询向量：与 embed_query 一样加上查询指令"""
+        return self.embed_documents([self.query_prefix + t for t in texts])
+
+
+@functools.lru_cache(maxsize=None)
+def _dashscope_class():
+    """DashScopeEmbeddings 加上批量查询 embedding（延迟导入 LangChain）"""
+    from langchain.embeddings import DashScopeEmbeddings
+    from langchain_community.embeddings.dashscope import embed_with_retry
+
+    class BatchQueryDashScopeEmbeddings(DashScopeEmbeddings):
+        def embed_queries(self, texts):
+            """一次请求计算多条查询，text_type 仍为 query（embed_documents 按 document 计算）"""
+            if not texts:
+                return []
+            items = embed_with_retry(self, input=list(texts), text_type="query", model=self.model)
+            return [item["embedding"] for item in items]
+
+    return BatchQueryDashScopeEmbeddings
+
+
+def get_embeddings(backend: str = None):
+    """按名称（默认 EMBEDDING_BACKEND）创建 embedding 后端"""
+    backend = backend or BACKEND
+    if backend == "dashscope":
+        from scheduler import ScheduledEmbeddings
+        client = _dashscope_class()(dashscope_api_key=os.getenv("DASHSCOPE_API_KEY"))
+        # DashScope SDK 不走共享的 httpx 客户端，在这里接入调度
+        embeddings = ScheduledEmbeddings(client)
+        embeddings.backend_name = f"dashscope:{getattr(client, 'model', 'text-embedding-v1')}"
+        return embeddings
+    if backend == "local":
+        return LocalOnnxEmbeddings()
+    if backend == "hash":
+        return HashEmbeddings()
+    raise ValueError(f"未知的 embedding 后端: {backend}（可选 {', '.join(BACKENDS)}）")
+
+
+def backend_name(embeddings) -> str:
+    return getattr(embeddings, "backend_name", type(embeddings).__name__)
+
+
+def recorded_backend(persist_directory: str):
+    """向量库根目录记录的建库后端，没有记录时返回 None"""
+    path = os.path.join(persist_directory, MARKER)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f).get("backend")
+
+
+def record_backend(persist_directory: str, name: str):
+    os.makedirs(persist_directory, exist_ok=True)
+    tmp = os.path.join(persist_directory, MARKER + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"backend": name}, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(persist_directory, MARKER))
+
+
+def check_store_backend(persist_directory: str, embeddings):
+    """
+    确认向量库是用当前后端建立的；没有记录时（新库，或引入后端选择之前建立的库）记为当前后端。
+    不一致时报错：继续使用会让查询向量与库中的向量不可比，检索结果没有意义。
+    """
+    current = backend_name(embeddings)
+    recorded = recorded_backend(persist_directory)
+    if recorded is None:
+        record_backend(persist_directory, current)
+    elif recorded != current:
+        raise RuntimeError(f"向量库 {persist_directory} 由 embedding 后端 {recorded} 建立，当前配置为 {current}；"
+                           f"请先运行 python 课程助手/reembed.py 重新计算向量，或改回原来的后端")
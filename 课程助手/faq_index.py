@@ -0,0 +1,151 @@
+"""
+FAQ 直答索引：课程 FAQ（问题：/答案：）在入库时建立索引，学生的问题与某个整理好的问题足够接近时，
+直接流式返回存好的答案并注明出处，不经过检索和 qwen-max 生成；否则回落到常规 RAG。
+
+匹配分三层，越往后越贵：
+    1. 归一化后完全相同（去掉标点、空白、开头的"请问"等客套词和结尾的"吗""呢"等语气词）
+    2. 字符二元组的词法相似度（倒排索引，只比较有共同二元组的问题）
+    3. 问题 embedding 的余弦相似度（词法分数不够高时才计算查询 embedding）
+阈值：FAQ_THRESHOLD（默认 0.85）。
+索引文件不存在时（升级前入库的部署），RAGProcess 首次使用时从课程库中的问答对建立。
+"""
+import json
+import math
+import os
+import re
+import threading
+import uuid
+
+from tracing import metrics
+
+FAQ_THRESHOLD = float(os.getenv("FAQ_THRESHOLD", "0.85"))
+LEXICAL_WEIGHT = 0.4  # 组合分数中词法相似度的权重
+
+_PUNCT = re.compile(r"[\s，。！？；：、“”‘’（）【】《》…—～·,.!?;:'\"()\[\]{}<>-]+")
+# 只去掉开头的客套词和结尾的语气词：词中间的"吗""呢"（如"吗啡""呢子"）保留
+_LEADING = re.compile(r"^(?:请问一下|请问|你好|您好|老师|想问一下|我想知道)+")
+_TRAILING = re.compile(r"(?:呢|吗|呀|啊)+$")
+
+
+def normalize_question(text: str) -> str:
+    text = _PUNCT.sub("", text.lower())
+    stripped = _TRAILING.sub("", _LEADING.sub("", text))
+    # 整个问题都是客套词时保留原样，避免归一化成空串
+    return stripped or text
+
+
+def _bigrams(text: str):
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+def _cosine(a, b) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class FAQIndex:
+    def __init__(self, path: str, embeddings, threshold: float = FAQ_THRESHOLD):
+        """
+        :param path: 索引文件（JSON）
+        :param embeddings: 计算问题 embedding 的模型，与课程库相同
+        """
+        self.path = path
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.entries = []  # {"question", "answer", "source", "norm", "vector"}
+        self._exact = {}
+        self._postings = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                entries = json.load(f)
+            for entry in entries:
+                # 归一化规则可能改过，加载时按当前规则重算
+                entry["norm"] = normalize_question(entry["question"])
+            self._replace(entries)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def _replace(self, entries):
+        """重建精确匹配表和二元组倒排索引，建好后一次性替换（检索线程不会看到半成品）"""
+        exact, postings = {}, {}
+        for i, entry in enumerate(entries):
+            exact[entry["norm"]] = i
+            for gram in _bigrams(entry["norm"]):
+                postings.setdefault(gram, set()).add(i)
+        self.entries, self._exact, self._postings = entries, exact, postings
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add_pairs(self, pairs, source: str):
+        """入库：加入 [(问题, 答案)]，同一归一化问题只保留最新的答案，然后写回文件"""
+        pairs = [(q, a) for q, a in pairs if q and a]
+        if not pairs:
+            return 0
+        vectors = self.embeddings.embed_documents([q for q, _ in pairs])
+        with self._lock:
+            entries = {e["norm"]: e for e in self.entries}
+            for (question, answer), vector in zip(pairs, vectors):
+                norm = normalize_question(question)
+                entries[norm] = {"question": question, "answer": answer, "source": os.path.basename(source),
+                                 "norm": norm, "vector": list(vector)}
+            self._replace(list(entries.values()))
+            self._save()
+        return len(pairs)
+
+    def build(self, pairs_by_source: dict) -> int:
+        """从头建立索引：{来源: [(问题, 答案)]}；没有问答对时也写出空索引，之后不再重复扫描"""
+        count = sum(self.add_pairs(pairs, source) for source, pairs in pairs_by_source.items())
+        if not self.exists():
+            with self._lock:
+                self._save()
+        return count
+
+    def _save(self):
+        # 临时文件名带进程号和随机后缀：多个进程同时建立索引时互不覆盖
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def match(self, query: str):
+        """返回 (条目, 分数)；没有超过阈值的问题时返回 None"""
+        entries, exact, postings = self.entries, self._exact, self._postings
+        if not entries:
+            return None
+        norm = normalize_question(query)
+        if norm in exact:
+            metrics.inc("faq_hits", kind="exact")
+            return entries[exact[norm]], 1.0
+        grams = _bigrams(norm)
+        candidates = {}
+        for gram in grams:
+            for i in postings.get(gram, ()):
+                candidates[i] = candidates.get(i, 0) + 1
+        if not candidates:
+            metrics.inc("faq_misses")
+            return None
+        # 词法分数：共同二元组的 Dice 系数
+        lexical = {i: 2 * shared / (len(grams) + len(_bigrams(entries[i]["norm"])))
+                   for i, shared in candidates.items()}
+        best = max(lexical, key=lexical.get)
+        if lexical[best] >= self.threshold:
+            metrics.inc("faq_hits", kind="lexical")
+            return entries[best], lexical[best]
+        # 词法分数太低的查询不值得再算 embedding
+        if lexical[best] < 0.3:
+            metrics.inc("faq_misses")
+            return None
+        vector = self.embeddings.embed_query(query)
+        scored = {i: LEXICAL_WEIGHT * lexical[i] + (1 - LEXICAL_WEIGHT) * _cosine(vector, entries[i]["vector"])
+                  for i in candidates}
+        best = max(scored, key=scored.get)
+        if scored[best] >= self.threshold:
+            metrics.inc("faq_hits", kind="semantic")
+            return entries[best], scored[best]
+        metrics.inc("faq_misses")
+        return None
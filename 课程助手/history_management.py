@@ -1,11 +1,21 @@
+import logging
+import os
+from contextlib import contextmanager
 from langchain_community.utilities import SQLDatabase
+from tracing import span
+import history_search
+
+logger = logging.getLogger(__name__)
+REINDEX_BATCH = 5000  # 重建全文索引时每批处理的记录数
+REINDEX_WAIT_MS = 600000  # 建表/重建索引时等待其他进程释放写锁的最长时间
 class HistoryManager:   
     def __init__(self):
 
-      self.db = SQLDatabase.from_uri("sqlite:///课程助手/课程助手.db") #sqlite:///是固定连接方法 后面跟文件路径
+      self.db = SQLDatabase.from_uri(os.getenv("HISTORY_DB_URI", "sqlite:///课程助手/课程助手.db")) #sqlite:///是固定连接方法 后面跟文件路径
       # -- 创建用户表
       self.db.run("""
               CREATE TABLE IF NOT EXISTS chat_history (
+                id INTEGER PRIMARY KEY, -- 记录ID（全文索引的行按它对应记录）
                 user_id TEXT NOT NULL, -- 用户ID
                 chat_id TEXT NOT NULL, -- 会话ID                
                 user_question TEXT NOT NULL, -- 用户问题
@@ -14,19 +24,151 @@ class HistoryManager:
             );
             """
           )
+      self._migrate_id_column()
+      # 侧边栏按用户分页列出会话、按会话加载记录都依赖这两个索引
+      self.db.run("CREATE INDEX IF NOT EXISTS idx_chat_history_user ON chat_history (user_id, last_response_date)")
+      self.db.run("CREATE INDEX IF NOT EXISTS idx_chat_history_chat ON chat_history (chat_id)")
+      # 全文索引（见 history_search.py）：只有 SQLite 且编译了 FTS5 时可用，否则搜索退回 LIKE 扫描
+      self.fts = self._init_search_index()
+
+    def _migrate_id_column(self):
+        """
+        旧表没有显式主键，全文索引按隐式 rowid 对应记录，而 VACUUM 可能给隐式 rowid 重新编号。
+        重建表加上 id INTEGER PRIMARY KEY，取原来的 rowid，已有的全文索引继续对应（索引随旧表删除，之后重新创建）。
+        """
+        from sqlalchemy import text
+        if self.db.dialect != "sqlite":
+            return
+        def has_id(conn):
+            return any(row[1] == "id" for row in conn.execute(text("PRAGMA table_info(chat_history)")))
+
+        with self.db._engine.connect() as conn:
+            if has_id(conn):
+                return
+        # 多个 worker 同时启动时只有拿到写锁的那个迁移，其余的等它提交后看到新表
+        with self._immediate(wait_ms=REINDEX_WAIT_MS) as conn:
+            if has_id(conn):
+                return
+            conn.execute(text("""
+                CREATE TABLE chat_history_migrated (
+                  id INTEGER PRIMARY KEY,
+                  user_id TEXT NOT NULL,
+                  chat_id TEXT NOT NULL,
+                  user_question TEXT NOT NULL,
+                  ai_response TEXT NOT NULL,
+                  last_response_date DATE NOT NULL
+                )"""))
+            conn.execute(text("INSERT INTO chat_history_migrated (id, user_id, chat_id, user_question, ai_response, "
+                              "last_response_date) SELECT rowid, user_id, chat_id, user_question, ai_response, "
+                              "last_response_date FROM chat_history"))
+            conn.execute(text("DROP TABLE chat_history"))
+            conn.execute(text("ALTER TABLE chat_history_migrated RENAME TO chat_history"))
+        logger.info("chat_history 已加上 id 主键")
+
+    def _init_search_index(self) -> bool:
+        from sqlalchemy import text
+        from sqlalchemy.exc import OperationalError
+        if self.db.dialect != "sqlite":
+            return False
+        with self.db._engine.connect() as conn:
+            if conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'chat_history_fts'")).first():
+                return True
+        try:
+            # 多个 worker 同时启动时，拿到写锁的那个建表并建索引，其余的排队等它提交后看到现成的表
+            with self._immediate(wait_ms=REINDEX_WAIT_MS) as conn:
+                existed = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'chat_history_fts'")).first()
+                # contentless 表：只存索引不存原文，索引的 rowid 即 chat_history.id，原文按它从 chat_history 取
+                conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS chat_history_fts USING fts5("
+                                  "owner, chat, question, response, content='')"))
+                if not existed:
+                    self._fill_search_index(conn)
+        except OperationalError as e:
+            if "no such module: fts5" not in str(e):
+                raise
+            logger.warning("SQLite 不支持 FTS5，聊天记录搜索使用 LIKE 扫描: %s", e)
+            return False
+        return True
+
+    @contextmanager
+    def _immediate(self, wait_ms: int = None):
+        """BEGIN IMMEDIATE 事务：开始时就拿到写锁，建表/重建索引与其他进程的写入互相排队"""
+        from sqlalchemy import text
+        with self.db._engine.connect() as conn:
+            previous = conn.execute(text("PRAGMA busy_timeout")).scalar() if wait_ms else None
+            try:
+                if wait_ms:
+                    conn.exec_driver_sql(f"PRAGMA busy_timeout = {int(wait_ms)}")
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+                try:
+                    yield conn
+                except BaseException:
+                    conn.rollback()
+                    raise
+                conn.commit()
+            finally:
+                if previous is not None:
+                    conn.exec_driver_sql(f"PRAGMA busy_timeout = {int(previous)}")
+                    conn.commit()
+
+    @staticmethod
+    def _index_row(record_id, user_id, chat_id, user_question, ai_response) -> dict:
+        return {"rowid": record_id, "owner": history_search.owner_token(user_id),
+                "chat": history_search.chat_token(chat_id),
+                "question": history_search.index_text(user_question),
+                "response": history_search.index_text(ai_response)}
+
+    def rebuild_search_index(self) -> int:
+        """
+        按 chat_history 重建全文索引，返回索引的记录数。
+        整个重建在一个 BEGIN IMMEDIATE 事务里完成：并发的重建和新写入的记录只能排在它前后，
+        不会出现同一条记录被索引两次、之后 'delete' 时破坏 contentless 索引的情况。
+        """
+        from sqlalchemy import text
+        with self._immediate(wait_ms=REINDEX_WAIT_MS) as conn:
+            conn.execute(text("INSERT INTO chat_history_fts (chat_history_fts) VALUES ('delete-all')"))
+            return self._fill_search_index(conn)
+
+    def _fill_search_index(self, conn) -> int:
+        """在调用方的事务里把 chat_history 的全部记录写入全文索引（分批读取，限制内存）"""
+        from sqlalchemy import text
+        insert = text("INSERT INTO chat_history_fts (rowid, owner, chat, question, response) "
+                      "VALUES (:rowid, :owner, :chat, :question, :response)")
+        count, last = 0, 0
+        while True:
+            rows = conn.execute(text(
+                "SELECT id, user_id, chat_id, user_question, ai_response FROM chat_history "
+                "WHERE id > :last ORDER BY id LIMIT :limit"), {"last": last, "limit": REINDEX_BATCH}).fetchall()
+            if not rows:
+                break
+            conn.execute(insert, [self._index_row(*row) for row in rows])
+            count += len(rows)
+            last = rows[-1][0]
+        if count:
+            logger.info("聊天记录全文索引已重建: %d 条", count)
+        return count
+
     def add_history(self, input_dict: dict):
-        self.db.run("""
-            INSERT INTO chat_history (chat_id,user_id, user_question, ai_response, last_response_date)
-            VALUES (:chat_id, :user_id, :user_question, :ai_response, :last_response_date)
-        """, 
-        parameters={
-            "chat_id": input_dict["chat_id"],
-            "user_id": input_dict["user_id"],
-            "user_question": input_dict["user_question"],
-            "ai_response": input_dict["ai_response"],
-            "last_response_date": input_dict["last_response_date"]
-        })
-        print(f"[sql] 成功为用户{input_dict['user_id']}添加一次对话记录{input_dict['chat_id']}\n")
+        from sqlalchemy import text
+        with span("sqlite_write"):
+            # 记录与索引在同一个事务里写入
+            with self.db._engine.begin() as conn:
+                result = conn.execute(text("""
+                    INSERT INTO chat_history (chat_id,user_id, user_question, ai_response, last_response_date)
+                    VALUES (:chat_id, :user_id, :user_question, :ai_response, :last_response_date)
+                """),
+                {
+                    "chat_id": input_dict["chat_id"],
+                    "user_id": input_dict["user_id"],
+                    "user_question": input_dict["user_question"],
+                    "ai_response": input_dict["ai_response"],
+                    "last_response_date": input_dict["last_response_date"]
+                })
+                if self.fts:
+                    conn.execute(text("INSERT INTO chat_history_fts (rowid, owner, chat, question, response) "
+                                      "VALUES (:rowid, :owner, :chat, :question, :response)"),
+                                 self._index_row(result.lastrowid, input_dict["user_id"], input_dict["chat_id"],
+                                                 input_dict["user_question"], input_dict["ai_response"]))
+            logger.debug(f"[sql] 成功为用户{input_dict['user_id']}添加一次对话记录{input_dict['chat_id']}")
 
     def get_all_history(self, user_id: str):
         result = self.db._execute("""
@@ -37,9 +179,52 @@ class HistoryManager:
         parameters={
             "user_id": user_id
         })
-        print(f"[sql] 成功获取用户{user_id}的所有对话记录\n")
+        logger.debug(f"[sql] 成功获取用户{user_id}的所有对话记录")
+        return result
+
+
+    def list_sessions(self, user_id: str, offset: int = 0, limit: int = 10, chat_ids: list = None):
+        """
+        分页列出用户的会话（按最后回答时间倒序），每个会话返回 chat_id、最后回答日期、对话轮数和首个问题作为标题。
+        chat_ids 不为空时只列出其中的会话（访客只能看到自己本次打开页面后创建的会话）。
+        """
+        if chat_ids is not None and not chat_ids:
+            return []
+        chat_filter, params = self._chat_filter(chat_ids)
+        params.update({"user_id": user_id, "limit": limit, "offset": offset})
+        result = self.db._execute(f"""
+          SELECT c.chat_id, MAX(c.last_response_date) AS last_response_date, COUNT(*) AS turns,
+                 (SELECT h.user_question FROM chat_history AS h
+                  WHERE h.chat_id = c.chat_id ORDER BY h.id LIMIT 1) AS title
+          FROM chat_history AS c
+          WHERE c.user_id = :user_id {chat_filter}
+          GROUP BY c.chat_id
+          ORDER BY MAX(c.last_response_date) DESC, MAX(c.id) DESC
+          LIMIT :limit OFFSET :offset
+        """,
+        parameters=params)
         return result
 
+    def count_sessions(self, user_id: str, chat_ids: list = None) -> int:
+        """用户的会话总数（用于分页）"""
+        if chat_ids is not None and not chat_ids:
+            return 0
+        chat_filter, params = self._chat_filter(chat_ids)
+        params["user_id"] = user_id
+        result = self.db._execute(f"""
+          SELECT COUNT(DISTINCT c.chat_id) AS total FROM chat_history AS c
+          WHERE c.user_id = :user_id {chat_filter}
+        """,
+        parameters=params)
+        return result[0]["total"] if result else 0
+
+    @staticmethod
+    def _chat_filter(chat_ids: list = None):
+        """生成 chat_id IN (...) 过滤条件和对应参数"""
+        if chat_ids is None:
+            return "", {}
+        names = [f"c{i}" for i in range(len(chat_ids))]
+        return f"AND c.chat_id IN ({', '.join(':' + n for n in names)})", dict(zip(names, chat_ids))
 
     def get_solo_history(self, chat_id: str):
         result = self.db._execute("""
@@ -50,19 +235,103 @@ class HistoryManager:
         parameters={
             "chat_id": chat_id
         })
-        print(f"[sql] 成功获取会话{chat_id}的对话记录\n")
+        logger.debug(f"[sql] 成功获取会话{chat_id}的对话记录")
         return result       
 
     def delete_history(self, user_id: str, chat_id: str):
-        self.db._execute("""
-          DELETE FROM chat_history 
-          WHERE chat_id = :chat_id AND user_id = :user_id
-        """, 
-        parameters={
-            "chat_id": chat_id,
-            "user_id": user_id
-        })
-        print(f"[sql] 成功删除用户{user_id}会话{chat_id}的对话记录\n")
+        from sqlalchemy import text
+        params = {"chat_id": chat_id, "user_id": user_id}
+        with self.db._engine.begin() as conn:
+            if self.fts:
+                # contentless 索引删除时要提供写入时的同样内容
+                rows = conn.execute(text("""
+                  SELECT id, user_id, chat_id, user_question, ai_response FROM chat_history
+                  WHERE chat_id = :chat_id AND user_id = :user_id
+                """), params).fetchall()
+                if rows:
+                    conn.execute(text("INSERT INTO chat_history_fts (chat_history_fts, rowid, owner, chat, question, response) "
+                                      "VALUES ('delete', :rowid, :owner, :chat, :question, :response)"),
+                                 [self._index_row(*row) for row in rows])
+            conn.execute(text("""
+              DELETE FROM chat_history 
+              WHERE chat_id = :chat_id AND user_id = :user_id
+            """), params)
+        logger.debug(f"[sql] 成功删除用户{user_id}会话{chat_id}的对话记录")
+
+    def search_sessions(self, user_id: str, query: str, offset: int = 0, limit: int = 10, chat_ids: list = None):
+        """
+        按相关度分页搜索用户的会话（问题和回答全文检索），每个会话取最相关的一轮：
+        返回 chat_id、最后回答日期、该轮的问题 title 和带【】标记的摘要 snippet。
+        chat_ids 不为空时只搜索其中的会话（访客）。
+        """
+        if chat_ids is not None and not chat_ids:
+            return []
+        with span("history_search"):
+            if self.fts:
+                match = history_search.match_expression(query, user_id, chat_ids)
+                if match is None:
+                    return []
+                # 每个会话取得分最高的一轮：问题里包含全部检索词的优先，其次是最近的（id 越大越新）；
+                # 只对已匹配的行检查问题原文，不再执行第二次 MATCH。MAX 的裸列取自得分最高的那一行
+                terms = history_search.query_terms(query)
+                in_question = " AND ".join(f"instr(lower(c.user_question), :t{i}) > 0" for i in range(len(terms)))
+                params = {f"t{i}": term.lower() for i, term in enumerate(terms)}
+                params.update({"match": match, "user_id": user_id, "limit": limit, "offset": offset})
+                rows = self.db._execute(f"""
+                  SELECT c.chat_id, c.last_response_date, c.user_question, c.ai_response,
+                         MAX(({in_question}) * 1000000000000 + f.rowid) AS score
+                  FROM chat_history_fts AS f JOIN chat_history AS c ON c.id = f.rowid
+                  WHERE chat_history_fts MATCH :match AND c.user_id = :user_id
+                  GROUP BY c.chat_id
+                  ORDER BY score DESC
+                  LIMIT :limit OFFSET :offset
+                """,
+                parameters=params)
+            else:
+                chat_filter, params = self._chat_filter(chat_ids)
+                params.update({"user_id": user_id, "pattern": f"%{query.strip()}%", "limit": limit, "offset": offset})
+                rows = self.db._execute(f"""
+                  SELECT c.chat_id, MAX(c.last_response_date) AS last_response_date, c.user_question, c.ai_response
+                  FROM chat_history AS c
+                  WHERE c.user_id = :user_id {chat_filter}
+                    AND (c.user_question LIKE :pattern OR c.ai_response LIKE :pattern)
+                  GROUP BY c.chat_id
+                  ORDER BY MAX(c.last_response_date) DESC, c.chat_id
+                  LIMIT :limit OFFSET :offset
+                """,
+                parameters=params)
+        terms = history_search.query_terms(query)
+        results = []
+        for row in rows:
+            source = row["user_question"] if any(t.lower() in row["user_question"].lower() for t in terms) else row["ai_response"]
+            results.append({"chat_id": row["chat_id"], "last_response_date": row["last_response_date"],
+                            "title": row["user_question"], "snippet": history_search.snippet(source, terms)})
+        return results
+
+    def count_search_sessions(self, user_id: str, query: str, chat_ids: list = None) -> int:
+        """搜索命中的会话总数（用于分页）"""
+        if chat_ids is not None and not chat_ids:
+            return 0
+        if self.fts:
+            match = history_search.match_expression(query, user_id, chat_ids)
+            if match is None:
+                return 0
+            result = self.db._execute("""
+              SELECT COUNT(DISTINCT c.chat_id) AS total
+              FROM chat_history_fts AS f JOIN chat_history AS c ON c.id = f.rowid
+              WHERE chat_history_fts MATCH :match AND c.user_id = :user_id
+            """,
+            parameters={"match": match, "user_id": user_id})
+        else:
+            chat_filter, params = self._chat_filter(chat_ids)
+            params.update({"user_id": user_id, "pattern": f"%{query.strip()}%"})
+            result = self.db._execute(f"""
+              SELECT COUNT(DISTINCT c.chat_id) AS total FROM chat_history AS c
+              WHERE c.user_id = :user_id {chat_filter}
+                AND (c.user_question LIKE :pattern OR c.ai_response LIKE :pattern)
+            """,
+            parameters=params)
+        return result[0]["total"] if result else 0
     
 from datetime import date
 # today = date.today()
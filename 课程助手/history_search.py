@@ -0,0 +1,83 @@
+"""
+聊天记录全文检索的分词与查询构造（索引本身在 history_management.py 的 chat_history_fts 表中）。
+SQLite FTS5 自带的 unicode61 分词器把一整段连续的汉字当成一个词，无法按词检索中文；
+Python 的 sqlite3 又不能注册自定义分词器，所以在写入前先分好词，FTS5 只按空格切分：
+    - 连续的汉字（含日文假名）切成相邻二元组，再加上最后一个字："线性代数" -> "线性 性代 代数 数"
+      任意两个以上汉字的查询都能按相邻二元组的短语匹配，单字查询用前缀匹配（每个字都是某个词的开头）
+    - 字母数字按词，转成小写；查询时按前缀匹配（"pyth" 能找到 python）
+每行另有 owner / chat 两列，存用户ID、会话ID的哈希词，查询时与内容条件一起交给 FTS5 求交集，
+只在该用户（或访客的这几个会话）的记录里排名，不需要先取出所有匹配再过滤。
+排名不用 bm25：bm25 需要每个短语在整个索引中的文档数，FTS5 每次查询都要扫描该短语的全部倒排列表，
+常见词组在百万条记录上要几百毫秒；这里按"问题中包含全部检索词"优先、再按时间从新到旧排列，只涉及该用户的匹配。
+修改分词规则后需要重建索引（HistoryManager.rebuild_search_index），否则删除记录时无法从索引中移除旧词。
+"""
+import hashlib
+import re
+
+_TOKEN = re.compile(r"[぀-ヿ㐀-䶿一-鿿豈-﫿]+|[0-9A-Za-zÀ-ɏ]+")
+_CJK = re.compile(r"[぀-ヿ㐀-䶿一-鿿豈-﫿]")
+SNIPPET_CHARS = 40
+
+
+def index_text(text: str) -> str:
+    """把文本转成写入 FTS5 的词序列（空格分隔）"""
+    tokens = []
+    for match in _TOKEN.finditer(text or ""):
+        run = match.group()
+        if _CJK.match(run):
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            tokens.append(run[-1])
+        else:
+            tokens.append(run.lower())
+    return " ".join(tokens)
+
+
+def owner_token(user_id: str) -> str:
+    return "u" + hashlib.md5(str(user_id).encode("utf-8")).hexdigest()[:16]
+
+
+def chat_token(chat_id: str) -> str:
+    return "c" + hashlib.md5(str(chat_id).encode("utf-8")).hexdigest()[:16]
+
+
+def query_terms(query: str) -> list:
+    """查询中的检索词（原文），用于生成摘要时定位"""
+    return [m.group() for m in _TOKEN.finditer(query or "")]
+
+
+def match_expression(query: str, user_id: str, chat_ids: list = None):
+    """
+    生成 FTS5 MATCH 表达式：所有检索词都要出现在问题或回答中（AND），并限定用户和会话。
+    查询里没有可检索的字符时返回 None。
+    """
+    parts = []
+    for term in query_terms(query):
+        if _CJK.match(term):
+            if len(term) == 1:
+                parts.append(f'"{term}"*')
+            else:
+                parts.append('"' + " ".join(term[i:i + 2] for i in range(len(term) - 1)) + '"')
+        else:
+            parts.append(f'"{term.lower()}"*')
+    if not parts:
+        return None
+    content = f'{{question response}} : ({" AND ".join(parts)})'
+    if chat_ids is not None:
+        # 指定了会话时只按会话过滤：访客共用一个 user_id，owner 词的倒排列表很长，会话词更有选择性
+        return "chat : (" + " OR ".join(f'"{chat_token(c)}"' for c in chat_ids) + ") AND " + content
+    return f'owner : "{owner_token(user_id)}" AND ' + content
+
+
+def snippet(text: str, terms: list, width: int = SNIPPET_CHARS) -> str:
+    """截取第一个检索词附近的一段原文，检索词用【】标出；没有找到时返回开头一段"""
+    # 直接在原文上不区分大小写地查找：lower() 可能改变字符个数（如 "İ"），在小写文本上找到的位置切原文会错位
+    text = text or ""
+    hits = [(m.start(), m.end()) for m in (re.search(re.escape(t), text, re.IGNORECASE) for t in terms if t) if m]
+    if not hits:
+        return text[:width].replace("\n", " ")
+    index, end = min(hits)
+    start = max(index - width // 3, 0)
+    piece = text[start:start + width].replace("\n", " ")
+    offset, length = index - start, end - index
+    piece = piece[:offset] + "【" + piece[offset:offset + length] + "】" + piece[offset + length:]
+    return ("…" if start > 0 else "") + piece + ("…" if start + width < len(text) else "")
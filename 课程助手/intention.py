@@ -1,16 +1,11 @@
-from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate
 from langchain.chains import LLMChain
-import os
 from dotenv import load_dotenv
+from llm_registry import get_chat_model
 load_dotenv(r"./lna.env")
 class IntentionRecognizer:
   def __init__(self):
-    self.llm = ChatOpenAI(
-                model="qwen-max",
-                api_key=os.getenv("DASHSCOPE_API_KEY"),
-                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-            )
+    self.llm = get_chat_model("qwen-max")
     self.prompt=ChatPromptTemplate.from_messages(
       [
         ("system","""你是一个意图识别小助手，请根据用户的提问识别用户的意图，并返回意图名称。
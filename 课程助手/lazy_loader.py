@@ -0,0 +1,68 @@
+import threading
+
+
+class LazyComponent:
+    """
+    类级别的延迟构造描述符：第一次访问时才调用 factory 构造组件，之后所有实例共享同一个对象。
+    多线程同时首次访问时只会构造一次。
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.name = factory.__name__
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner):
+        return self.get()
+
+    def get(self):
+        """返回组件，未构造时先构造"""
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._value = self.factory()
+                    self._loaded = True
+        return self._value
+
+    def set(self, value):
+        """直接指定组件（例如基准测试中替换为假实现），之后访问不再调用 factory"""
+        with self._lock:
+            self._value = value
+            self._loaded = True
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+
+class lazy_property:
+    """
+    实例级别的延迟属性（线程安全版 cached_property）：第一次访问时构造并缓存到实例上。
+    """
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+        self._lock = threading.Lock()
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner):
+        if obj is None:
+            return self
+        if self.name in obj.__dict__:
+            return obj.__dict__[self.name]
+        with self._lock:
+            if self.name not in obj.__dict__:
+                obj.__dict__[self.name] = self.func(obj)
+        return obj.__dict__[self.name]
+
+
+def is_loaded(obj, name: str) -> bool:
+    """判断实例上的 lazy_property 是否已经构造过"""
+    return name in obj.__dict__
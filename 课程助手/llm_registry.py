@@ -0,0 +1,154 @@
+"""
+进程级共享的大模型客户端注册表。
+同一组 (模型, 参数) 只构造一个 ChatOpenAI，所有模型共享一个带连接池、keep-alive 的 httpx 客户端，
+避免每次提问都新建客户端、重新做 TLS 握手。连接池大小可通过环境变量配置：
+    LLM_MAX_CONNECTIONS      最大连接数（默认 50）
+    LLM_MAX_KEEPALIVE        最大空闲保活连接数（默认 20）
+    LLM_KEEPALIVE_EXPIRY     空闲连接保活秒数（默认 120）
+    LLM_TIMEOUT              请求超时秒数（默认 60）
+    DASHSCOPE_BASE_URL       默认模型服务地址
+同步和异步客户端的每个请求经过 scheduler 的调度传输层（按服务和端点分别限并发、限速、按用户公平排队）。
+配置了备用服务（deepseek_api_key）时，get_chat_model 返回 model_gateway 的网关模型（超时、重试、熔断、对冲）。
+"""
+import os
+import asyncio
+import atexit
+import logging
+import threading
+import httpx
+from dotenv import load_dotenv
+load_dotenv(r"课程助手/lna.env")
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = os.getenv("DASHSCOPE_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
+DEFAULT_API_KEY_ENV = "DASHSCOPE_API_KEY"
+
+_lock = threading.RLock()  # 网关模型在持锁状态下构造各服务的 ChatOpenAI
+_models = {}
+_http_client = None
+_async_http_client = None
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "50")),
+        max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE", "20")),
+        keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "120")),
+    )
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(float(os.getenv("LLM_TIMEOUT", "60")), connect=10.0)
+
+
+def get_http_client() -> httpx.Client:
+    """返回进程内共享的同步 httpx 客户端（线程安全，自带连接池）"""
+    global _http_client
+    if _http_client is None:
+        with _lock:
+            if _http_client is None:
+                from scheduler import ScheduledTransport
+                from cancellation import abort_on_cancel
+                transport = ScheduledTransport(httpx.HTTPTransport(limits=_limits()))
+                # 本轮被取消时关闭正在读取的响应（见 cancellation.abort_on_cancel）
+                _http_client = httpx.Client(transport=transport, timeout=_timeout(),
+                                            event_hooks={"response": [abort_on_cancel]})
+    return _http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """返回进程内共享的异步 httpx 客户端（供同一事件循环内的并发协程复用）"""
+    global _async_http_client
+    if _async_http_client is None:
+        with _lock:
+            if _async_http_client is None:
+                from scheduler import AsyncScheduledTransport
+                transport = AsyncScheduledTransport(httpx.AsyncHTTPTransport(limits=_limits()))
+                _async_http_client = httpx.AsyncClient(transport=transport, timeout=_timeout())
+    return _async_http_client
+
+
+def get_chat_model(model: str = "qwen-max", *, temperature: float = None, streaming: bool = False,
+                   base_url: str = None, api_key_env: str = DEFAULT_API_KEY_ENV, **kwargs):
+    """
+    按 (模型, 参数) 返回共享的聊天模型，首次请求时构造。
+    使用默认服务且启用了模型网关时返回网关模型（主服务 + 备用服务），否则返回 ChatOpenAI。
+    """
+    if base_url is None and api_key_env == DEFAULT_API_KEY_ENV:
+        from model_gateway import gateway_enabled, get_gateway_model
+        if gateway_enabled():
+            key = ("gateway", model, temperature, streaming, tuple(sorted(kwargs.items())))
+            llm = _models.get(key)
+            if llm is None:
+                with _lock:
+                    if key not in _models:
+                        _models[key] = get_gateway_model(model, temperature=temperature, streaming=streaming, **kwargs)
+                llm = _models[key]
+            return llm
+    return get_provider_model(model, temperature=temperature, streaming=streaming,
+                              base_url=base_url, api_key_env=api_key_env, **kwargs)
+
+
+def get_provider_model(model: str, *, temperature: float = None, streaming: bool = False,
+                       base_url: str = None, api_key_env: str = DEFAULT_API_KEY_ENV, **kwargs):
+    """
+    按 (模型, 服务, 参数) 返回共享的 ChatOpenAI 实例，首次请求时构造。
+    ChatOpenAI 调用本身无状态，可以在多个线程、多个会话之间安全共享。
+    """
+    base_url = base_url or DEFAULT_BASE_URL
+    key = (model, base_url, api_key_env, temperature, streaming, tuple(sorted(kwargs.items())))
+    llm = _models.get(key)
+    if llm is not None:
+        return llm
+    # 共享客户端在拿 _lock 之前创建：get_http_client 自己也要拿 _lock
+    http_client, http_async_client = get_http_client(), get_async_http_client()
+    with _lock:
+        if key not in _models:
+            from langchain_openai import ChatOpenAI
+            params = dict(kwargs)
+            if temperature is not None:
+                params["temperature"] = temperature
+            _models[key] = ChatOpenAI(
+                model=model,
+                api_key=os.getenv(api_key_env),
+                base_url=base_url,
+                streaming=streaming,
+                http_client=http_client,
+                http_async_client=http_async_client,
+                **params
+            )
+        return _models[key]
+
+
+def prewarm_connections(base_url: str = None, api_key_env: str = DEFAULT_API_KEY_ENV) -> bool:
+    """预先与模型服务建立连接（完成 TLS 握手并放入连接池），失败不影响后续使用"""
+    url = (base_url or DEFAULT_BASE_URL).rstrip("/") + "/models"
+    try:
+        get_http_client().get(url, headers={"Authorization": f"Bearer {os.getenv(api_key_env, '')}"})
+        return True
+    except httpx.HTTPError as e:
+        logger.warning("预热连接失败: %s", e)
+        return False
+
+
+def registry_stats() -> dict:
+    """返回注册表中的模型数量（调试用）"""
+    stats = {"models": len(_models), "http_client": _http_client is not None}
+    if any(key[0] == "gateway" for key in list(_models)):
+        from model_gateway import provider_stats
+        stats["providers"] = provider_stats()
+    return stats
+
+
+def _close_clients():
+    if _http_client is not None:
+        _http_client.close()
+    if _async_http_client is not None:
+        try:
+            asyncio.run(_async_http_client.aclose())
+        except Exception as e:
+            logger.debug("关闭异步 httpx 客户端出错: %s", e)
+
+
+atexit.register(_close_clients)
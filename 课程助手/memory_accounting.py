@@ -0,0 +1,342 @@
+"""
+进程内存统计与泄漏排查。
+各模块把自己持有的内存（会话历史、缓存、向量库句柄、调度器的按用户记录等）注册到 memory，
+/memory.json 汇总：进程 RSS 与峰值、各组件的估计字节数和条目数、占用最多的会话。
+管理接口（挂在指标服务上，只监听 127.0.0.1）：
+    GET /memory.json                              汇总报告（?top=20 占用最多的会话数）
+    POST /memory/tracemalloc/start?frames=25      开始 tracemalloc（有明显开销，排查完请 stop）
+    GET /memory/tracemalloc/snapshot?top=30       拍快照作为基线，返回按代码行汇总的分配
+    GET /memory/tracemalloc/diff?top=30           与基线比较，返回增长最多的代码行；reset=1 时把这次快照设为新基线
+    POST /memory/tracemalloc/stop
+    snapshot / diff 可用 group=lineno|filename|traceback 指定汇总方式
+高水位（后台每 MEMORY_CHECK_INTERVAL 秒检查一次，默认 60，设为 0 关闭）：
+    MEMORY_HIGH_WATER_MB   RSS 超过时告警，并调用各组件的回收函数（淘汰缓存、清理空闲记录），默认 0 不检查
+    MEMORY_EVICT_COOLDOWN  两次高水位回收的最短间隔秒数，默认 300；期间 RSS 比上次回收时再涨 10% 以上才提前回收
+                           （释放的内存常常留在分配器里，RSS 不会马上下降，不能每次检查都再淘汰一轮）
+    MEMORY_SESSION_MAX_KB  单个会话超过时告警，并回收该会话的缓存，默认 0 不检查
+字节数是递归 sys.getsizeof 的估计值，用来发现增长趋势和异常会话，不等于 RSS 的精确构成。
+"""
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+from tracing import metrics
+
+logger = logging.getLogger(__name__)
+
+CHECK_INTERVAL = float(os.getenv("MEMORY_CHECK_INTERVAL", "60"))
+HIGH_WATER_MB = float(os.getenv("MEMORY_HIGH_WATER_MB", "0"))
+SESSION_MAX_KB = float(os.getenv("MEMORY_SESSION_MAX_KB", "0"))
+EVICT_COOLDOWN = float(os.getenv("MEMORY_EVICT_COOLDOWN", "300"))
+EVICT_REGROWTH = 1.1  # 冷却期内 RSS 超过上次回收时的这个倍数才再次回收
+SIZE_MAX_OBJECTS = 20000  # approx_size 最多遍历的对象数，超过后按已遍历部分估计
+
+
+def approx_size(obj, max_objects: int = SIZE_MAX_OBJECTS) -> int:
+    """递归估计对象占用的字节数（容器元素、对象 __dict__ / __slots__），同一对象只计一次"""
+    seen, stack, total = set(), [obj], 0
+    while stack and len(seen) < max_objects:
+        item = stack.pop()
+        if id(item) in seen or isinstance(item, (type, type(sys), type(approx_size))):
+            continue
+        seen.add(id(item))
+        try:
+            total += sys.getsizeof(item)
+        except TypeError:
+            continue
+        if isinstance(item, (str, bytes, bytearray, int, float, bool)) or item is None:
+            continue
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)) or type(item).__name__ == "deque":
+            stack.extend(item)
+        else:
+            if hasattr(item, "__dict__"):
+                stack.append(vars(item))
+            for slot in getattr(type(item), "__slots__", ()):
+                if hasattr(item, slot):
+                    stack.append(getattr(item, slot))
+    return total
+
+
+def process_memory() -> dict:
+    """当前进程的 RSS 与峰值 RSS（字节）；取不到时为 None"""
+    try:
+        import psutil  # 可选依赖，Windows 上靠它取 RSS
+        info = psutil.Process().memory_info()
+        return {"rss_bytes": info.rss, "peak_rss_bytes": getattr(info, "peak_wset", None)}
+    except ImportError:
+        pass
+    rss = peak = None
+    try:
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = maxrss if sys.platform == "darwin" else maxrss * 1024
+    except ImportError:
+        pass
+    return {"rss_bytes": rss, "peak_rss_bytes": peak}
+
+
+class _Component:
+    __slots__ = ("name", "report", "evict", "evict_session")
+
+    def __init__(self, name, report, evict, evict_session):
+        self.name = name
+        self.report = report
+        self.evict = evict
+        self.evict_session = evict_session
+
+
+class SessionSizes:
+    """
+    记录不在服务端容器里的按会话数据的大小（如 Gradio gr.State 中的 chat_history），由调用方在每轮结束时更新。
+    最多记录 max_sessions 个会话，超过时丢弃最久没有更新的（记录本身不能成为泄漏）。
+    """
+    def __init__(self, max_sessions: int = 10000):
+        self._sizes = OrderedDict()  # session_id -> (字节数, 浏览器会话标识)
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+
+    def record(self, session_id: str, value, client: str = None):
+        size = approx_size(value)
+        with self._lock:
+            self._sizes[session_id] = (size, client)
+            self._sizes.move_to_end(session_id)
+            while len(self._sizes) > self.max_sessions:
+                self._sizes.popitem(last=False)
+
+    def forget(self, session_id: str):
+        with self._lock:
+            self._sizes.pop(session_id, None)
+
+    def forget_client(self, client: str):
+        """浏览器页面关闭：忘记该页面记录的所有会话"""
+        with self._lock:
+            for session_id in [s for s, (_, c) in self._sizes.items() if c == client]:
+                del self._sizes[session_id]
+
+    def report(self) -> dict:
+        with self._lock:
+            sessions = {s: size for s, (size, _) in self._sizes.items()}
+        return {"bytes": sum(sessions.values()), "items": len(sessions), "sessions": sessions}
+
+
+class MemoryAccountant:
+    def __init__(self):
+        self._components = {}
+        self._lock = threading.Lock()
+        self._baseline = None
+        self._thread = None
+        self._last_evict = None  # (时间, 当时的 RSS)
+        self.last_check = None
+
+    def register(self, name: str, report, evict=None, evict_session=None):
+        """
+        :param report: () -> {"bytes": 估计字节数, "items": 条目数, "sessions": {会话ID: 字节数}（可选）, ...}
+        :param evict: (目标释放比例 0~1) -> 描述回收结果的 dict，RSS 超过高水位时调用
+        :param evict_session: (会话ID) -> None，单个会话超过上限时调用
+        """
+        with self._lock:
+            self._components[name] = _Component(name, report, evict, evict_session)
+
+    def _collect(self):
+        with self._lock:
+            components = list(self._components.values())
+        results = {}
+        for c in components:
+            start = time.perf_counter()
+            try:
+                results[c.name] = dict(c.report())
+            except Exception as e:
+                logger.warning("内存统计 %s 出错: %s", c.name, e)
+                results[c.name] = {"error": str(e)}
+            results[c.name]["report_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return results
+
+    def report(self, top: int = 20) -> dict:
+        components = self._collect()
+        sessions = {}
+        for name, data in components.items():
+            for session_id, size in (data.pop("sessions", None) or {}).items():
+                entry = sessions.setdefault(session_id, {"bytes": 0})
+                entry[name] = size
+                entry["bytes"] += size
+        largest = sorted(sessions.items(), key=lambda item: item[1]["bytes"], reverse=True)[:top]
+        return {
+            "process": process_memory(),
+            "components": components,
+            "total_estimated_bytes": sum(d.get("bytes", 0) for d in components.values()),
+            "sessions": {"count": len(sessions), "largest": [{"session": s, **v} for s, v in largest]},
+            "thresholds": {"high_water_mb": HIGH_WATER_MB, "session_max_kb": SESSION_MAX_KB},
+            "tracemalloc": tracemalloc.is_tracing(),
+            "last_check": self.last_check,
+        }
+
+    def check(self, high_water_mb: float = HIGH_WATER_MB, session_max_kb: float = SESSION_MAX_KB) -> dict:
+        """更新内存指标；超过高水位时告警并回收"""
+        report = self.report(top=100)
+        rss = report["process"]["rss_bytes"]
+        if rss is not None:
+            metrics.set_gauge("process_rss_bytes", rss)
+        for name, data in report["components"].items():
+            metrics.set_gauge("memory_estimated_bytes", data.get("bytes", 0), component=name)
+            metrics.set_gauge("memory_items", data.get("items", 0), component=name)
+        actions = {}
+        if high_water_mb and rss is not None and rss > high_water_mb * 1024 * 1024:
+            metrics.inc("memory_high_water")
+            if self._cooling_down(rss):
+                logger.info("进程内存 %.0fMB 仍高于高水位 %.0fMB，距上次回收不足 %.0fs，暂不回收",
+                            rss / 1024 / 1024, high_water_mb, EVICT_COOLDOWN)
+                actions["evict_skipped"] = "cooldown"
+            else:
+                pressure = min(1.0, (rss - high_water_mb * 1024 * 1024) / rss + 0.25)
+                logger.warning("进程内存 %.0fMB 超过高水位 %.0fMB，开始回收（比例 %.2f）",
+                               rss / 1024 / 1024, high_water_mb, pressure)
+                self._last_evict = (time.time(), rss)
+                actions["evicted"] = self._evict(pressure)
+        if session_max_kb:
+            oversized = [s for s in report["sessions"]["largest"] if s["bytes"] > session_max_kb * 1024]
+            for entry in oversized:
+                logger.warning("会话 %s 占用约 %.0fKB，超过上限 %.0fKB，回收其缓存",
+                               entry["session"], entry["bytes"] / 1024, session_max_kb)
+                metrics.inc("memory_session_over_limit")
+                self._evict_session(entry["session"])
+            if oversized:
+                actions["oversized_sessions"] = [e["session"] for e in oversized]
+        self.last_check = {"at": time.time(), "rss_bytes": rss, "actions": actions}
+        return self.last_check
+
+    def _cooling_down(self, rss: int) -> bool:
+        if self._last_evict is None:
+            return False
+        at, evicted_rss = self._last_evict
+        return time.time() - at < EVICT_COOLDOWN and rss <= evicted_rss * EVICT_REGROWTH
+
+    def _evict(self, pressure: float) -> dict:
+        with self._lock:
+            components = [c for c in self._components.values() if c.evict is not None]
+        results = {}
+        for c in components:
+            try:
+                results[c.name] = c.evict(pressure)
+            except Exception as e:
+                logger.warning("回收 %s 出错: %s", c.name, e)
+        return results
+
+    def _evict_session(self, session_id: str):
+        with self._lock:
+            components = [c for c in self._components.values() if c.evict_session is not None]
+        for c in components:
+            try:
+                c.evict_session(session_id)
+            except Exception as e:
+                logger.warning("回收会话 %s 的 %s 出错: %s", session_id, c.name, e)
+
+    def start(self, interval: float = CHECK_INTERVAL):
+        """后台定期检查（interval 为 0 时不启动）"""
+        if not interval or self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check()
+                except Exception:
+                    logger.exception("内存检查出错")
+
+        self._thread = threading.Thread(target=loop, name="memory-check", daemon=True)
+        self._thread.start()
+
+    # ---------- tracemalloc ----------
+    @staticmethod
+    def _take_snapshot():
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc 未开启，请先 POST /memory/tracemalloc/start")
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+
+    @staticmethod
+    def _format_stat(stat, diff: bool = False) -> dict:
+        frames = [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback]
+        row = {"where": frames[0] if len(frames) == 1 else frames, "size_bytes": stat.size, "count": stat.count}
+        if diff:
+            row.update(size_diff_bytes=stat.size_diff, count_diff=stat.count_diff)
+        return row
+
+    def tracemalloc_start(self, frames: int = 25) -> dict:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        return {"tracing": True, "frames": tracemalloc.get_traceback_limit()}
+
+    def tracemalloc_stop(self) -> dict:
+        tracemalloc.stop()
+        self._baseline = None
+        return {"tracing": False}
+
+    def tracemalloc_snapshot(self, top: int = 30, group: str = "lineno") -> dict:
+        snapshot = self._take_snapshot()
+        self._baseline = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        return {"traced_bytes": current, "traced_peak_bytes": peak,
+                "top": [self._format_stat(s) for s in snapshot.statistics(group)[:top]]}
+
+    def tracemalloc_diff(self, top: int = 30, group: str = "lineno", reset: bool = False) -> dict:
+        if self._baseline is None:
+            raise RuntimeError("还没有基线，请先访问 /memory/tracemalloc/snapshot")
+        snapshot = self._take_snapshot()
+        stats = snapshot.compare_to(self._baseline, group)
+        if reset:
+            self._baseline = snapshot
+        return {"total_diff_bytes": sum(s.size_diff for s in stats),
+                "top": [self._format_stat(s, diff=True) for s in stats[:top]]}
+
+
+memory = MemoryAccountant()
+# Gradio gr.State 中的 chat_history 保存在 Gradio 的会话状态里（服务端无法回收，只统计），每轮结束时按会话记录大小
+chat_histories = SessionSizes()
+memory.register("chat_history", chat_histories.report)
+
+
+def _query(handler) -> dict:
+    return {k: v[-1] for k, v in parse_qs(urlsplit(handler.path).query).items()}
+
+
+def _register_routes():
+    from metrics_server import MetricsHandler
+
+    def tracemalloc_route(action):
+        def route(handler):
+            q = _query(handler)
+            top, group = int(q.get("top", 30)), q.get("group", "lineno")
+            if action == "start":
+                return memory.tracemalloc_start(int(q.get("frames", 25)))
+            if action == "stop":
+                return memory.tracemalloc_stop()
+            if action == "snapshot":
+                return memory.tracemalloc_snapshot(top, group)
+            return memory.tracemalloc_diff(top, group, reset=q.get("reset") == "1")
+        return route
+
+    MetricsHandler.routes["/memory.json"] = lambda handler: memory.report(int(_query(handler).get("top", 20)))
+    for action in ("start", "stop"):
+        MetricsHandler.post_routes[f"/memory/tracemalloc/{action}"] = tracemalloc_route(action)
+    for action in ("snapshot", "diff"):
+        MetricsHandler.routes[f"/memory/tracemalloc/{action}"] = tracemalloc_route(action)
+
+
+_register_routes()
@@ -0,0 +1,79 @@
+"""
+本地指标服务，与 Gradio 应用运行在同一进程中：
+    GET /metrics        Prometheus 文本格式
+    GET /metrics.json   JSON 格式（每个阶段的 count/avg/p50/p95/p99 和计数器）
+会改变进程状态的管理操作注册到 post_routes，只接受 POST。
+默认只监听 127.0.0.1，端口由 METRICS_PORT 配置（默认 9464，设为 0 关闭）。
+"""
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tracing import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # 其他模块可以注册额外的路由：path -> 返回 dict 的函数；routes 只读（GET），post_routes 会改变状态（POST）
+    routes = {}
+    post_routes = {}
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            self._send(200, metrics.render_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+        elif path == "/metrics.json":
+            self._send_json(metrics.snapshot())
+        elif path in self.routes:
+            self._dispatch(self.routes[path], path)
+        elif path in self.post_routes:
+            self._send(405, "use POST\n", "text/plain; charset=utf-8")
+        else:
+            self._send(404, "not found\n", "text/plain; charset=utf-8")
+
+    def do_POST(self):
+        path = self.path.split("?", 1)[0]
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)  # 参数都在查询串里，请求体丢弃
+        if path in self.post_routes:
+            self._dispatch(self.post_routes[path], path)
+        else:
+            self._send(404, "not found\n", "text/plain; charset=utf-8")
+
+    def _dispatch(self, route, path: str):
+        try:
+            self._send_json(route(self))
+        except Exception as e:
+            logger.exception("指标接口 %s 出错", path)
+            self._send_json({"error": str(e)}, 500)
+
+    def _send_json(self, data, status: int = 200):
+        self._send(status, json.dumps(data, ensure_ascii=False, default=str), "application/json; charset=utf-8")
+
+    def _send(self, status: int, body: str, content_type: str):
+        payload = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics %s", format % args)
+
+
+def start_metrics_server(port: int = None, host: str = "127.0.0.1"):
+    """在后台线程中启动指标服务，返回 server（端口为 0 时不启动，返回 None）"""
+    if port is None:
+        port = int(os.getenv("METRICS_PORT", "9464"))
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info("指标服务已启动: http://%s:%s/metrics", host, port)
+    return server
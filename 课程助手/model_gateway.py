@@ -0,0 +1,410 @@
+"""
+模型网关：在多个 OpenAI 兼容的模型服务之间做截止时间、重试、熔断和对冲请求。
+    主服务    DashScope qwen-max（DASHSCOPE_BASE_URL / DASHSCOPE_API_KEY）
+    备用服务  DeepSeek（DEEPSEEK_BASE_URL，默认 https://api.deepseek.com/v1；密钥 deepseek_api_key；
+              模型 DEEPSEEK_MODEL，默认 deepseek-chat）
+每次调用：
+    - 截止时间：首 token 须在 GATEWAY_TTFT_TIMEOUT 秒内到达（默认 20），整次调用不超过 GATEWAY_DEADLINE 秒（默认 120）
+    - 首 token 之前失败时按指数退避 + 随机抖动重试（GATEWAY_RETRIES 次，默认 2）；已经输出了内容就不再重试
+    - 每个服务一个熔断器：连续失败 GATEWAY_BREAKER_FAILURES 次（默认 5）后熔断 GATEWAY_BREAKER_COOLDOWN 秒（默认 30），
+      冷却后放行一个试探请求，成功则恢复
+    - 对冲：首 token 超过主服务近期首 token 时间的 GATEWAY_HEDGE_PERCENTILE 分位（默认 0.95）仍未到达时，
+      同时向备用服务发出同样的请求，先出首 token 的一方胜出，另一方的 HTTP 连接立即关闭（释放调度槽位）；
+      主服务直接报错时立即切换到备用服务。
+      被关闭或超时的请求按已等待的时间记入首 token 统计（删失样本），否则只统计胜出方会让对冲越来越早触发。
+      样本不足 GATEWAY_HEDGE_MIN_SAMPLES（默认 20）时用 GATEWAY_HEDGE_DELAY_MS（默认 3000）
+所在轮次被取消时立即结束：不重试、不对冲，也不记为服务失败。
+配置了备用服务的密钥时 llm_registry.get_chat_model 返回网关模型，否则直接返回 ChatOpenAI（MODEL_GATEWAY=0 强制关闭）。
+指标：model_ttft（按服务）、gateway_retries、gateway_failover、gateway_hedges、gateway_hedge_wins、gateway_breaker_open。
+"""
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, List
+
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from cancellation import CancelToken, TurnCancelled, bound, current_token
+from scheduler import current as current_schedule, scheduling
+from tracing import metrics
+
+logger = logging.getLogger(__name__)
+
+TTFT_TIMEOUT = float(os.getenv("GATEWAY_TTFT_TIMEOUT", "20"))
+DEADLINE = float(os.getenv("GATEWAY_DEADLINE", "120"))
+RETRIES = int(os.getenv("GATEWAY_RETRIES", "2"))
+BACKOFF_BASE = float(os.getenv("GATEWAY_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.getenv("GATEWAY_BACKOFF_MAX", "4"))
+BREAKER_FAILURES = int(os.getenv("GATEWAY_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("GATEWAY_BREAKER_COOLDOWN", "30"))
+HEDGE = os.getenv("GATEWAY_HEDGE", "1") == "1"
+HEDGE_PERCENTILE = float(os.getenv("GATEWAY_HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("GATEWAY_HEDGE_MIN_SAMPLES", "20"))
+HEDGE_DELAY_MS = float(os.getenv("GATEWAY_HEDGE_DELAY_MS", "3000"))
+
+
+class GatewayError(Exception):
+    """所有服务都失败、熔断或超过截止时间"""
+
+
+class CircuitBreaker:
+    """连续失败达到阈值后熔断；冷却结束进入半开状态，只放行一个试探请求"""
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+                self._trial = False
+            if self.state == "half_open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state, self.failures, self._trial = "closed", 0, False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                metrics.inc("gateway_breaker_open", provider=self.name)
+                logger.warning("模型服务 %s 已熔断 %.0f 秒", self.name, self.cooldown)
+
+    def abandon(self):
+        """请求被对冲取消，既不算成功也不算失败；半开状态下允许再放行一个试探请求"""
+        with self._lock:
+            self._trial = False
+
+
+class LatencyWindow:
+    """最近的首 token 时间（毫秒），用于计算对冲的触发点"""
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, ms: float):
+        with self._lock:
+            self._samples.append(ms)
+
+    def percentile(self, q: float, default: float, min_samples: int = HEDGE_MIN_SAMPLES) -> float:
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < min_samples:
+            return default
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class Provider:
+    """一个 OpenAI 兼容的模型服务：熔断器和首 token 时间统计在所有网关模型之间共享"""
+    def __init__(self, name: str, model: str, base_url: str, api_key_env: str):
+        self.name = name
+        self.model = model
+        self.base_url = base_url
+        self.api_key_env = api_key_env
+        self.breaker = CircuitBreaker(name)
+        self.ttft = {True: LatencyWindow(), False: LatencyWindow()}  # 按是否流式分开统计
+
+    @property
+    def configured(self) -> bool:
+        return bool(os.getenv(self.api_key_env))
+
+    def chat_model(self, model: str = None, **params):
+        from llm_registry import get_provider_model
+        # 重试由网关负责，客户端自身不再重试
+        return get_provider_model(model or self.model, base_url=self.base_url, api_key_env=self.api_key_env,
+                                  max_retries=0, **params)
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(name: str) -> Provider:
+    with _providers_lock:
+        if name not in _providers:
+            if name == "dashscope":
+                from llm_registry import DEFAULT_BASE_URL, DEFAULT_API_KEY_ENV
+                _providers[name] = Provider(name, "qwen-max", DEFAULT_BASE_URL, DEFAULT_API_KEY_ENV)
+            elif name == "deepseek":
+                _providers[name] = Provider(name, os.getenv("DEEPSEEK_MODEL", "deepseek-chat"),
+                                            os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1"),
+                                            "deepseek_api_key")
+            else:
+                raise ValueError(f"未知的模型服务: {name}")
+        return _providers[name]
+
+
+def gateway_enabled() -> bool:
+    return os.getenv("MODEL_GATEWAY", "1") == "1" and get_provider("deepseek").configured
+
+
+def provider_stats() -> dict:
+    return {name: {"state": p.breaker.state, "failures": p.breaker.failures,
+                   "hedge_delay_ms": p.ttft[True].percentile(HEDGE_PERCENTILE, HEDGE_DELAY_MS)}
+            for name, p in sorted(_providers.items())}
+
+
+class _Attempt:
+    """
+    一次发往某个服务的请求，在后台线程中运行，结果放入共享队列。
+    请求的 HTTP 响应登记在自己的取消令牌上：stop() 时关闭连接，线程不必等到下一个 token 才退出；
+    所在轮次被取消时也一起停止。
+    """
+    def __init__(self, provider: Provider, model, hedge: bool = False):
+        self.provider = provider
+        self.model = model
+        self.hedge = hedge
+        self.started = time.monotonic()
+        self.stopped = threading.Event()
+        self.finished = False
+        self.token = CancelToken(record=False)
+
+    def stop(self, reason: str = "stopped"):
+        self.stopped.set()
+        self.token.cancel(reason)
+
+    def start(self, messages, stop, kwargs, streaming: bool, results: queue.Queue):
+        user, priority = current_schedule()
+        turn = current_token()
+        if turn is not None:
+            turn.on_cancel(self.stop)
+
+        def run():
+            # 新线程没有调用方的上下文，模型调用仍记在原用户名下排队
+            with scheduling(user, priority), bound(self.token):
+                try:
+                    if streaming:
+                        stream = self.model.stream(messages, stop=stop, **kwargs)
+                        try:
+                            for chunk in stream:
+                                if self.stopped.is_set():
+                                    return
+                                results.put((self, "item", chunk))
+                        finally:
+                            stream.close()
+                    else:
+                        results.put((self, "item", self.model.invoke(messages, stop=stop, **kwargs)))
+                    results.put((self, "done", None))
+                except Exception as e:
+                    if not self.stopped.is_set():
+                        results.put((self, "error", e))
+
+        threading.Thread(target=run, name=f"gateway-{self.provider.name}", daemon=True).start()
+        return self
+
+
+class _BeforeFirstToken(Exception):
+    """首 token 之前失败（可以重试）"""
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
+
+class GatewayChatModel(BaseChatModel):
+    """按 routes 顺序（主服务在前）调用的聊天模型，接口与 ChatOpenAI 相同"""
+    routes: List[Any]              # [(Provider, 模型参数 dict)]
+    streaming: bool = False
+    hedge: bool = HEDGE
+    retries: int = RETRIES
+    ttft_timeout: float = TTFT_TIMEOUT
+    deadline: float = DEADLINE
+
+    @property
+    def _llm_type(self) -> str:
+        return "model-gateway"
+
+    def bind_tools(self, tools, **kwargs):
+        from langchain_core.utils.function_calling import convert_to_openai_tool
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], **kwargs)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.streaming:
+            return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+        message = next(self._call(messages, stop, kwargs, streaming=False))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for chunk in self._call(messages, stop, kwargs, streaming=True):
+            generation = ChatGenerationChunk(message=chunk)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.content if isinstance(chunk.content, str) else "", chunk=generation)
+            yield generation
+
+    def _call(self, messages, stop, kwargs, streaming: bool):
+        """带重试的调用：首 token 之前失败时退避后重试，重试时跳过已熔断的服务"""
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        turn = current_token()
+        while True:
+            # 轮次已取消（包括退避期间）：不再发出请求
+            if turn is not None:
+                turn.raise_if_cancelled()
+            routes = [(p, params) for p, params in self.routes if p.breaker.allow()]
+            if not routes:
+                raise GatewayError("所有模型服务都处于熔断状态，请稍后再试")
+            try:
+                yield from self._race(routes, messages, stop, kwargs, streaming, deadline)
+                return
+            except _BeforeFirstToken as e:
+                attempt += 1
+                remaining = deadline - time.monotonic()
+                if attempt > self.retries or remaining <= 0:
+                    raise e.error
+                delay = min(BACKOFF_BASE * 2 ** (attempt - 1), BACKOFF_MAX) * random.uniform(0.5, 1.5)
+                metrics.inc("gateway_retries")
+                logger.warning("模型调用失败，%.2f 秒后重试（第 %d 次）: %s", delay, attempt, e.error)
+                time.sleep(min(delay, remaining))
+
+    def _race(self, routes, messages, stop, kwargs, streaming, deadline):
+        """向主服务发请求，首 token 迟迟不到或主服务报错时启用备用服务，先出首 token 的一方胜出"""
+        results = queue.Queue()
+        turn = current_token()
+        if turn is not None:
+            # 轮次取消时各请求被 stop()，不会再放入结果；放一个标记唤醒下面的等待
+            turn.on_cancel(lambda: results.put((None, "cancelled", None)))
+        primary, primary_params = routes[0]
+        backups = list(routes[1:])
+        attempts = [_Attempt(primary, primary.chat_model(**primary_params)).start(messages, stop, kwargs, streaming, results)]
+        start = time.monotonic()
+        first_deadline = min(start + self.ttft_timeout, deadline)
+        hedge_at = None
+        if self.hedge and backups:
+            hedge_at = start + primary.ttft[streaming].percentile(HEDGE_PERCENTILE, HEDGE_DELAY_MS) / 1000
+        error = None
+
+        def launch_backup(hedge: bool):
+            provider, params = backups.pop(0)
+            attempts.append(_Attempt(provider, provider.chat_model(**params), hedge=hedge)
+                            .start(messages, stop, kwargs, streaming, results))
+
+        def abandon_all():
+            # 轮次被取消：关闭所有请求，不算服务失败，也不记首 token 样本
+            for a in attempts:
+                if not a.finished:
+                    a.stop("cancelled")
+                    a.provider.breaker.abandon()
+            raise TurnCancelled(turn.reason)
+
+        try:
+            # 1. 等待首 token
+            while True:
+                if turn is not None and turn.cancelled:
+                    abandon_all()
+                now = time.monotonic()
+                if hedge_at is not None and now >= hedge_at and backups:
+                    metrics.inc("gateway_hedges", provider=primary.name)
+                    launch_backup(hedge=True)
+                    hedge_at = None
+                alive = [a for a in attempts if not a.finished]
+                if not alive:
+                    raise _BeforeFirstToken(error)
+                wait = first_deadline - now
+                if hedge_at is not None and backups:
+                    wait = min(wait, hedge_at - now)
+                if first_deadline - now <= 0:
+                    for a in alive:
+                        a.stop("ttft_timeout")
+                        a.provider.breaker.failure()
+                        a.provider.ttft[streaming].add((now - a.started) * 1000)
+                    raise _BeforeFirstToken(TimeoutError(f"{self.ttft_timeout:.0f} 秒内没有收到模型的首个 token"))
+                try:
+                    attempt, kind, payload = results.get(timeout=max(wait, 0.001))
+                except queue.Empty:
+                    continue
+                if kind == "cancelled":
+                    abandon_all()
+                if kind == "error":
+                    attempt.finished = True
+                    attempt.provider.breaker.failure()
+                    error = payload
+                    logger.warning("模型服务 %s 调用失败: %s", attempt.provider.name, payload)
+                    if backups:
+                        # 主服务直接报错：不等对冲时间，立即切换
+                        metrics.inc("gateway_failover", provider=attempt.provider.name)
+                        launch_backup(hedge=False)
+                    continue
+                winner = attempt
+                break
+
+            ttft_ms = (time.monotonic() - winner.started) * 1000
+            winner.provider.ttft[streaming].add(ttft_ms)
+            winner.provider.breaker.success()
+            metrics.observe("model_ttft", ttft_ms, provider=winner.provider.name, streaming=str(streaming).lower())
+            if winner.hedge:
+                metrics.inc("gateway_hedge_wins", provider=winner.provider.name)
+            for a in attempts:
+                if a is not winner and not a.finished:
+                    # 输掉的一方：立即关闭连接；它的首 token 至少要这么久，作为删失样本记入
+                    a.stop("hedge_lost")
+                    a.provider.breaker.abandon()
+                    a.provider.ttft[streaming].add((time.monotonic() - a.started) * 1000)
+
+            # 2. 继续读取胜出方的输出
+            completed = False
+            try:
+                if kind == "item":
+                    yield payload
+                else:
+                    completed = True
+                    return
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise GatewayError(f"模型调用超过截止时间 {self.deadline:.0f} 秒")
+                    try:
+                        attempt, kind, payload = results.get(timeout=remaining)
+                    except queue.Empty:
+                        continue
+                    if kind == "cancelled":
+                        raise TurnCancelled(turn.reason)
+                    if attempt is not winner:
+                        continue
+                    if kind == "done":
+                        completed = True
+                        return
+                    if kind == "error":
+                        winner.provider.breaker.failure()
+                        raise payload
+                    yield payload
+            finally:
+                if completed:
+                    winner.stopped.set()
+                else:
+                    # 调用方提前关闭、出错或超过截止时间：关闭胜出方的连接
+                    winner.stop("closed")
+        finally:
+            # 没有用上的备用服务：归还半开熔断器的试探名额
+            for provider, _ in backups:
+                provider.breaker.abandon()
+
+
+def get_gateway_model(model: str = "qwen-max", *, temperature: float = None, streaming: bool = False, **kwargs):
+    """主服务为 DashScope 上的 model，备用服务为 DeepSeek"""
+    params = dict(kwargs, streaming=streaming)
+    if temperature is not None:
+        params["temperature"] = temperature
+    routes = [(get_provider("dashscope"), dict(params, model=model))]
+    backup = get_provider("deepseek")
+    if backup.configured:
+        routes.append((backup, params))
+    return GatewayChatModel(routes=routes, streaming=streaming)
@@ -49,6 +49,9 @@ class ToolManager:
                 lines = (line.strip() for line in text.splitlines())
                 chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
                 text = '\n'.join(chunk for chunk in chunks if chunk)
+                # 完整正文写入本会话的网页缓存，追问时不必重新抓取（返回给 Agent 的仍是截断后的内容）
+                from web_cache import remember
+                remember(url, soup.title.string.strip() if soup.title and soup.title.string else url, text)
                 return text[:3000] + "\n\n[内容已截断...]" if len(text) > 3000 else text
             else:
                 return response.text[:3000] + "\n\n[HTML内容已截断...]" if len(response.text) > 3000 else response.text
@@ -1,49 +1,261 @@
 import os
+import json
 import uuid
+import time
+import logging
+import weakref
 from typing import List, Dict
-from langchain.vectorstores import Chroma
-from langchain.embeddings import DashScopeEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader, CSVLoader
-from langchain.chains import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.prompts import ChatPromptTemplate,MessagesPlaceholder
-from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
+from lazy_loader import lazy_property, is_loaded
+from chain_registry import ChainRegistry, get_configurable
+from tracing import span, metrics, sampled, trace_stream, TracedEmbeddings
+from chunkers import sentence_pieces
+from cancellation import TurnCancelled
+from scheduler import scheduling, BULK
+from retrieval_config import load_retrieval_config, fuse
 load_dotenv(r"课程助手/lna.env")
-class RAGProcess:
-    def __init__(self, persist_directory="课程助手/course_knowledge_base"):
-        self.embeddings = DashScopeEmbeddings(
-            dashscope_api_key=os.getenv("DASHSCOPE_API_KEY")
-        )
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200
-        )
 
+logger = logging.getLogger(__name__)
+# 进程内的 RAGProcess 实例（弱引用），供内存统计汇总已打开的向量库
+_instances = weakref.WeakSet()
+
+RAG_SYSTEM_PROMPT = (
+    """
+        你是一个课程助手，请根据以下上下文信息回答问题。如果信息不足，请说明。
+        不要直接复制上下文，而是根据上下文信息进行推理和回答。
+        不要编造答案，只能根据上下文信息进行回答。
+        如果用户提问了与文档内容无关的问题，忽略他的问题并回答：“我是课程咨询助手，请不要提与课程内容无关的问题”
+        并根据用户问题的意图推荐用户切换“联网查询”或者“普通对话”模式，语气稍微耐心一些。
+        回答尽可能简洁明了，注意文字排版要美观，不要一行就几个字。
+    """
+    "Context: {context}"
+)
+
+
+def _label_source(doc, label: str):
+    """把 source 标成来源库名，原来的文件路径保存在 source_file（上下文组装按它判断块是否来自同一文件）"""
+    if doc.metadata.get("source") != label:
+        doc.metadata.setdefault("source_file", doc.metadata.get("source"))
+    doc.metadata["source"] = label
+
+# LangChain / Chroma / DashScope 相关依赖均在首次使用时导入，
+# 向量库与 embedding 客户端也在首次使用时才创建（或通过 warm_up 提前创建）
+class RAGProcess:
+    def __init__(self, persist_directory="课程助手/course_knowledge_base",
+                 upload_directory="课程助手/user_uploads", embeddings=None, retrieval=None):
+        """
+        :param persist_directory: 向量库根目录（course_db / user_db 位于其下）
+        :param upload_directory: 上传文件的保存目录
+        :param embeddings: 指定 embedding 模型（如离线基准测试用的假模型），默认按 EMBEDDING_BACKEND 选择（见 embedding_backends.py）
+        :param retrieval: 检索参数（RetrievalConfig），默认读取离线调参的结果（见 retrieval_config.py）
+        """
+        self.retrieval = retrieval or load_retrieval_config()
+        self.persist_directory = persist_directory
         # 固定的本地课程知识库
         self.course_kb_path = os.path.join(persist_directory, "course_db")
-        self.course_vector_store = self._init_course_kb()
+        # 紧凑索引（COURSE_STORE=compact 时使用）：课程库导出的 mmap 矩阵
+        self.course_index_path = os.path.join(persist_directory, "course_index")
+        self.faq_index_path = os.path.join(persist_directory, "faq_index.json")
 
         # 用户上传文档的存储路径
-        self.upload_directory = "课程助手/user_uploads"
+        self.upload_directory = upload_directory
         self.user_kb_path = os.path.join(persist_directory, "user_db")
-        self.user_vector_store = self._init_user_kb()
 
         # 确保目录存在
         os.makedirs(self.upload_directory, exist_ok=True)
+        # 预编译的 RAG 链，按检索来源缓存
+        self.chains = ChainRegistry()
+        if embeddings is not None:
+            self.__dict__["embeddings"] = TracedEmbeddings(embeddings)
+        _instances.add(self)
+
+    @lazy_property
+    def embeddings(self):
+        from embedding_backends import get_embeddings, check_store_backend
+        embeddings = get_embeddings()
+        # 库中的向量必须来自同一个后端，否则检索结果没有意义
+        check_store_backend(self.persist_directory, embeddings)
+        return TracedEmbeddings(embeddings)
+
+    @lazy_property
+    def text_splitter(self):
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+        splitter = RecursiveCharacterTextSplitter(
+            chunk_size=self.retrieval.chunk_size,
+            chunk_overlap=self.retrieval.chunk_overlap
+        )
+        if self.retrieval.chunking == "recursive":
+            return splitter
+        # 按文件类型和结构选择分块器（问答对、章节、表格、中文句子），其余文本仍用上面的通用分块器
+        from chunkers import StructureAwareSplitter
+        return StructureAwareSplitter(fallback=splitter)
+
+    @lazy_property
+    def faq_index(self):
+        """课程 FAQ 直答索引（见 faq_index.py），在 load_course_documents 时增量写入；文件不存在时从课程库建立"""
+        from faq_index import FAQIndex
+        index = FAQIndex(self.faq_index_path, self.embeddings)
+        if not index.exists() and os.path.exists(self.course_kb_path):
+            with scheduling(user="course_admin", priority=BULK):
+                count = index.build(self._course_qa_pairs())
+            logger.info("FAQ 索引不存在，已从课程库建立: %d 条", count)
+        return index
+
+    def _course_qa_pairs(self) -> Dict[str, List]:
+        """从课程库收集问答对 {来源: [(问题, 答案)]}：
+        按问答对分块的片段直接拼回答案；早期按通用分块入库的，重新解析仍在磁盘上的 FAQ 源文件"""
+        from chunkers import QAPairChunker, parse_qa_pairs
+        data = self.course_chroma._collection.get(include=["documents", "metadatas"])
+        answers, files = {}, set()
+        for text, meta in zip(data["documents"], data["metadatas"]):
+            meta = meta or {}
+            source = meta.get("source", "")
+            if meta.get("chunk_type") == QAPairChunker.name and meta.get("question"):
+                # 长答案被切成多段，每段都是"问题：…\n答案：…"，按入库顺序拼接
+                part = text.split("答案：", 1)[-1]
+                answers.setdefault(source, {}).setdefault(meta["question"], []).append(part)
+            elif source:
+                files.add(source)
+        pairs = {source: [(q, "".join(parts)) for q, parts in by_question.items()]
+                 for source, by_question in answers.items()}
+        for source in sorted(files - set(pairs)):
+            if not os.path.isfile(source):
+                continue
+            with open(source, encoding="utf-8", errors="ignore") as f:
+                content = f.read()
+            if QAPairChunker.detect(content):
+                pairs[source] = parse_qa_pairs(content)
+        return pairs
+
+    @lazy_property
+    def csv_tables(self):
+        """上传 CSV 导入的按用户隔离的 SQLite 表（见 csv_query.py）"""
+        from csv_query import CSVTableStore, CSV_DB_PATH
+        return CSVTableStore(os.getenv("CSV_DB_PATH", CSV_DB_PATH))
+
+    @lazy_property
+    def uploads(self):
+        """上传的配额、过期与孤儿回收（见 upload_lifecycle.py）"""
+        from upload_lifecycle import UploadLifecycle
+        return UploadLifecycle(self, os.getenv("UPLOADS_DB_PATH", os.path.join(self.persist_directory, "uploads.db")),
+                               self.upload_directory)
+
+    @lazy_property
+    def course_vector_store(self):
+        return self._init_course_kb()
+
+    @lazy_property
+    def course_chroma(self):
+        """课程库的 Chroma：默认直接用于检索；COURSE_STORE=compact 时是紧凑索引的数据源"""
+        from langchain.vectorstores import Chroma
+        return Chroma(persist_directory=self.course_kb_path, embedding_function=self.embeddings)
+
+    @lazy_property
+    def user_vector_store(self):
+        return self._init_user_kb()
+
+    @lazy_property
+    def user_writes(self):
+        """用户库的写入协调器：并发上传的写入合并提交，每组只 persist 一次（见 write_coordinator.py）"""
+        from write_coordinator import VectorWriteCoordinator
+        return VectorWriteCoordinator(self.user_vector_store, self.embeddings, name="user_writes")
+
+    @lazy_property
+    def course_writes(self):
+        """课程库的写入协调器：紧凑索引模式下写入数据源 Chroma，写完由 refresh_course_index 重新导出"""
+        from write_coordinator import VectorWriteCoordinator
+        store = self.course_chroma if self._compact_course() else self.course_vector_store
+        return VectorWriteCoordinator(store, self.embeddings, name="course_writes")
+
+    @lazy_property
+    def batched_search(self):
+        """各向量库的微批检索器（RETRIEVAL_BATCHING=1 时启用，见 batching.py）"""
+        from batching import BatchedSearch
+        return {
+            "course": BatchedSearch(self.course_vector_store, self.embeddings, name="retrieval_course"),
+            "user": BatchedSearch(self.user_vector_store, self.embeddings, name="retrieval_user"),
+        }
+
+    def search(self, store: str, query: str, k: int, filter: dict = None) -> List:
+        """
+        检索课程库('course')或用户库('user')。开启微批时，并发到达的查询合并成一次 embedding 请求和一次矩阵检索。
+        """
+        if os.getenv("RETRIEVAL_BATCHING", "0") == "1":
+            return self.batched_search[store].similarity_search(query, k=k, filter=filter)
+        vector_store = self.course_vector_store if store == "course" else self.user_vector_store
+        if filter:
+            return vector_store.similarity_search(query, k=k, filter=filter)
+        return vector_store.similarity_search(query, k=k)
+
+    def warm_up(self):
+        """预热：提前打开两个向量库和 FAQ 索引并创建 embedding 客户端，返回各部分耗时（毫秒）"""
+        timings = {}
+        # faq_index 放在最后：索引文件缺失时在这里建立，而不是留给第一个提问的用户
+        for name in ("embeddings", "course_vector_store", "user_vector_store", "faq_index"):
+            start = time.perf_counter()
+            getattr(self, name)
+            timings[name] = (time.perf_counter() - start) * 1000
+        return timings
+
+    def loaded_components(self) -> Dict:
+        """返回各组件是否已经加载"""
+        return {name: is_loaded(self, name)
+                for name in ("embeddings", "text_splitter", "course_vector_store", "user_vector_store")}
+
+    def memory_report(self) -> Dict:
+        """已打开的向量库的内存估计：紧凑索引按矩阵与文档列表计，Chroma 按 向量数 × 维度 × 4 字节估计"""
+        from memory_accounting import approx_size
+        stores = {}
+        for name in ("course_vector_store", "user_vector_store"):
+            if not is_loaded(self, name):
+                continue
+            store = getattr(self, name)
+            if hasattr(store, "memory_bytes"):
+                stores[name] = {"bytes": store.memory_bytes() + approx_size(store._docs), "items": len(store)}
+            else:
+                count = store._collection.count()
+                sample = store._collection.get(limit=1, include=["embeddings"])["embeddings"] if count else None
+                dim = len(sample[0]) if sample is not None and len(sample) else 0
+                stores[name] = {"bytes": count * dim * 4, "items": count}
+        if is_loaded(self, "faq_index"):
+            stores["faq_index"] = {"bytes": approx_size(self.faq_index.entries), "items": len(self.faq_index)}
+        return stores
 
     def _init_course_kb(self):
-        """初始化课程知识库"""
-        if os.path.exists(self.course_kb_path):
-            return Chroma(persist_directory=self.course_kb_path,
-                          embedding_function=self.embeddings)
-        else:
-            return Chroma(persist_directory=self.course_kb_path,
-                          embedding_function=self.embeddings)
+        """
+        初始化课程知识库。
+        COURSE_STORE=compact 时使用紧凑 mmap 索引（见 course_index.py），由 Chroma 课程库导出，
+        Chroma 的内容与导出时不同（重新入库过）时重新导出；COURSE_INDEX_DTYPE 可选 float32 / int8。
+        """
+        if self._compact_course():
+            from course_index import CompactVectorIndex
+            index = CompactVectorIndex(self.course_index_path, self.embeddings, os.getenv("COURSE_INDEX_DTYPE", "float32"))
+            self.refresh_course_index(index)
+            return index
+        return self.course_chroma
+
+    @staticmethod
+    def _compact_course() -> bool:
+        return os.getenv("COURSE_STORE", "chroma") == "compact"
+
+    def refresh_course_index(self, index=None) -> bool:
+        """紧凑索引与 Chroma 课程库不一致时重新导出并加载，返回是否重新导出"""
+        from course_index import export_from_chroma, source_stamp
+        index = index if index is not None else self.__dict__.get("course_vector_store")
+        if index is None or not hasattr(index, "reload") or not os.path.exists(self.course_kb_path):
+            return False
+        stamp = source_stamp(self.course_chroma)
+        if stamp == index.source_stamp:
+            return False
+        logger.info("课程库已变化，重新导出紧凑索引: %s", self.course_index_path)
+        export_from_chroma(self.course_chroma, self.course_index_path, self.embeddings,
+                           os.getenv("COURSE_INDEX_DTYPE", index.dtype), stamp=stamp)
+        index.reload()
+        return True
 
     def _init_user_kb(self):
         """初始化用户文档知识库"""
+        from langchain.vectorstores import Chroma
         if os.path.exists(self.user_kb_path):
             return Chroma(persist_directory=self.user_kb_path,
                           embedding_function=self.embeddings)
@@ -52,63 +264,203 @@ class RAGProcess:
                           embedding_function=self.embeddings)
 
     def load_course_documents(self, documents_path="./course_materials"):
-        """加载课程文档到固定知识库"""
+        """加载课程文档到固定知识库（批量入库，模型调用排在交互式对话之后）"""
         documents = self._load_documents_from_directory(documents_path)
-        split_docs = self.text_splitter.split_documents(documents)
+        # FAQ 文件的问答对同时写入直答索引
+        from chunkers import QAPairChunker, parse_qa_pairs
+        with scheduling(user="course_admin", priority=BULK):
+            for doc in documents:
+                if QAPairChunker.detect(doc.page_content):
+                    self.faq_index.add_pairs(parse_qa_pairs(doc.page_content), doc.metadata.get("source", ""))
+            split_docs = self.text_splitter.split_documents(documents)
 
-        self.course_vector_store.add_documents(split_docs)
-        self.course_vector_store.persist()
+            self.course_writes.add_documents(split_docs)
+        if self._compact_course():
+            self.refresh_course_index()
 
         return len(split_docs)
 
-    def upload_document(self, file_path: str, user_id: str = "default") -> Dict:
-        """用户上传文档并存储（带用户隔离）"""
+    def upload_document(self, file_path: str, user_id: str = "default", cancel_token=None) -> Dict:
+        """
+        用户上传文档并存储（带用户隔离）
+        cancel_token: 本轮被取消时在加载/分割之后停止，不再计算 embedding 和写入向量库
+        超过用户的上传配额时拒绝；写入中途失败或取消时删除已写入的向量
+        """
+        from upload_lifecycle import QuotaExceeded
+        if file_path.endswith('.csv') and os.getenv("CSV_AS_TABLE", "1") == "1":
+            return self._upload_csv_table(file_path, user_id, cancel_token)
+        upload = None
         try:
             # 1. 加载文档
             documents = self._load_single_document(file_path)
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
 
             # 2. 处理文档元数据
-            saved_paths = []
+            original_file = os.path.basename(file_path)
             for doc in documents:
-                original_file = os.path.basename(file_path)
-                upload_id = str(uuid.uuid4())
                 doc.metadata.update({
                     'user_id': user_id,
                     'original_file': original_file,
-                    'upload_id': upload_id,
                 })
-                saved_paths.append(original_file)
 
             # 3. 分割文档
             split_docs = self.text_splitter.split_documents(documents)
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+
+            # 4. 检查配额并登记上传，同一文件的所有片段共用一个 upload_id，删除和过期时一起删除
+            upload = self.uploads.reserve(user_id, original_file, os.path.getsize(file_path), len(split_docs))
+            for doc in split_docs:
+                doc.metadata['upload_id'] = upload['upload_id']
 
-            # 4. 存储到用户知识库
-            self.user_vector_store.add_documents(split_docs)
-            self.user_vector_store.persist()
+            # 5. 存储到用户知识库（与其他用户同时进行的上传合并提交，提交完成后才返回）
+            self.user_writes.add_documents(split_docs)
 
-            # 5. 保存原始文件到 upload 目录
-            filename = os.path.basename(file_path)
-            new_filename = f"{user_id}_{uuid.uuid4()}_{filename}"
-            save_path = os.path.join(self.upload_directory, new_filename)
-            os.rename(file_path, save_path)
+            # 6. 保存原始文件到 upload 目录
+            os.rename(file_path, upload['saved_path'])
+            self.uploads.activate(upload['upload_id'])
 
             return {
                 'success': True,
                 'document_count': len(split_docs),
-                'saved_path': save_path,
-                'uploaded_files': list(set(saved_paths)),
-                'message': f'成功上传并处理文档: {", ".join(set(saved_paths))}'
+                'saved_path': upload['saved_path'],
+                'uploaded_files': [original_file],
+                'message': f'成功上传并处理文档: {original_file}'
             }
 
+        except QuotaExceeded as e:
+            return {
+                'success': False,
+                'quota_exceeded': True,
+                'message': str(e)
+            }
+        except TurnCancelled:
+            logger.info("上传已取消: %s", file_path)
+            self._abort_upload(upload)
+            return {
+                'success': False,
+                'cancelled': True,
+                'message': '上传已取消'
+            }
         except Exception as e:
+            self._abort_upload(upload)
             return {
                 'success': False,
                 'error': str(e),
                 'message': f'文档上传失败: {str(e)}'
             }
 
+    def _abort_upload(self, upload):
+        if upload is None:
+            return
+        try:
+            self.uploads.abort(upload['upload_id'])
+        except Exception as e:
+            # 清单行保留，由后台回收继续删除
+            logger.warning("回滚上传 %s 失败: %s", upload['upload_id'], e)
+
+    def _upload_csv_table(self, file_path: str, user_id: str, cancel_token=None) -> Dict:
+        """CSV 导入 SQLite 表，向量库中只存一条表结构文档（用于判断问题是否针对这张表）
+        cancel_token: 导入时每批插入之后检查，取消时回滚表并撤销上传登记"""
+        from langchain_core.documents import Document
+        from upload_lifecycle import QuotaExceeded
+        upload = None
+        try:
+            original_file = os.path.basename(file_path)
+            upload = self.uploads.reserve(user_id, original_file, os.path.getsize(file_path), 1, kind='csv_table')
+            table = self.csv_tables.import_csv(file_path, user_id, original_file, cancel_token=cancel_token)
+            self.uploads.attach_table(upload['upload_id'], table['table_name'])
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            schema_doc = Document(page_content=self.csv_tables.schema_text(table), metadata={
+                'user_id': user_id,
+                'original_file': original_file,
+                'upload_id': upload['upload_id'],
+                'kind': 'csv_table',
+                'table': table['table_name'],
+            })
+            self.user_writes.add_documents([schema_doc])
+            os.rename(file_path, upload['saved_path'])
+            self.uploads.activate(upload['upload_id'])
+            return {
+                'success': True,
+                'document_count': 1,
+                'saved_path': upload['saved_path'],
+                'uploaded_files': [original_file],
+                'message': f'成功导入表格: {original_file}（{table["row_count"]} 行，{len(table["columns"])} 列）'
+            }
+        except QuotaExceeded as e:
+            return {
+                'success': False,
+                'quota_exceeded': True,
+                'message': str(e)
+            }
+        except TurnCancelled:
+            logger.info("表格导入已取消: %s", file_path)
+            self._abort_upload(upload)
+            return {
+                'success': False,
+                'cancelled': True,
+                'message': '上传已取消'
+            }
+        except Exception as e:
+            self._abort_upload(upload)
+            return {
+                'success': False,
+                'error': str(e),
+                'message': f'表格导入失败: {str(e)}'
+            }
+
+    def route_user_question(self, query: str, user_id: str):
+        """问题最相关的上传内容是表格时返回该表的信息，否则返回 None（走常规 RAG）"""
+        if not self.csv_tables.list_tables(user_id):
+            return None
+        docs = self.search("user", query, k=1, filter={"user_id": user_id})
+        if docs and docs[0].metadata.get('kind') == 'csv_table':
+            return self.csv_tables.get_table(docs[0].metadata['table'], user_id)
+        return None
+
+    def answer_from_table(self, query: str, user_id: str, table: Dict, session_id: str = None):
+        """
+        针对表格的问题：模型生成 SQL -> 只读执行 -> 根据结果流式回答。
+        SQL 执行失败时回落到常规 RAG。
+        :yield: {"type": "sql", "content": SQL} 以及与 answer_question 相同的 answer 字典
+        """
+        from langchain.prompts import ChatPromptTemplate
+        from csv_query import CSV_SQL_PROMPT, CSV_ANSWER_PROMPT, QueryTooExpensive, extract_sql
+        from llm_registry import get_chat_model
+        schema = self.csv_tables.schema_text(table)
+        sql_chain = self.chains.get(("csv", "sql"), lambda: ChatPromptTemplate.from_messages(
+            [("system", CSV_SQL_PROMPT), ("human", "{input}")]) | get_chat_model("qwen-max", temperature=0))
+        with span("csv_sql_generate"):
+            sql = extract_sql(sql_chain.invoke({"schema": schema, "input": query}).content)
+        try:
+            with span("csv_sql_execute"):
+                columns, rows = self.csv_tables.run_query(sql, table['table_name'])
+        except QueryTooExpensive as e:
+            # 查询本身太重：换成向量检索也答不了聚合问题，直接说明
+            logger.warning("表格查询超时: %s (%s)", e, sql)
+            metrics.inc("csv_query_timeouts")
+            yield {"type": "sql", "content": sql}
+            yield {"type": "answer", "answer": f"这个问题生成的查询过于复杂（{e}）。请缩小问题范围，"
+                                                f"例如指定要统计的列或筛选条件后再问。"}
+            return
+        except Exception as e:
+            logger.warning("表格查询失败，回落到常规检索: %s (%s)", e, sql)
+            yield from self.answer_question(query, user_id, 'user', session_id=session_id)
+            return
+        yield {"type": "sql", "content": sql}
+        answer_chain = self.chains.get(("csv", "answer"), lambda: ChatPromptTemplate.from_messages(
+            [("system", CSV_ANSWER_PROMPT), ("human", "{input}")]) | get_chat_model("qwen-max", temperature=0, streaming=True))
+        result = json.dumps([dict(zip(columns, row)) for row in rows], ensure_ascii=False, default=str)
+        for chunk in trace_stream("llm", answer_chain.stream({"sql": sql, "rows": result, "input": query}), mode="csv"):
+            if chunk.content:
+                yield {"type": "answer", "answer": chunk.content}
+
     def _load_single_document(self, file_path: str):
         """加载单个文档"""
+        from langchain.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader, CSVLoader
         if file_path.endswith('.pdf'):
             loader = PyPDFLoader(file_path)
         elif file_path.endswith('.txt'):
@@ -132,31 +484,32 @@ class RAGProcess:
                     docs = self._load_single_document(file_path)
                     documents.extend(docs)
                 except Exception as e:
-                    print(f"加载文件 {filename} 时出错: {e}")
+                    logger.warning("加载文件 %s 时出错: %s", filename, e)
         return documents
 
-    def hybrid_search(self, query: str, user_id: str = "default", top_k: int = 6):
+    def hybrid_search(self, query: str, user_id: str = "default", top_k: int = None):
         """混合检索：同时检索课程知识库和当前用户的上传文档"""
+        top_k = top_k or self.retrieval.hybrid_k
         # 课程知识库（所有人共享）
         course_results = self.course_vector_store.similarity_search_with_score(
-            query, k=top_k // 2
+            query, k=self.retrieval.course_k
         )
 
         # 用户知识库：仅当前用户
         user_results = self.user_vector_store.similarity_search_with_score(
             query,
-            k=top_k // 2,
+            k=self.retrieval.user_k,
             where={"user_id": user_id}  # ✅ 关键：按 user_id 过滤
         )
 
         all_results = []
 
         for doc, score in course_results:
-            doc.metadata['source'] = 'course_knowledge_base'
+            _label_source(doc, 'course_knowledge_base')
             all_results.append((doc, score))
 
         for doc, score in user_results:
-            doc.metadata['source'] = 'user_uploaded'
+            _label_source(doc, 'user_uploaded')
             all_results.append((doc, score))
 
         # 按相似度排序（score 越小越相关）
@@ -165,148 +518,156 @@ class RAGProcess:
     def get_hybrid_retriever(self, user_id: str = "default"):
         """返回一个支持用户隔离的混合检索器"""
         class HybridRetriever:
-            def __init__(self, course_store, user_store, user_id):
-                self.course_store = course_store
-                self.user_store = user_store
+            def __init__(self, rag, user_id):
+                self.rag = rag
                 self.user_id = user_id
 
             def get_relevant_documents(self, query):
-                course_docs = self.course_store.similarity_search(query, k=5)
-                user_docs = self.user_store.similarity_search(
-                    query,
-                    k=5,
-                    where={"user_id": self.user_id}  # ✅ 用户隔离
-                )
-                for doc in course_docs:
-                    doc.metadata['source'] = 'course_knowledge_base'
-                for doc in user_docs:
-                    doc.metadata['source'] = 'user_uploaded'
-                return course_docs + user_docs
-
-        return HybridRetriever(self.course_vector_store, self.user_vector_store, user_id)
-
-    def answer_question(self, query: str, user_id: str = "default", source: str = "hybrid"):
+                return self.rag._hybrid_retrieve(query, self.user_id)  # ✅ 用户隔离
+
+        return HybridRetriever(self, user_id)
+
+    def _retrieve(self, inputs: dict, source: str, config=None) -> List:
+        """
+        检索函数（供预编译的 RAG 链使用）。
+        user_id、prefetched_docs 等每次请求不同的参数从 config["configurable"] 读取。
+        """
+        prefetched_docs = get_configurable(config, "prefetched_docs")
+        if prefetched_docs is not None:
+            # 直接复用投机检索的结果，不再重复 embedding 和检索
+            return prefetched_docs
+        query = inputs["input"]
+        user_id = get_configurable(config, "user_id", "default")
+        if source == "course":
+            # 仅从课程库检索
+            with span("vector_search", store="course"):
+                return self.search("course", query, k=self.retrieval.course_k)
+        if source == "user":
+            # 仅从用户库检索，并过滤 user_id
+            with span("vector_search", store="user"):
+                return self.search("user", query, k=self.retrieval.user_k, filter={"user_id": user_id})  # ✅ 内置过滤
+        # hybrid：课程库 + 当前用户的上传文档
+        return self._hybrid_retrieve(query, user_id)
+
+    def _hybrid_retrieve(self, query: str, user_id: str) -> List:
+        """课程库与当前用户的上传文档各取候选，按 retrieval.fusion 融合后保留 hybrid_k 个"""
+        cfg = self.retrieval
+        with span("vector_search", store="course"):
+            course_docs = self.search("course", query, k=cfg.course_k)
+        for doc in course_docs:
+            _label_source(doc, 'course_knowledge_base')
+        with span("vector_search", store="user"):
+            user_docs = self.search("user", query, k=cfg.user_k, filter={"user_id": user_id})  # ✅ 过滤
+        for doc in user_docs:
+            _label_source(doc, 'user_uploaded')
+        return fuse(course_docs, user_docs, cfg.fusion, cfg.hybrid_k)
+
+    def retrieve(self, query: str, user_id: str = "default", source: str = "hybrid") -> List:
+        """按当前检索参数检索，返回组装上下文之前的文档（离线调参用它评估检索参数）"""
+        return self._retrieve({"input": query}, source, {"configurable": {"user_id": user_id}})
+
+    @staticmethod
+    def assemble(docs: List, session_id: str = None) -> List:
+        """组装交给模型的上下文；提供 session_id 时本轮节省的 token 按会话写日志"""
+        if os.getenv("CONTEXT_ASSEMBLY", "1") == "1":
+            # 合并重叠块、去重、MMR 排序并按 token 预算截断（见 context_assembler.py）
+            from context_assembler import assemble_context
+            docs, _ = assemble_context(docs, session_id=session_id)
+        return docs
+
+    def _build_rag_chain(self, source: str):
+        """构建某个检索来源的 RAG 链（只在第一次使用该来源时调用）"""
+        from langchain.chains import create_retrieval_chain
+        from langchain.chains.combine_documents import create_stuff_documents_chain
+        from langchain.prompts import ChatPromptTemplate
+        from langchain_core.runnables import RunnableLambda
+        from llm_registry import get_chat_model
+
+        def retrieve(inputs: dict, config) -> List:
+            return self.assemble(self._retrieve(inputs, source, config), get_configurable(config, "session_id"))
+
+        llm = get_chat_model("qwen-max", temperature=0, streaming=True)
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", RAG_SYSTEM_PROMPT),
+                # MessagesPlaceholder(variable_name="chat_history"),
+                ("human", "{input}"),
+            ]
+        )
+        question_answer_chain = create_stuff_documents_chain(llm, prompt)
+        return create_retrieval_chain(RunnableLambda(retrieve), question_answer_chain)
+
+    def get_rag_chain(self, source: str = "hybrid"):
+        """返回预编译的 RAG 链，source 可选 'course', 'user', 'hybrid'"""
+        return self.chains.get(("rag", source), lambda: self._build_rag_chain(source))
+
+    def answer_question(self, query: str, user_id: str = "default", source: str = "hybrid", prefetched_docs: List = None,
+                        session_id: str = None):
             """
             回答问题，支持三种检索模式。
             :param query: 用户的问题
             :param user_id: 用户ID
             :param source: 检索来源，可选 'course', 'user', 'hybrid'
+            :param prefetched_docs: 已提前检索好的文档（投机检索结果），提供时跳过检索
+            :param session_id: 会话ID，上下文组装的节省统计按会话记日志
             :yield: 包含答案和来源的字典
             """
-            # --- 1. 根据 source 创建不同的检索器 ---
-            if source == "course":
-                # 仅从课程库检索
-                retriever = self.course_vector_store.as_retriever(search_kwargs={"k": 6})
-            elif source == "user":
-                # 仅从用户库检索，并过滤 user_id
-                retriever = self.user_vector_store.as_retriever(
-                    search_kwargs={
-                        "k": 6,
-                        "filter": {"user_id": user_id}  # ✅ 内置过滤
-                    }
-                )
-            else:  # hybrid
-                # 混合检索：创建一个支持混合的检索器
-                # from langchain_core.retrievers import RetrieverLike
-                from typing import List
-                def hybrid_retriever(query) -> List:
-                    course_docs = self.course_vector_store.similarity_search(query, k=3)
-                    for doc in course_docs:
-                        doc.metadata['source'] = 'course_knowledge_base'
-
-                    user_docs = self.user_vector_store.similarity_search(
-                        query,
-                        k=3,
-                        filter={"user_id": user_id}  # ✅ 过滤
-                    )
-                    for doc in user_docs:
-                        doc.metadata['source'] = 'user_uploaded'
-
-                    return course_docs + user_docs
-
-                # 包装成 LangChain 可用的 Runnable
-                from langchain_core.runnables import RunnableLambda
-                retriever = RunnableLambda(hybrid_retriever)
-
-            # --- 2. 创建 RAG 链 ---
-            llm = ChatOpenAI(
-                    model="qwen-max",
-                    api_key=os.getenv("DASHSCOPE_API_KEY"),
-                    openai_api_base="https://dashscope.aliyuncs.com/compatible-mode/v1",
-                    temperature=0,
-                    streaming=True
-                    )
-
-            system_prompt = (
-                """
-                    你是一个课程助手，请根据以下上下文信息回答问题。如果信息不足，请说明。
-                    不要直接复制上下文，而是根据上下文信息进行推理和回答。
-                    不要编造答案，只能根据上下文信息进行回答。
-                    如果用户提问了与文档内容无关的问题，忽略他的问题并回答：“我是课程咨询助手，请不要提与课程内容无关的问题”
-                    并根据用户问题的意图推荐用户切换“联网查询”或者“普通对话”模式，语气稍微耐心一些。
-                    回答尽可能简洁明了，注意文字排版要美观，不要一行就几个字。
-                """
-                "Context: {context}"
-            )
-
-            prompt = ChatPromptTemplate.from_messages(
-                [
-                    ("system", system_prompt),
-                    # MessagesPlaceholder(variable_name="chat_history"),
-                    ("human", "{input}"),
-                ]
-            )
-
-            question_answer_chain = create_stuff_documents_chain(llm, prompt)
-            rag_chain = create_retrieval_chain(retriever, question_answer_chain)
-            answer = ''
-            # --- 3. 执行链 ---
-            for chunk in rag_chain.stream({"input": query}):
+            # --- 0. 命中整理好的 FAQ 时直接返回存好的答案，不检索也不调用模型 ---
+            if source in ("course", "hybrid") and os.getenv("FAQ_DIRECT", "1") == "1":
+                with span("faq_match"):
+                    hit = self.faq_index.match(query)
+                if hit is not None:
+                    entry, score = hit
+                    logger.debug("FAQ 直答命中: %s (%.2f)", entry["question"], score)
+                    for sentence in sentence_pieces(entry["answer"]):
+                        yield {"type": "answer", "answer": sentence}
+                    yield {"type": "answer", "answer": f"\n\n> 来源：{entry['source']} · {entry['question']}"}
+                    return
+            # --- 1. 取出预编译的 RAG 链，本次请求的参数通过 config 传入 ---
+            rag_chain = self.get_rag_chain(source)
+            config = {"configurable": {"user_id": user_id, "session_id": session_id, "prefetched_docs": prefetched_docs}}
+            # --- 2. 执行链 ---
+            context = []
+            # 模型首 token 时间从检索完成（拿到 context）开始计算
+            traced = sampled()
+            llm_start, first_token = None, True
+            for chunk in rag_chain.stream({"input": query}, config=config):
                 if 'context' in chunk:
+                    context = chunk['context']
+                    llm_start = time.perf_counter()
                     yield{"type":"rag","content":"正在查询本地知识库...\n"}
                 if 'answer' in chunk:
+                    if traced and first_token and llm_start is not None:
+                        metrics.observe("llm_ttft", (time.perf_counter() - llm_start) * 1000, mode="rag")
+                        first_token = False
                     yield {"type":"answer","answer":chunk['answer']}
-            
-            # answer = result["answer"]
-
-            # --- 4. 手动构建 sources 列表（用于前端展示）---
-            search_results = []
-            if source == "course":
-                results = self.course_vector_store.similarity_search_with_score(query, k=6)
-                for doc, score in results:
-                    doc.metadata['source'] = 'course_knowledge_base'
-                    search_results.append((doc, score))
-            elif source == "user":
-                results = self.user_vector_store.similarity_search_with_score(
-                    query, k=6, filter={"user_id": user_id}
-                )
-                for doc, score in results:
-                    doc.metadata['source'] = 'user_uploaded'
-                    search_results.append((doc, score))
-            else:  # hybrid
-                course_results = self.course_vector_store.similarity_search_with_score(query, k=3)
-                user_results = self.user_vector_store.similarity_search_with_score(
-                    query, k=3, filter={"user_id": user_id}
-                )
-                all_results = [(doc, score) for doc, score in course_results] + \
-                            [(doc, score) for doc, score in user_results]
-                search_results = sorted(all_results, key=lambda x: x[1])[:6]
+            if traced and llm_start is not None:
+                metrics.observe("llm_total", (time.perf_counter() - llm_start) * 1000, mode="rag")
 
+            # --- 3. 根据本次实际使用的上下文构建 sources 列表（用于前端展示），不再重复检索 ---
             sources = []
-            for doc, score in search_results:
+            for doc in context:
                 sources.append({
                     'content': doc.page_content[:200] + "...",
                     'source': doc.metadata.get('source', 'unknown'),
                     'file': doc.metadata.get('original_file', 'unknown'),
-                    'score': float(score)
                 })
 
             # yield {
             #     'type':'sources',
             #     'sources': sources,
-            #     'context_used': len(search_results)
+            #     'context_used': len(context)
             # }
 
+    def delete_user_documents(self, user_id: str, original_file: str = None):
+        """删除用户上传的文档（某个文件或该用户的全部文档）：向量、导入的表和保存的原始文件一起删除"""
+        self.uploads.delete(user_id, original_file)
+        # 还没有登记到清单的旧数据（见 UploadLifecycle.adopt）按元数据删除向量
+        where = {"user_id": user_id}
+        if original_file is not None:
+            where = {"$and": [{"user_id": user_id}, {"original_file": original_file}]}
+        self.user_writes.delete(where=where)
+
     def get_user_documents(self, user_id: str = "default") -> List[Dict]:
         """获取某用户上传的文档列表"""
         # try:
@@ -332,6 +693,23 @@ class RAGProcess:
         #     return []
 
 
+def _memory_report() -> Dict:
+    stores = {}
+    for i, rag in enumerate(list(_instances)):
+        for name, data in rag.memory_report().items():
+            stores[f"{i}:{name}"] = data
+    return {"bytes": sum(d["bytes"] for d in stores.values()), "items": sum(d["items"] for d in stores.values()),
+            "stores": stores}
+
+
+def _register_memory():
+    from memory_accounting import memory
+    memory.register("vector_stores", _memory_report)
+
+
+_register_memory()
+
+
 if __name__ == "__main__":
     # 初始化课程助手
     assistant = RAGProcess()
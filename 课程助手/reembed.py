@@ -0,0 +1,135 @@
+"""
+切换 embedding 后端时重新计算向量库的向量：
+    python 课程助手/reembed.py --to local
+    python 课程助手/reembed.py --to local --persist-directory 课程助手/course_knowledge_base --batch-size 64
+依次处理根目录下存在的 course_db / user_db（Chroma）、course_index（紧凑索引）和 faq_index.json。
+每个库先在旁边写出新库（<名称>.reembed），全部成功后再逐个替换，旧库保留为 <名称>.bak-<旧后端>（--no-backup 时删除），
+最后把 embedding.json 改为新后端。文本、元数据和文档 ID 都保持不变。
+迁移期间请停止服务：迁移不会阻止其他进程继续写入旧库。
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import time
+
+from embedding_backends import BACKENDS, backend_name, get_embeddings, record_backend, recorded_backend
+
+DEFAULT_PERSIST_DIRECTORY = "课程助手/course_knowledge_base"
+
+
+def _batches(items, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def reembed_chroma(path: str, target: str, embeddings, batch_size: int) -> int:
+    from langchain.vectorstores import Chroma
+    data = Chroma(persist_directory=path)._collection.get(include=["documents", "metadatas"])
+    new = Chroma(persist_directory=target, embedding_function=embeddings)
+    rows = list(zip(data["ids"], data["documents"], data["metadatas"]))
+    for batch in _batches(rows, batch_size):
+        ids, texts, metadatas = (list(column) for column in zip(*batch))
+        new._collection.upsert(ids=ids, embeddings=[list(v) for v in embeddings.embed_documents(texts)],
+                               metadatas=metadatas, documents=texts)
+    if hasattr(new, "persist"):
+        new.persist()
+    return len(rows)
+
+
+def reembed_compact(path: str, target: str, embeddings, batch_size: int) -> int:
+    from langchain_core.documents import Document
+    from course_index import CompactVectorIndex
+    old = CompactVectorIndex(path, None)
+    new = CompactVectorIndex(target, embeddings, old.dtype)
+    for batch in _batches(old._docs, batch_size):
+        texts = [d["page_content"] for d in batch]
+        new.add_embeddings([Document(page_content=d["page_content"], metadata=d["metadata"]) for d in batch],
+                           embeddings.embed_documents(texts))
+    new.persist()
+    return len(old._docs)
+
+
+def reembed_faq(path: str, target: str, embeddings, batch_size: int) -> int:
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    for batch in _batches(entries, batch_size):
+        for entry, vector in zip(batch, embeddings.embed_documents([e["question"] for e in batch])):
+            entry["vector"] = list(vector)
+    with open(target, "w", encoding="utf-8") as f:
+        json.dump(entries, f, ensure_ascii=False)
+    return len(entries)
+
+
+STORES = (
+    ("course_db", reembed_chroma),
+    ("user_db", reembed_chroma),
+    ("course_index", reembed_compact),
+    ("faq_index.json", reembed_faq),
+)
+
+
+def _remove(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def migrate(persist_directory: str, embeddings, batch_size: int = 64, backup: bool = True):
+    """重新计算根目录下所有库的向量，返回 {库名: 文档数}"""
+    old_backend = recorded_backend(persist_directory) or "unknown"
+    suffix = re.sub(r"[^\w.-]+", "_", old_backend)
+    written = []
+    counts = {}
+    try:
+        for name, reembed in STORES:
+            path = os.path.join(persist_directory, name)
+            if not os.path.exists(path):
+                continue
+            target = path + ".reembed"
+            _remove(target)
+            start = time.perf_counter()
+            counts[name] = reembed(path, target, embeddings, batch_size)
+            written.append((path, target))
+            elapsed = time.perf_counter() - start
+            print(f"  {name}: {counts[name]} 条，{elapsed:.1f}s（{counts[name] / max(elapsed, 1e-9):.1f} 条/秒）")
+    except BaseException:
+        # 任何一个库失败都不替换，旧库保持原样
+        for _, target in written:
+            _remove(target)
+        raise
+    for path, target in written:
+        backup_path = f"{path}.bak-{suffix}"
+        _remove(backup_path)
+        os.replace(path, backup_path)
+        os.replace(target, path)
+        if not backup:
+            _remove(backup_path)
+    record_backend(persist_directory, backend_name(embeddings))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="切换 embedding 后端并重新计算向量库")
+    parser.add_argument("--to", choices=BACKENDS, required=True, help="新的 embedding 后端")
+    parser.add_argument("--persist-directory", default=DEFAULT_PERSIST_DIRECTORY, help="向量库根目录")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--no-backup", action="store_true", help="替换后删除旧库")
+    parser.add_argument("--force", action="store_true", help="记录的后端与目标相同时也重新计算")
+    args = parser.parse_args()
+
+    embeddings = get_embeddings(args.to)
+    old, new = recorded_backend(args.persist_directory), backend_name(embeddings)
+    if old == new and not args.force:
+        print(f"{args.persist_directory} 已经使用 {new}，无需迁移（--force 强制重新计算）")
+        return
+    print(f"{args.persist_directory}: {old or 'unknown'} -> {new}")
+    start = time.perf_counter()
+    counts = migrate(args.persist_directory, embeddings, args.batch_size, backup=not args.no_backup)
+    print(f"完成：{sum(counts.values())} 条，耗时 {time.perf_counter() - start:.1f}s；启动服务前请把 EMBEDDING_BACKEND 设为 {args.to}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+检索参数：分块方式与大小、各向量库的 k、混合检索的融合方式。
+RAGProcess 启动时从 RETRIEVAL_CONFIG（默认 课程助手/retrieval_config.json）读取，文件由离线调参命令生成：
+    python 课程助手/retrieval_tuner.py
+文件不存在时使用下面的默认值；环境变量 CHUNKING / RAG_CHUNK_SIZE / RAG_CHUNK_OVERLAP / RAG_COURSE_K /
+RAG_USER_K / RAG_HYBRID_K / RAG_FUSION 优先于文件。
+    course_k / user_k  单独检索课程库 / 用户库时取的块数，混合检索时也是各库的候选数
+    hybrid_k           混合检索融合后保留的块数
+    fusion             'rrf'：按各库内排名做倒数排名融合（两库交替）；'concat'：课程库在前、用户库在后
+"""
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.getenv("RETRIEVAL_CONFIG", "课程助手/retrieval_config.json")
+FUSION_METHODS = ("rrf", "concat")
+RRF_K = 60
+
+_FIELDS = {
+    # 字段: (默认值, 类型, 覆盖用的环境变量)
+    "chunking": ("structured", str, "CHUNKING"),
+    "chunk_size": (1000, int, "RAG_CHUNK_SIZE"),
+    "chunk_overlap": (200, int, "RAG_CHUNK_OVERLAP"),
+    "course_k": (6, int, "RAG_COURSE_K"),
+    "user_k": (6, int, "RAG_USER_K"),
+    "hybrid_k": (6, int, "RAG_HYBRID_K"),
+    "fusion": ("rrf", str, "RAG_FUSION"),
+}
+
+
+class RetrievalConfig:
+    def __init__(self, **values):
+        unknown = set(values) - set(_FIELDS)
+        if unknown:
+            raise ValueError(f"未知的检索参数: {', '.join(sorted(unknown))}")
+        for name, (default, cast, _) in _FIELDS.items():
+            setattr(self, name, cast(values.get(name, default)))
+        if self.fusion not in FUSION_METHODS:
+            raise ValueError(f"不支持的融合方式: {self.fusion}")
+        if self.chunk_overlap >= self.chunk_size:
+            raise ValueError("chunk_overlap 必须小于 chunk_size")
+
+    def replace(self, **values) -> "RetrievalConfig":
+        return RetrievalConfig(**{**self.to_dict(), **values})
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in _FIELDS}
+
+    def __repr__(self):
+        return f"RetrievalConfig({', '.join(f'{k}={v!r}' for k, v in self.to_dict().items())})"
+
+
+def load_retrieval_config(path: str = None) -> RetrievalConfig:
+    """读取调参结果（只取参数字段，忽略报告部分），再用环境变量覆盖"""
+    path = path or CONFIG_PATH
+    values = {}
+    if os.path.exists(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            values = {k: v for k, v in data.get("config", data).items() if k in _FIELDS}
+        except (OSError, ValueError) as e:
+            logger.warning("读取检索参数 %s 失败，使用默认值: %s", path, e)
+    for name, (_, _, env) in _FIELDS.items():
+        if os.getenv(env):
+            values[name] = os.getenv(env)
+    return RetrievalConfig(**values)
+
+
+def fuse(course_docs, user_docs, method: str, k: int):
+    """融合两个库的检索结果（各自按相关性排好序），去掉内容相同的块，保留前 k 个"""
+    if method == "concat":
+        ranked = list(course_docs) + list(user_docs)
+    else:
+        scores = {}
+        for docs in (course_docs, user_docs):
+            for rank, doc in enumerate(docs):
+                scores[id(doc)] = (scores.get(id(doc), (0.0, doc))[0] + 1.0 / (RRF_K + rank + 1), doc)
+        # 分数相同时保持课程库在前（sorted 是稳定排序）
+        ranked = [doc for _, doc in sorted(scores.values(), key=lambda item: item[0], reverse=True)]
+    seen, fused = set(), []
+    for doc in ranked:
+        if doc.page_content in seen:
+            continue
+        seen.add(doc.page_content)
+        fused.append(doc)
+    return fused[:k]
@@ -0,0 +1,278 @@
+"""
+离线检索调参命令：以 local_course 中的问答对为标注集，扫描 分块方式/大小/重叠 × 各库 k × 融合方式，
+统计召回率、上下文 token 数和检索延迟，输出 Pareto 最优的配置并写入 retrieval_config.json（RAGProcess 启动时读取）。
+    python 课程助手/retrieval_tuner.py                          # 使用 EMBEDDING_BACKEND 的 embedding，写入 RETRIEVAL_CONFIG
+    python 课程助手/retrieval_tuner.py --store compact --dry-run # 只打印报告
+    python 课程助手/retrieval_tuner.py --backend hash --dry-run  # 离线 hash embedding（只用来试跑命令，结果不可用于线上）
+标注集：retrieval_queries.json 中人工改写的学生问法为查询（不用 FAQ 原问题本身，否则调出的配置只对原文过拟合），
+对应问答对答案的每个句子为需要召回的内容。问答对按奇偶分成两半，一半放课程库，一半作为学生上传的文档放用户库，
+分别按 course / user / hybrid 三种来源检索。线上会被 FAQ 直答命中的查询（见 faq_index.py）不经过检索，不计入标注集。
+    召回率     答案句子出现在最终上下文（经过 context_assembler 组装）中的比例，对所有查询取平均
+    上下文 token  交给模型的上下文的估计 token 数
+    延迟       检索 + 融合 + 上下文组装的耗时（embedding 已缓存，不计入；它与检索参数无关。
+               检索到的块相同时组装结果只计算一次，耗时复用第一次的测量值）
+在三个指标上都不被其他配置支配的为 Pareto 最优；其中召回率与最高值相差不超过 --recall-tolerance 的配置里，
+选上下文 token 最少的写入配置文件。
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+COURSE_DIR = os.path.join(BASE_DIR, "local_course")
+# 不放在 local_course 中：那个目录会整体入库
+QUERIES_PATH = os.path.join(BASE_DIR, "retrieval_queries.json")
+TUNER_USER = "retrieval_tuner"
+
+from retrieval_config import RetrievalConfig, load_retrieval_config, CONFIG_PATH, FUSION_METHODS
+from embedding_backends import BACKEND, BACKENDS, backend_name, get_embeddings
+
+
+class CachedEmbeddings:
+    """缓存 embedding 结果：同一段文本在不同配置下只计算一次"""
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self._cache = {}
+
+    def embed_documents(self, texts):
+        missing = list(dict.fromkeys(t for t in texts if t not in self._cache))
+        if missing:
+            self._cache.update(zip(missing, self.embeddings.embed_documents(missing)))
+        return [self._cache[t] for t in texts]
+
+    def embed_query(self, text):
+        key = ("query", text)
+        if key not in self._cache:
+            self._cache[key] = self.embeddings.embed_query(text)
+        return self._cache[key]
+
+
+def build_labels(course_dir: str = COURSE_DIR, queries_path: str = QUERIES_PATH):
+    """读取课程目录下的问答对和改写的查询，返回 (课程库文档, 用户库文档, 标注 [{query, sentences, source}], 问答对)"""
+    from langchain_core.documents import Document
+    from chunkers import parse_qa_pairs, split_sentences
+    pairs = []
+    for name in sorted(os.listdir(course_dir)):
+        with open(os.path.join(course_dir, name), encoding="utf-8") as f:
+            pairs.extend((name, q, a) for q, a in parse_qa_pairs(f.read()))
+    if not pairs:
+        raise SystemExit(f"{course_dir} 中没有找到问答对，无法构建标注集")
+    halves = {"course": pairs[0::2], "user": pairs[1::2]}
+
+    def document(part, metadata):
+        text = "\n\n".join(f"问题：{q}\n答案：{a}" for _, q, a in part)
+        return Document(page_content=text, metadata=metadata)
+
+    course_doc = document(halves["course"], {"source": os.path.join(course_dir, "course.txt")})
+    user_doc = document(halves["user"], {"source": "notes.txt", "user_id": TUNER_USER, "original_file": "notes.txt"})
+    with open(queries_path, encoding="utf-8") as f:
+        queries = json.load(f)
+    answers = {question: (store, answer) for store, part in halves.items() for _, question, answer in part}
+    labels = []
+    for item in queries:
+        if item["question"] not in answers:
+            raise SystemExit(f"{queries_path}: 课程目录中没有问题 {item['question']!r}")
+        store, answer = answers[item["question"]]
+        sentences = split_sentences(answer)
+        labels.append({"query": item["query"], "sentences": sentences, "source": store})
+        labels.append({"query": item["query"], "sentences": sentences, "source": "hybrid"})
+    return course_doc, user_doc, labels, pairs
+
+
+def drop_faq_hits(labels, pairs, embeddings, workdir: str):
+    """去掉线上会被 FAQ 直答命中的查询（它们不经过检索），返回 (剩余标注, 去掉的查询数)"""
+    from faq_index import FAQIndex
+    index = FAQIndex(os.path.join(workdir, "faq_index.json"), embeddings)
+    index.add_pairs([(q, a) for _, q, a in pairs], "faq")
+    hits = {l["query"] for l in labels if index.match(l["query"]) is not None}
+    return [l for l in labels if l["query"] not in hits], len(hits)
+
+
+def chunking_grid(args):
+    """分块参数组合；structured 对问答文件一问一答为一块，大小和重叠只影响回退的通用分块器，只取一组"""
+    base = load_retrieval_config()
+    for chunking in args.chunking:
+        if chunking == "structured":
+            yield {"chunking": "structured", "chunk_size": base.chunk_size, "chunk_overlap": base.chunk_overlap}
+            continue
+        for size, overlap in itertools.product(args.chunk_sizes, args.overlaps):
+            if overlap < size:
+                yield {"chunking": chunking, "chunk_size": size, "chunk_overlap": overlap}
+
+
+class Evaluator:
+    def __init__(self, embeddings, store: str, labels, workdir: str):
+        self.embeddings = CachedEmbeddings(embeddings)
+        self.store = store
+        self.labels = labels
+        self.workdir = workdir
+        self._rags = {}     # 分块结果的摘要 -> RAGProcess（不同分块参数切出相同的块时共用）
+        self._results = {}  # (分块摘要, 来源, 影响该来源的参数) -> [(召回率, token 数, 延迟毫秒)]
+        self._assembled = {}  # (查询, 检索到的块) -> (组装后的文档, 组装耗时毫秒)；不同参数检索到相同的块时只组装一次
+
+    def rag_for(self, chunk_params: dict, course_doc, user_doc):
+        """按分块参数建库，返回 (分块摘要, RAGProcess, 块数)"""
+        from rag_process import RAGProcess
+        cfg = RetrievalConfig(**chunk_params)
+        splitter = RAGProcess(persist_directory=self.workdir, upload_directory=self.workdir,
+                              embeddings=self.embeddings, retrieval=cfg).text_splitter
+        course_chunks = splitter.split_documents([course_doc])
+        user_chunks = splitter.split_documents([user_doc])
+        digest = hashlib.md5("\x00".join(c.page_content for c in course_chunks + user_chunks).encode("utf-8")).hexdigest()
+        if digest not in self._rags:
+            path = os.path.join(self.workdir, digest)
+            rag = RAGProcess(persist_directory=path, upload_directory=path, embeddings=self.embeddings, retrieval=cfg)
+            if self.store == "compact":
+                from course_index import CompactVectorIndex
+                rag.__dict__["course_vector_store"] = CompactVectorIndex(os.path.join(path, "course_index"), rag.embeddings)
+                rag.__dict__["user_vector_store"] = CompactVectorIndex(os.path.join(path, "user_index"), rag.embeddings)
+            rag.course_writes.add_documents(course_chunks)
+            rag.user_writes.add_documents(user_chunks)
+            self._rags[digest] = rag
+        return digest, self._rags[digest], len(course_chunks) + len(user_chunks)
+
+    def run(self, digest: str, rag, cfg: RetrievalConfig, source: str):
+        from context_assembler import estimate_tokens
+        params = {"course": (cfg.course_k,), "user": (cfg.user_k,),
+                  "hybrid": (cfg.course_k, cfg.user_k, cfg.hybrid_k, cfg.fusion)}[source]
+        key = (digest, source, params)
+        if key not in self._results:
+            rag.retrieval = cfg
+            rows = []
+            for label in (l for l in self.labels if l["source"] == source):
+                start = time.perf_counter()
+                retrieved = rag.retrieve(label["query"], user_id=TUNER_USER, source=source)
+                elapsed = (time.perf_counter() - start) * 1000
+                docs, assemble_ms = self.assemble(rag, label["query"], retrieved)
+                elapsed += assemble_ms
+                found = sum(any(s in d.page_content for d in docs) for s in label["sentences"])
+                rows.append((found / len(label["sentences"]), sum(estimate_tokens(d.page_content) for d in docs), elapsed))
+            self._results[key] = rows
+        return self._results[key]
+
+    def assemble(self, rag, query: str, docs):
+        key = (query, tuple(d.page_content for d in docs))
+        if key not in self._assembled:
+            start = time.perf_counter()
+            assembled = rag.assemble(docs)
+            self._assembled[key] = (assembled, (time.perf_counter() - start) * 1000)
+        return self._assembled[key]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)] if values else 0.0
+
+
+def summarize(rows) -> dict:
+    return {
+        "recall": round(sum(r for r, _, _ in rows) / len(rows), 4),
+        "full_hit_rate": round(sum(r == 1.0 for r, _, _ in rows) / len(rows), 4),
+        "context_tokens": round(sum(t for _, t, _ in rows) / len(rows), 1),
+        "latency_p50_ms": round(percentile([ms for _, _, ms in rows], 0.5), 3),
+        "latency_p95_ms": round(percentile([ms for _, _, ms in rows], 0.95), 3),
+    }
+
+
+def dominates(a: dict, b: dict) -> bool:
+    """a 在召回率、token 数、p50 延迟上都不差于 b，且至少一项更好"""
+    keys = (("recall", 1), ("context_tokens", -1), ("latency_p50_ms", -1))
+    no_worse = all(a[k] * sign >= b[k] * sign for k, sign in keys)
+    return no_worse and any(a[k] * sign > b[k] * sign for k, sign in keys)
+
+
+def pareto_front(results):
+    return [r for r in results if not any(dominates(o["metrics"], r["metrics"]) for o in results if o is not r)]
+
+
+def choose(front, tolerance: float):
+    best = max(r["metrics"]["recall"] for r in front)
+    candidates = [r for r in front if r["metrics"]["recall"] >= best - tolerance]
+    return min(candidates, key=lambda r: (r["metrics"]["context_tokens"], r["metrics"]["latency_p50_ms"]))
+
+
+def tune(args, embeddings):
+    course_doc, user_doc, labels, pairs = build_labels(args.course_dir, args.queries)
+    workdir = tempfile.mkdtemp(prefix="retrieval_tuner_")
+    evaluator = Evaluator(embeddings, args.store, labels, workdir)
+    if not args.keep_faq_hits:
+        labels, dropped = drop_faq_hits(labels, pairs, evaluator.embeddings, workdir)
+        evaluator.labels = labels
+        print(f"  FAQ 直答命中 {dropped} 个查询，不计入标注集", file=sys.stderr)
+        if not labels:
+            raise SystemExit("所有查询都会被 FAQ 直答命中，没有可用于调参的查询")
+    results = []
+    for chunk_params in chunking_grid(args):
+        digest, rag, chunks = evaluator.rag_for(chunk_params, course_doc, user_doc)
+        for course_k, user_k, hybrid_k, fusion in itertools.product(args.course_k, args.user_k, args.hybrid_k, args.fusion):
+            cfg = RetrievalConfig(**chunk_params, course_k=course_k, user_k=user_k, hybrid_k=hybrid_k, fusion=fusion)
+            rows = [row for source in ("course", "user", "hybrid") for row in evaluator.run(digest, rag, cfg, source)]
+            results.append({"config": cfg.to_dict(), "metrics": {**summarize(rows), "chunks": chunks}})
+        print(f"  {chunk_params}: {chunks} 块", file=sys.stderr)
+    return results, len(labels)
+
+
+def _int_list(value: str):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def _str_list(value: str):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线检索调参：召回率 / 上下文 token / 延迟的 Pareto 报告")
+    parser.add_argument("--course-dir", default=COURSE_DIR, help="标注集来源（问答对文件所在目录）")
+    parser.add_argument("--queries", default=QUERIES_PATH, help="改写的查询 [{query, question}]，question 为对应的 FAQ 原问题")
+    parser.add_argument("--keep-faq-hits", action="store_true", help="保留会被 FAQ 直答命中的查询")
+    parser.add_argument("--chunking", type=_str_list, default=["structured", "recursive"])
+    parser.add_argument("--chunk-sizes", type=_int_list, default=[300, 500, 800, 1000])
+    parser.add_argument("--overlaps", type=_int_list, default=[0, 100, 200])
+    parser.add_argument("--course-k", type=_int_list, default=[2, 3, 4, 6, 8])
+    parser.add_argument("--user-k", type=_int_list, default=[2, 3, 4, 6])
+    parser.add_argument("--hybrid-k", type=_int_list, default=[4, 6, 8])
+    parser.add_argument("--fusion", type=_str_list, default=list(FUSION_METHODS))
+    parser.add_argument("--recall-tolerance", type=float, default=0.02,
+                        help="选择配置时允许比最高召回率低多少（换取更少的上下文 token）")
+    parser.add_argument("--store", choices=["chroma", "compact"], default="chroma")
+    parser.add_argument("--backend", choices=BACKENDS, default=BACKEND, help="embedding 后端（应与线上一致）")
+    parser.add_argument("--output", default=CONFIG_PATH, help="配置文件路径（RAGProcess 启动时读取）")
+    parser.add_argument("--dry-run", action="store_true", help="只打印报告，不写配置文件")
+    args = parser.parse_args()
+
+    embeddings = get_embeddings(args.backend)
+    start = time.perf_counter()
+    results, queries = tune(args, embeddings)
+    front = sorted(pareto_front(results), key=lambda r: -r["metrics"]["recall"])
+    chosen = choose(front, args.recall_tolerance)
+    print(f"\n共 {len(results)} 组配置，{queries} 个查询，耗时 {time.perf_counter() - start:.1f}s；Pareto 最优 {len(front)} 组：")
+    print(f"{'召回率':>8} {'全中率':>8} {'token':>8} {'p50(ms)':>9} {'p95(ms)':>9}  配置")
+    for r in front:
+        m = r["metrics"]
+        mark = "  ← 选用" if r is chosen else ""
+        print(f"{m['recall']:>8.3f} {m['full_hit_rate']:>8.3f} {m['context_tokens']:>8.0f} "
+              f"{m['latency_p50_ms']:>9.2f} {m['latency_p95_ms']:>9.2f}  {r['config']}{mark}")
+
+    if args.dry_run:
+        return
+    report = {
+        "config": chosen["config"],
+        "metrics": chosen["metrics"],
+        "pareto": front,
+        "tuning": {"generated_at": time.strftime("%Y-%m-%d %H:%M:%S"), "queries": queries,
+                   "configs": len(results), "store": args.store,
+                   "embeddings": backend_name(embeddings), "recall_tolerance": args.recall_tolerance},
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+"""
+模型调用的准入控制与按用户公平调度。
+所有发往模型服务的请求（qwen-max 对话补全、DashScope embedding）先在这里排队领取执行槽位：
+    - 每个端点有全局并发上限和令牌桶限速（请求/秒 + 突发量），避免被服务商限流
+    - 每个用户在每个端点上有并发上限；同一优先级内正在执行最少、最久没被服务的用户优先，
+      一个学生一次上传 10 个文件不会饿死其他人的对话
+    - 交互式对话（interactive）优先于批量入库（bulk）
+    - 排队过长或等待超时时拒绝请求（SchedulerBusy），而不是无限排队
+端点按 服务地址 + 类型（chat / embed）区分：默认服务（DASHSCOPE_BASE_URL）的端点名为 chat / embed，
+其他服务（如备用的 DeepSeek）为 chat@主机名，各自有独立的并发槽位和令牌桶，备用服务的请求不会排在主服务后面。
+同步和异步的共享 httpx 客户端都经过调度（ScheduledTransport / AsyncScheduledTransport）。
+请求属于哪个用户、什么优先级由 scheduling() / scheduled_stream() 设置的上下文决定。
+排队时间记录到直方图 scheduler_queue_wait（按端点、优先级），拒绝次数记录到计数器 scheduler_rejected。
+配置（环境变量，<EP> 为 CHAT 或 EMBED，同一类型的各个服务使用相同的配置）：
+    SCHEDULER                 设为 0 关闭调度
+    SCHED_<EP>_CONCURRENCY    全局并发上限（默认 CHAT 16，EMBED 8）
+    SCHED_<EP>_RPS            令牌桶速率，请求/秒（默认 CHAT 10，EMBED 20；0 表示不限速）
+    SCHED_<EP>_BURST          令牌桶容量（默认为速率的 2 倍）
+    SCHED_USER_CONCURRENCY    每个用户在每个端点上的并发上限（默认 2）
+    SCHED_MAX_QUEUE           每个端点最多排队的请求数（默认 200）
+    SCHED_MAX_WAIT            最长排队秒数（默认 30）
+    SCHED_EMBED_BATCH         批量 embedding 每次请求的文本数（默认 25，与 DashScope 单次上限一致）
+"""
+import asyncio
+import contextvars
+import functools
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+
+from tracing import metrics
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+_PRIORITY_ORDER = {INTERACTIVE: 0, BULK: 1}
+
+ENABLED = os.getenv("SCHEDULER", "1") == "1"
+USER_CONCURRENCY = int(os.getenv("SCHED_USER_CONCURRENCY", "2"))
+MAX_QUEUE = int(os.getenv("SCHED_MAX_QUEUE", "200"))
+MAX_WAIT = float(os.getenv("SCHED_MAX_WAIT", "30"))
+EMBED_BATCH = int(os.getenv("SCHED_EMBED_BATCH", "25"))
+IDLE_USER_TTL = 300  # 超过这么久没被服务的用户不再影响公平排序，清掉其记录
+IDLE_PRUNE_AT = 1024  # 记录的用户数超过时，放行请求的同时顺带清理
+# 端点 -> (默认并发上限, 默认速率)
+_DEFAULTS = {"chat": (16, 10.0), "embed": (8, 20.0)}
+
+# 当前请求的 (用户, 优先级)
+_context = contextvars.ContextVar("model_call_context", default=("anonymous", INTERACTIVE))
+
+
+class SchedulerBusy(Exception):
+    """排队过长或等待超时，请求被拒绝"""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = max(burst, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """有令牌时取走一个并返回 0，否则返回还需等待的秒数（调用方持有锁）"""
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Waiter:
+    __slots__ = ("user", "priority", "seq", "enqueued")
+
+    def __init__(self, user, priority, seq):
+        self.user = user
+        self.priority = priority
+        self.seq = seq
+        self.enqueued = time.perf_counter()
+
+
+class EndpointScheduler:
+    """单个端点的排队与放行"""
+    def __init__(self, name: str, concurrency: int, rate: float, burst: float,
+                 user_concurrency: int = USER_CONCURRENCY, max_queue: int = MAX_QUEUE, max_wait: float = MAX_WAIT):
+        self.name = name
+        self.concurrency = concurrency
+        self.user_concurrency = user_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.bucket = TokenBucket(rate, burst)
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._running = 0
+        self._user_running = {}
+        self._last_served = {}
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.rejected = 0
+
+    def _next(self):
+        """下一个应被放行的请求：优先级 > 用户正在执行的请求数 > 用户上次被服务的时间 > 到达顺序"""
+        best, best_key = None, None
+        for w in self._waiting:
+            running = self._user_running.get(w.user, 0)
+            if running >= self.user_concurrency:
+                continue
+            key = (_PRIORITY_ORDER.get(w.priority, 1), running, self._last_served.get(w.user, 0.0), w.seq)
+            if best_key is None or key < best_key:
+                best, best_key = w, key
+        return best
+
+    def _reject(self, priority: str, reason: str) -> SchedulerBusy:
+        self.rejected += 1
+        metrics.inc("scheduler_rejected", endpoint=self.name, priority=priority, reason=reason)
+        return SchedulerBusy(f"模型服务繁忙（{self.name}: {reason}），请稍后再试")
+
+    def acquire(self, user: str, priority: str = INTERACTIVE):
+        waiter = _Waiter(user, priority, next(self._seq))
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            if len(self._waiting) >= self.max_queue:
+                raise self._reject(priority, "queue_full")
+            self._waiting.append(waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = deadline - now
+                    if self._running < self.concurrency and self._next() is waiter:
+                        delay = self.bucket.take(now)
+                        if delay == 0:
+                            break
+                        wait = min(wait, delay)
+                    if wait <= 0:
+                        raise self._reject(priority, "timeout")
+                    self._cond.wait(wait)
+            finally:
+                self._waiting.remove(waiter)
+                # 队首变化后其他等待者需要重新判断
+                self._cond.notify_all()
+            self._running += 1
+            self._user_running[user] = self._user_running.get(user, 0) + 1
+            self._last_served[user] = now
+            self.admitted += 1
+            if len(self._last_served) > IDLE_PRUNE_AT:
+                self._prune_idle(now, IDLE_USER_TTL)
+        metrics.observe("scheduler_queue_wait", (time.perf_counter() - waiter.enqueued) * 1000,
+                        endpoint=self.name, priority=priority)
+
+    def release(self, user: str):
+        with self._cond:
+            self._running -= 1
+            running = self._user_running.get(user, 0) - 1
+            if running > 0:
+                self._user_running[user] = running
+            else:
+                self._user_running.pop(user, None)
+            self._cond.notify_all()
+
+    def _prune_idle(self, now: float, max_idle: float) -> int:
+        idle = [u for u, t in self._last_served.items() if now - t > max_idle and u not in self._user_running]
+        for user in idle:
+            del self._last_served[user]
+        return len(idle)
+
+    def prune_idle(self, max_idle: float = IDLE_USER_TTL) -> int:
+        """清理长时间没有请求的用户的记录，返回清理的用户数（否则每个来过的用户都永久留一条）"""
+        with self._cond:
+            return self._prune_idle(time.monotonic(), max_idle)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "running": self._running,
+                "waiting": len(self._waiting),
+                "waiting_bulk": sum(w.priority == BULK for w in self._waiting),
+                "active_users": len(self._user_running),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "concurrency": self.concurrency,
+                "rate": self.bucket.rate,
+            }
+
+
+@functools.lru_cache(maxsize=None)
+def _default_host() -> str:
+    from llm_registry import DEFAULT_BASE_URL
+    return httpx.URL(DEFAULT_BASE_URL).host
+
+
+def endpoint_name(url: httpx.URL) -> str:
+    """请求所属的端点：默认服务为 chat / embed，其他服务带上主机名（chat@api.deepseek.com）"""
+    kind = "embed" if url.path.endswith("/embeddings") else "chat"
+    return kind if url.host == _default_host() else f"{kind}@{url.host}"
+
+
+class ModelScheduler:
+    """按端点（chat / embed / chat@主机名 ...）管理 EndpointScheduler，首次使用时按环境变量创建"""
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def endpoint(self, name: str) -> EndpointScheduler:
+        sched = self._endpoints.get(name)
+        if sched is None:
+            with self._lock:
+                sched = self._endpoints.get(name)
+                if sched is None:
+                    kind = name.split("@", 1)[0]
+                    concurrency, rate = _DEFAULTS.get(kind, (8, 10.0))
+                    prefix = f"SCHED_{kind.upper()}_"
+                    rate = float(os.getenv(prefix + "RPS", str(rate)))
+                    sched = self._endpoints[name] = EndpointScheduler(
+                        name,
+                        concurrency=int(os.getenv(prefix + "CONCURRENCY", str(concurrency))),
+                        rate=rate,
+                        burst=float(os.getenv(prefix + "BURST", str(rate * 2))),
+                    )
+        return sched
+
+    @contextmanager
+    def slot(self, endpoint: str):
+        """在当前上下文的用户/优先级下占用端点的一个执行槽位"""
+        if not ENABLED:
+            yield
+            return
+        user, priority = _context.get()
+        sched = self.endpoint(endpoint)
+        sched.acquire(user, priority)
+        try:
+            yield
+        finally:
+            sched.release(user)
+
+    def snapshot(self) -> dict:
+        return {name: sched.stats() for name, sched in sorted(self._endpoints.items())}
+
+    def memory_report(self) -> dict:
+        from memory_accounting import approx_size
+        endpoints = list(self._endpoints.values())
+        users = {}
+        for sched in endpoints:
+            with sched._cond:
+                users[sched.name] = dict(sched._last_served)
+        return {"bytes": approx_size(users), "items": sum(len(u) for u in users.values())}
+
+    def evict(self, pressure: float) -> dict:
+        return {name: sched.prune_idle() for name, sched in list(self._endpoints.items())}
+
+
+scheduler = ModelScheduler()
+
+
+def current() -> tuple:
+    """当前上下文的 (用户, 优先级)"""
+    return _context.get()
+
+
+@contextmanager
+def scheduling(user: str = None, priority: str = None):
+    """设置此上下文中模型调用所属的用户和优先级；未指定的一项沿用外层设置"""
+    outer_user, outer_priority = _context.get()
+    token = _context.set((user or outer_user, priority or outer_priority))
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def scheduled_stream(stream, user: str = None, priority: str = None):
+    """
+    包装生成器：每次推进都在指定的用户/优先级上下文中进行。
+    Gradio 可能在不同的工作线程里推进同一个生成器，所以不能只在开始时设置一次。
+    """
+    iterator = iter(stream)
+    try:
+        while True:
+            with scheduling(user, priority):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+
+
+class _ReleasingStream(httpx.SyncByteStream):
+    """响应体读完或关闭时释放槽位（流式回答在整个输出期间占用槽位）"""
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                release()
+
+
+class _AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                release()
+
+
+def _busy_response(request: httpx.Request, error: SchedulerBusy) -> httpx.Response:
+    return httpx.Response(429, headers={"x-should-retry": "false"}, request=request,
+                          json={"error": {"message": str(error), "type": "scheduler_busy", "code": "scheduler_busy"}})
+
+
+class ScheduledTransport(httpx.BaseTransport):
+    """
+    httpx 传输层：共享客户端发出的每个模型请求先领取所属端点（服务 + 类型）的调度槽位。
+    被拒绝时直接返回 429（x-should-retry: false，避免 openai 客户端重试放大流量）。
+    """
+    def __init__(self, transport: httpx.BaseTransport, model_scheduler: ModelScheduler = None):
+        self._transport = transport
+        self._scheduler = model_scheduler or scheduler
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if not ENABLED:
+            return self._transport.handle_request(request)
+        user, priority = _context.get()
+        sched = self._scheduler.endpoint(endpoint_name(request.url))
+        try:
+            sched.acquire(user, priority)
+        except SchedulerBusy as e:
+            return _busy_response(request, e)
+        try:
+            response = self._transport.handle_request(request)
+        except BaseException:
+            sched.release(user)
+            raise
+        response.stream = _ReleasingStream(response.stream, lambda: sched.release(user))
+        return response
+
+    def close(self):
+        self._transport.close()
+
+
+class AsyncScheduledTransport(httpx.AsyncBaseTransport):
+    """异步版本：排队在线程池里等待（不阻塞事件循环），槽位与同步客户端共用"""
+    def __init__(self, transport: httpx.AsyncBaseTransport, model_scheduler: ModelScheduler = None):
+        self._transport = transport
+        self._scheduler = model_scheduler or scheduler
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not ENABLED:
+            return await self._transport.handle_async_request(request)
+        user, priority = _context.get()
+        sched = self._scheduler.endpoint(endpoint_name(request.url))
+        try:
+            await asyncio.to_thread(sched.acquire, user, priority)
+        except SchedulerBusy as e:
+            return _busy_response(request, e)
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            sched.release(user)
+            raise
+        response.stream = _AsyncReleasingStream(response.stream, lambda: sched.release(user))
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class ScheduledEmbeddings:
+    """
+    给 embedding 模型加上调度：查询 embedding 占用一个槽位；
+    批量 embedding 按 SCHED_EMBED_BATCH 分批，每批单独排队，批量入库之间可以插入其他人的查询。
+    """
+    def __init__(self, embeddings, model_scheduler: ModelScheduler = None, batch_size: int = EMBED_BATCH):
+        self._embeddings = embeddings
+        self._scheduler = model_scheduler or scheduler
+        self.batch_size = batch_size
+
+    def embed_query(self, text: str):
+        with self._scheduler.slot("embed"):
+            return self._embeddings.embed_query(text)
+
+    def embed_documents(self, texts):
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            with self._scheduler.slot("embed"):
+                vectors.extend(self._embeddings.embed_documents(texts[i:i + self.batch_size]))
+        return vectors
+
+    def embed_queries(self, texts):
+        """批量查询 embedding：后端不支持批量时逐条走 embed_query"""
+        if not hasattr(self._embeddings, "embed_queries"):
+            return [self.embed_query(t) for t in texts]
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            with self._scheduler.slot("embed"):
+                vectors.extend(self._embeddings.embed_queries(texts[i:i + self.batch_size]))
+        return vectors
+
+    def __getattr__(self, name):
+        return getattr(self._embeddings, name)
+
+
+def _register_routes():
+    from memory_accounting import memory
+    from metrics_server import MetricsHandler
+    MetricsHandler.routes["/scheduler.json"] = lambda handler: scheduler.snapshot()
+    memory.register("scheduler", scheduler.memory_report, evict=scheduler.evict)
+
+
+_register_routes()
@@ -0,0 +1,125 @@
+"""
+多进程部署：启动 N 个应用进程（每个进程一个 Gradio 服务），前面放一个本地 TCP 负载均衡器。
+会话历史、登录令牌都在状态后端（STATE_BACKEND，默认 SQLite），所以任意进程都能接着处理同一个会话。
+
+    python 课程助手/serve_workers.py --workers 4 --port 7860 --routing sticky
+
+路由方式：
+    sticky       按客户端 IP 固定到同一个进程。浏览器访问 Gradio 时使用：Gradio 队列的
+                 join/data 请求和页面里的 gr.State 必须落在同一个进程上
+    round_robin  每个 TCP 连接轮询分配，适合无状态的 API 调用（如 gradio_client、压测）
+进程挂掉时请求会转发到下一个存活的进程，会话数据不会丢失（只需重新加载页面）。
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import signal
+import subprocess
+import sys
+import zlib
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+logger = logging.getLogger(__name__)
+
+
+def start_workers(count: int, base_port: int, metrics_base_port: int):
+    """每个进程使用不同的 Gradio 端口和指标端口，共享同一个状态后端"""
+    workers = []
+    for i in range(count):
+        env = dict(os.environ)
+        env.update({
+            "GRADIO_SERVER_PORT": str(base_port + i),
+            "GRADIO_SERVER_NAME": "127.0.0.1",
+            "GRADIO_SHARE": "0",
+            "METRICS_PORT": str(metrics_base_port + i) if metrics_base_port else "0",
+            "STATE_BACKEND": os.getenv("STATE_BACKEND", "sqlite"),
+        })
+        proc = subprocess.Popen([sys.executable, os.path.join(APP_DIR, "界面.py")], env=env)
+        workers.append((proc, base_port + i))
+        logger.info("进程 %s 已启动，端口 %s", proc.pid, base_port + i)
+    return workers
+
+
+class LoadBalancer:
+    def __init__(self, backends, routing: str = "sticky"):
+        self.backends = list(backends)  # [(host, port)]
+        self.routing = routing
+        self._rr = itertools.cycle(range(len(self.backends)))
+
+    def _candidates(self, client_host: str):
+        """按路由方式给出首选进程，后面依次是故障转移的候选"""
+        if self.routing == "sticky":
+            first = zlib.crc32(client_host.encode("utf-8")) % len(self.backends)
+        else:
+            first = next(self._rr)
+        return [self.backends[(first + i) % len(self.backends)] for i in range(len(self.backends))]
+
+    async def handle(self, client_reader, client_writer):
+        client_host = client_writer.get_extra_info("peername")[0]
+        for host, port in self._candidates(client_host):
+            try:
+                upstream_reader, upstream_writer = await asyncio.open_connection(host, port)
+                break
+            except OSError:
+                logger.warning("进程 %s:%s 不可用，尝试下一个", host, port)
+        else:
+            client_writer.close()
+            return
+        await asyncio.gather(self._pipe(client_reader, upstream_writer),
+                             self._pipe(upstream_reader, client_writer))
+
+    @staticmethod
+    async def _pipe(reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            try:
+                writer.close()
+            except Exception:
+                pass
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.info("负载均衡器监听 %s:%s，路由方式 %s，后端 %s", host, port, self.routing, self.backends)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多进程启动课程助手")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=7860, help="负载均衡器端口")
+    parser.add_argument("--base-port", type=int, default=7870, help="第一个应用进程的端口")
+    parser.add_argument("--metrics-base-port", type=int, default=9464, help="第一个进程的指标端口，0 关闭")
+    parser.add_argument("--routing", choices=["sticky", "round_robin"], default="sticky")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    workers = start_workers(args.workers, args.base_port, args.metrics_base_port)
+
+    def shutdown(*_):
+        for proc, _ in workers:
+            proc.terminate()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    balancer = LoadBalancer([("127.0.0.1", port) for _, port in workers], args.routing)
+    try:
+        asyncio.run(balancer.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+启动耗时分析命令：
+    python 课程助手/startup_profile.py                      # 分析导入 agent_with_tools 的耗时
+    python 课程助手/startup_profile.py --module 界面 --top 30
+    python 课程助手/startup_profile.py --warm rag,intent,tools  # 额外测量各组件的预热耗时
+导入耗时使用 `python -X importtime` 在独立子进程中测量，保证是真正的冷启动。
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def profile_import(module: str):
+    """在新进程中导入 module，返回 (总墙钟耗时毫秒, [(累计微秒, 自身微秒, 模块名), ...])"""
+    code = f"import sys; sys.path.insert(0, {BASE_DIR!r}); import {module}"
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          capture_output=True, text=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    if proc.returncode != 0:
+        tail = proc.stderr.strip().splitlines()[-1:] or [""]
+        raise RuntimeError(f"导入 {module} 失败: {tail[0]}")
+    rows = []
+    for line in proc.stderr.splitlines():
+        # 格式：import time:  self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+    return wall_ms, rows
+
+
+def profile_warm_up(components):
+    """在当前进程中测量 AgentRouter 各组件的构造耗时（毫秒）"""
+    sys.path.insert(0, BASE_DIR)
+    from agent_with_tools import AgentRouter
+    timings = {}
+    for name in components:
+        start = time.perf_counter()
+        AgentRouter.warm_up(components=(name,))
+        timings[name] = (time.perf_counter() - start) * 1000
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分析课程助手的导入与启动耗时")
+    parser.add_argument("--module", default="agent_with_tools", help="要分析的模块名")
+    parser.add_argument("--top", type=int, default=20, help="显示累计耗时最多的前 N 个模块")
+    parser.add_argument("--warm", default="", help="逗号分隔的预热组件：rag,intent,tools")
+    args = parser.parse_args()
+
+    wall_ms, rows = profile_import(args.module)
+    total_us = sum(self_us for _, self_us, _ in rows)
+    print(f"导入 {args.module}: 进程墙钟 {wall_ms:.1f}ms，模块导入合计 {total_us / 1000:.1f}ms，共 {len(rows)} 个模块")
+    print(f"{'累计(ms)':>10} {'自身(ms)':>10}  模块")
+    for cumulative_us, self_us, name in sorted(rows, reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:>10.1f} {self_us / 1000:>10.1f}  {name}")
+
+    components = [c.strip() for c in args.warm.split(",") if c.strip()]
+    if components:
+        print("\n组件预热耗时：")
+        for name, ms in profile_warm_up(components).items():
+            print(f"  {name:<8} {ms:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
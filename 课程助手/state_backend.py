@@ -0,0 +1,341 @@
+"""
+会话状态后端：会话消息历史、登录令牌都放在进程外，
+多个应用进程（serve_workers.py 启动）共享同一份状态，任意进程都能接着处理同一个会话。
+
+    STATE_BACKEND=sqlite   默认，本机多进程共享一个 SQLite 文件（WAL 模式）
+    STATE_BACKEND=memory   单进程内存（原来的行为，进程重启即丢失）
+    STATE_BACKEND=redis    网络存储，需要安装 redis 包并设置 REDIS_URL
+
+新增后端只需实现 StateBackend 的几个抽象方法。
+"""
+import abc
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "课程助手/session_state.db")
+LOGIN_TTL_S = int(os.getenv("LOGIN_TTL_S", str(7 * 24 * 3600)))  # 登录令牌有效期
+
+
+def _message_to_json(message) -> str:
+    from langchain_core.messages import message_to_dict
+    return json.dumps(message_to_dict(message), ensure_ascii=False)
+
+
+def _messages_from_json(rows):
+    from langchain_core.messages import messages_from_dict
+    return messages_from_dict([json.loads(r) for r in rows])
+
+
+@functools.lru_cache(maxsize=None)
+def _history_class():
+    """BackendChatMessageHistory：读写直接落到状态后端（延迟导入 LangChain）"""
+    from langchain_core.chat_history import BaseChatMessageHistory
+
+    class BackendChatMessageHistory(BaseChatMessageHistory):
+        def __init__(self, backend, session_id):
+            self.backend = backend
+            self.session_id = session_id
+
+        @property
+        def messages(self):
+            return self.backend.get_messages(self.session_id)
+
+        def add_messages(self, messages):
+            self.backend.append_messages(self.session_id, list(messages))
+
+        def clear(self):
+            self.backend.clear_messages(self.session_id)
+
+    return BackendChatMessageHistory
+
+
+class StateBackend(abc.ABC):
+    """状态后端接口"""
+
+    # 会话消息历史
+    @abc.abstractmethod
+    def get_messages(self, session_id: str) -> list:
+        ...
+
+    @abc.abstractmethod
+    def append_messages(self, session_id: str, messages) -> None:
+        ...
+
+    @abc.abstractmethod
+    def clear_messages(self, session_id: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def seed_messages(self, session_id: str, messages) -> bool:
+        """会话还没有消息时写入（从历史库导入用），已有消息时不写；返回是否写入。多个进程同时导入同一会话只有一个生效"""
+
+    # 登录身份
+    @abc.abstractmethod
+    def create_login(self, username: str) -> str:
+        ...
+
+    @abc.abstractmethod
+    def resolve_login(self, token: str):
+        """令牌对应的用户名，令牌无效或过期返回 None"""
+
+    @abc.abstractmethod
+    def revoke_login(self, token: str) -> None:
+        ...
+
+    def get_history(self, session_id: str):
+        """返回 LangChain 的 BaseChatMessageHistory，读写都直接落到后端"""
+        return _history_class()(self, session_id)
+
+    # 内存统计（见 memory_accounting.py）：进程外的后端不占本进程内存
+    def memory_report(self) -> dict:
+        return {"bytes": 0, "items": 0, "backend": type(self).__name__}
+
+    def evict(self, pressure: float) -> dict:
+        return {}
+
+
+class MemoryStateBackend(StateBackend):
+    """进程内存后端：只适合单进程运行"""
+    def __init__(self):
+        self._messages = {}
+        self._logins = {}
+        self._lock = threading.Lock()
+
+    def get_messages(self, session_id):
+        with self._lock:
+            return list(self._messages.get(session_id, []))
+
+    def append_messages(self, session_id, messages):
+        with self._lock:
+            self._messages.setdefault(session_id, []).extend(messages)
+
+    def clear_messages(self, session_id):
+        with self._lock:
+            self._messages.pop(session_id, None)
+
+    def seed_messages(self, session_id, messages):
+        with self._lock:
+            if self._messages.get(session_id):
+                return False
+            self._messages[session_id] = list(messages)
+        return True
+
+    def create_login(self, username):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._logins[token] = (username, time.time() + LOGIN_TTL_S)
+        return token
+
+    def resolve_login(self, token):
+        with self._lock:
+            item = self._logins.get(token)
+        if item and item[1] > time.time():
+            return item[0]
+        return None
+
+    def revoke_login(self, token):
+        with self._lock:
+            self._logins.pop(token, None)
+
+    def memory_report(self):
+        from memory_accounting import approx_size
+        with self._lock:
+            messages = {sid: list(items) for sid, items in self._messages.items()}
+            logins = len(self._logins)
+        sessions = {sid: approx_size(items) for sid, items in messages.items()}
+        return {"bytes": sum(sessions.values()), "items": sum(len(m) for m in messages.values()),
+                "sessions": sessions, "logins": logins, "backend": type(self).__name__}
+
+    def evict(self, pressure):
+        """会话历史是唯一的副本，不能淘汰；只清理过期的登录令牌"""
+        now = time.time()
+        with self._lock:
+            expired = [token for token, (_, expires) in self._logins.items() if expires <= now]
+            for token in expired:
+                del self._logins[token]
+        return {"expired_logins": len(expired)}
+
+
+class SQLiteStateBackend(StateBackend):
+    """
+    SQLite 后端：WAL 模式下多个进程可以同时读、串行写，适合单机多进程部署。
+    每个线程使用自己的连接（sqlite3 连接不能跨线程共享）。
+    """
+    def __init__(self, path: str = STATE_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS session_messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                message TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_session_messages ON session_messages (session_id, seq);
+            CREATE TABLE IF NOT EXISTS login_tokens (
+                token TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_login_tokens_expiry ON login_tokens (expires_at);
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_messages(self, session_id):
+        rows = self._conn().execute(
+            "SELECT message FROM session_messages WHERE session_id = ? ORDER BY seq", (session_id,)
+        ).fetchall()
+        return _messages_from_json([r[0] for r in rows])
+
+    def append_messages(self, session_id, messages):
+        rows = [(session_id, _message_to_json(m)) for m in messages]
+        if not rows:
+            return
+        conn = self._conn()
+        # 一轮对话的多条消息放在同一个事务里写入
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("INSERT INTO session_messages (session_id, message) VALUES (?, ?)", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear_messages(self, session_id):
+        self._conn().execute("DELETE FROM session_messages WHERE session_id = ?", (session_id,))
+
+    def seed_messages(self, session_id, messages):
+        rows = [(session_id, _message_to_json(m)) for m in messages]
+        if not rows:
+            return False
+        conn = self._conn()
+        # 检查和写入在同一个写事务里：其他进程的导入要等这里提交，之后看到已有消息就不再写
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM session_messages WHERE session_id = ? LIMIT 1", (session_id,)).fetchone():
+                conn.execute("COMMIT")
+                return False
+            conn.executemany("INSERT INTO session_messages (session_id, message) VALUES (?, ?)", rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def create_login(self, username):
+        token = uuid.uuid4().hex
+        conn = self._conn()
+        conn.execute("INSERT INTO login_tokens (token, username, expires_at) VALUES (?, ?, ?)",
+                     (token, username, time.time() + LOGIN_TTL_S))
+        # 每次登录顺带清理过期令牌（按 expires_at 索引删除，很快）
+        self.purge_expired_logins()
+        return token
+
+    def purge_expired_logins(self) -> int:
+        return self._conn().execute("DELETE FROM login_tokens WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    def resolve_login(self, token):
+        row = self._conn().execute("SELECT username FROM login_tokens WHERE token = ? AND expires_at > ?",
+                                   (token, time.time())).fetchone()
+        return row[0] if row else None
+
+    def revoke_login(self, token):
+        self._conn().execute("DELETE FROM login_tokens WHERE token = ?", (token,))
+
+    def evict(self, pressure):
+        return {"expired_logins": self.purge_expired_logins()}
+
+
+class RedisStateBackend(StateBackend):
+    """Redis 后端：多台机器部署时使用，键带 course: 前缀"""
+    def __init__(self, url: str = None):
+        import redis
+        self.client = redis.Redis.from_url(url or os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0"))
+
+    def get_messages(self, session_id):
+        rows = self.client.lrange(f"course:messages:{session_id}", 0, -1)
+        return _messages_from_json([r.decode("utf-8") for r in rows])
+
+    def append_messages(self, session_id, messages):
+        rows = [_message_to_json(m) for m in messages]
+        if rows:
+            self.client.rpush(f"course:messages:{session_id}", *rows)
+
+    def clear_messages(self, session_id):
+        self.client.delete(f"course:messages:{session_id}")
+
+    def seed_messages(self, session_id, messages):
+        import redis
+        rows = [_message_to_json(m) for m in messages]
+        if not rows:
+            return False
+        key = f"course:messages:{session_id}"
+        with self.client.pipeline() as pipe:
+            try:
+                # WATCH 之后键被其他进程写入时 EXEC 失败：别人已经导入（或已经开始对话）
+                pipe.watch(key)
+                if pipe.llen(key):
+                    return False
+                pipe.multi()
+                pipe.rpush(key, *rows)
+                pipe.execute()
+            except redis.WatchError:
+                return False
+        return True
+
+    def create_login(self, username):
+        token = uuid.uuid4().hex
+        self.client.set(f"course:login:{token}", username, ex=LOGIN_TTL_S)
+        return token
+
+    def resolve_login(self, token):
+        value = self.client.get(f"course:login:{token}")
+        return value.decode("utf-8") if value else None
+
+    def revoke_login(self, token):
+        self.client.delete(f"course:login:{token}")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_state_backend() -> StateBackend:
+    """按 STATE_BACKEND 创建进程内唯一的状态后端"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                kind = os.getenv("STATE_BACKEND", "sqlite")
+                if kind == "memory":
+                    _backend = MemoryStateBackend()
+                elif kind == "redis":
+                    _backend = RedisStateBackend()
+                else:
+                    _backend = SQLiteStateBackend(os.getenv("STATE_DB_PATH", STATE_DB_PATH))
+    return _backend
+
+
+def _register_memory():
+    from memory_accounting import memory
+    memory.register("state_backend",
+                    lambda: _backend.memory_report() if _backend is not None else {"bytes": 0, "items": 0},
+                    evict=lambda pressure: _backend.evict(pressure) if _backend is not None else {})
+
+
+_register_memory()
@@ -0,0 +1,54 @@
+"""
+流式输出合帧：把模型逐个产出的 token 按固定帧率合并成"帧"再推送给前端，
+避免每个 token 都触发一次 Gradio 更新。帧率通过环境变量 STREAM_MAX_FPS 配置（默认 15 帧/秒，0 表示不合帧）。
+"""
+import os
+import time
+
+
+class TokenCoalescer:
+    def __init__(self, max_fps: float = None, clock=time.monotonic):
+        """
+        :param max_fps: 每秒最多推送的帧数，None 时读取 STREAM_MAX_FPS
+        :param clock: 计时函数，基准测试中可以替换为模拟时钟
+        """
+        if max_fps is None:
+            max_fps = float(os.getenv("STREAM_MAX_FPS", "15"))
+        self.interval = 1.0 / max_fps if max_fps > 0 else 0.0
+        self.clock = clock
+        self.tokens_in = 0
+        self.frames_out = 0
+
+    def frames(self, tokens):
+        """
+        消费 token 迭代器，产出合并后的增量文本（delta）。
+        空白 token（空格、换行）同样保留，保证 Markdown 排版正确；只丢弃 None 和空字符串。
+        """
+        buffer = []
+        last_emit = self.clock()
+        for token in tokens:
+            if not token:
+                continue
+            self.tokens_in += 1
+            buffer.append(token)
+            now = self.clock()
+            if now - last_emit >= self.interval:
+                self.frames_out += 1
+                yield "".join(buffer)
+                buffer.clear()
+                last_emit = now
+        # 结束时把剩余内容作为最后一帧推送
+        if buffer:
+            self.frames_out += 1
+            yield "".join(buffer)
+
+
+def stream_to_message(tokens, max_fps: float = None, clock=time.monotonic):
+    """
+    把 token 流转换为"最后一条助手消息的完整内容"序列：每帧产出 (累计文本, 本帧增量)。
+    调用方只需更新 chat_history 的最后一条消息，Gradio 会按增量(diff)把变化发送给浏览器。
+    """
+    text = ""
+    for delta in TokenCoalescer(max_fps, clock).frames(tokens):
+        text += delta
+        yield text, delta
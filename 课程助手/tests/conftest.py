@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 应用模块是 课程助手/ 下的平铺模块（界面.py 同样从这个目录导入）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,58 @@
+import threading
+import time
+
+import pytest
+from langchain_core.messages import AIMessageChunk
+
+from cancellation import CancelToken, TurnCancelled, bound, current_token
+from model_gateway import GatewayChatModel, Provider
+from tracing import metrics
+
+
+class _HangingModel:
+    """首 token 之前一直等待，直到所在请求被关闭（模拟卡住的上游）"""
+    def __init__(self):
+        self.calls = 0
+
+    def stream(self, messages, stop=None, **kwargs):
+        self.calls += 1
+        token = current_token()
+        deadline = time.monotonic() + 5
+        while not token.cancelled and time.monotonic() < deadline:
+            time.sleep(0.01)
+        raise ConnectionError("连接已关闭")
+        yield AIMessageChunk(content="")
+
+
+class _FakeProvider(Provider):
+    def __init__(self, name, model):
+        super().__init__(name, "fake", "http://127.0.0.1:1", "FAKE_API_KEY")
+        self.model_instance = model
+
+    def chat_model(self, model=None, **params):
+        return self.model_instance
+
+
+def _retries():
+    return sum(c["value"] for c in metrics.snapshot()["counters"] if c["counter"] == "gateway_retries")
+
+
+def test_cancel_before_first_token_does_not_retry_or_trip_breaker():
+    primary_model, backup_model = _HangingModel(), _HangingModel()
+    primary, backup = _FakeProvider("primary", primary_model), _FakeProvider("backup", backup_model)
+    gateway = GatewayChatModel(routes=[(primary, {}), (backup, {})], streaming=True,
+                               ttft_timeout=5, retries=2, hedge=True)
+    retries_before = _retries()
+    turn = CancelToken("chat-1", record=False)
+    threading.Timer(0.2, turn.cancel, args=("superseded",)).start()
+
+    start = time.monotonic()
+    with bound(turn), pytest.raises(TurnCancelled):
+        list(gateway.stream("你好"))
+
+    assert time.monotonic() - start < 2, "取消后应立即结束，而不是等到首 token 超时"
+    assert primary_model.calls == 1
+    assert backup_model.calls == 0, "已取消的轮次不应再对冲"
+    assert primary.breaker.failures == 0 and backup.breaker.failures == 0
+    assert primary.breaker.state == "closed"
+    assert _retries() == retries_before
@@ -0,0 +1,32 @@
+from langchain_core.tools import StructuredTool
+from pydantic import BaseModel, Field
+
+from web_cache import _session, web_cache, with_web_cache
+
+
+class _SearchSchema(BaseModel):
+    query: str = Field(description="搜索关键词")
+
+
+def _fake_search(query: str) -> str:
+    return f"关于{query}的搜索结果：课程助手支持联网搜索和网页缓存。"
+
+
+def _wrapped_search():
+    tool = StructuredTool.from_function(func=_fake_search, name="tavily_search",
+                                        description="联网搜索", args_schema=_SearchSchema)
+    return {t.name: t for t in with_web_cache([tool])}["tavily_search"]
+
+
+def test_wrapped_tool_accepts_plain_string_input():
+    wrapped = _wrapped_search()
+    token = _session.set("chat-string-input")
+    try:
+        # ReAct Agent 的调用方式：整个输入是一个字符串
+        assert wrapped.run("网页缓存") == _fake_search("网页缓存")
+        assert wrapped.invoke({"query": "联网搜索"}) == _fake_search("联网搜索")
+    finally:
+        _session.reset(token)
+    results, _ = web_cache.search("chat-string-input", "网页缓存")
+    assert results
+    web_cache.drop("chat-string-input")
@@ -0,0 +1,212 @@
+"""
+轻量级的分阶段耗时追踪。
+每个阶段用 span("阶段名") 包起来，耗时（毫秒）汇总到直方图中，由 metrics_server 以 Prometheus 文本或 JSON 暴露。
+为了让开销可以忽略，span 按 TRACE_SAMPLE_RATE（默认 0.2）随机采样，未采样时几乎不做任何事情；
+采样按链路决定：一轮对话开始时调用 begin_trace() 决定一次，这一轮里的所有 span 跟随同一个决定，
+采到的轮次各阶段齐全；不在任何链路里的 span（后台任务等）各自决定。
+计数器（counter）不采样，总是累加。
+"""
+import contextvars
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.2"))
+_trace_sampled = contextvars.ContextVar("trace_sampled", default=None)
+# 直方图桶的上界（毫秒）
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个是 +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, upper in enumerate(self.buckets):
+            if value <= upper:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """按桶估算分位数（返回所在桶的上界）"""
+        if not self.count:
+            return 0.0
+        target, seen = q * self.count, 0
+        for i, upper in enumerate(self.buckets):
+            seen += self.counts[i]
+            if seen >= target:
+                return float(upper)
+        return float("inf")
+
+
+class MetricsRegistry:
+    def __init__(self, sample_rate: float = SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def observe(self, name: str, value_ms: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram()
+            hist.observe(value_ms)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """当前值类指标（内存占用等），每次覆盖"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def snapshot(self) -> dict:
+        """JSON 友好的快照：每个直方图给出 count/sum/avg/p50/p95/p99，以及全部计数器"""
+        with self._lock:
+            spans = []
+            for (name, labels), hist in sorted(self._histograms.items()):
+                spans.append({
+                    "span": name,
+                    "labels": dict(labels),
+                    "count": hist.count,
+                    "sum_ms": round(hist.sum, 3),
+                    "avg_ms": round(hist.sum / hist.count, 3) if hist.count else 0.0,
+                    "p50_ms": hist.quantile(0.5),
+                    "p95_ms": hist.quantile(0.95),
+                    "p99_ms": hist.quantile(0.99),
+                })
+            counters = [{"counter": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            gauges = [{"gauge": name, "labels": dict(labels), "value": value}
+                      for (name, labels), value in sorted(self._gauges.items())]
+        return {"sample_rate": self.sample_rate, "spans": spans, "counters": counters, "gauges": gauges}
+
+    def render_prometheus(self, prefix: str = "course_assistant") -> str:
+        """Prometheus 文本格式"""
+        def fmt(labels, extra=None):
+            items = list(labels) + (extra or [])
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in items) + "}"
+
+        lines = [f"# TYPE {prefix}_span_duration_ms histogram"]
+        with self._lock:
+            for (name, labels), hist in sorted(self._histograms.items()):
+                base = [("span", name)] + list(labels)
+                cumulative = 0
+                for upper, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    lines.append(f"{prefix}_span_duration_ms_bucket{fmt(base, [('le', upper)])} {cumulative}")
+                lines.append(f"{prefix}_span_duration_ms_bucket{fmt(base, [('le', '+Inf')])} {hist.count}")
+                lines.append(f"{prefix}_span_duration_ms_sum{fmt(base)} {hist.sum:.3f}")
+                lines.append(f"{prefix}_span_duration_ms_count{fmt(base)} {hist.count}")
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {prefix}_{name}_total counter")
+                    typed.add(name)
+                lines.append(f"{prefix}_{name}_total{fmt(labels)} {value}")
+            for (name, labels), value in sorted(self._gauges.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {prefix}_{name} gauge")
+                    typed.add(name)
+                lines.append(f"{prefix}_{name}{fmt(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+
+def _escape_label(value) -> str:
+    """Prometheus 标签值转义：反斜杠、双引号、换行"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = MetricsRegistry()
+
+
+def begin_trace() -> bool:
+    """在当前上下文开始一条链路并决定是否采样（每轮对话调用一次，之后的 span 都跟随这个决定）"""
+    decision = metrics.sampled()
+    _trace_sampled.set(decision)
+    return decision
+
+
+def sampled() -> bool:
+    """当前链路是否采样；不在链路里时单独决定"""
+    decision = _trace_sampled.get()
+    return metrics.sampled() if decision is None else decision
+
+
+@contextmanager
+def span(name: str, **labels):
+    """记录一个阶段的耗时；未被采样时直接执行，不计时"""
+    if not sampled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(name, (time.perf_counter() - start) * 1000, **labels)
+
+
+def trace_stream(name: str, stream, **labels):
+    """
+    包装一个流式生成器：记录首个输出的时间（{name}_ttft）和总耗时（{name}_total）。
+    是否采样在开始时决定一次（在链路里时跟随链路）。
+    """
+    if not sampled():
+        yield from stream
+        return
+    start = time.perf_counter()
+    first = True
+    for item in stream:
+        if first:
+            metrics.observe(f"{name}_ttft", (time.perf_counter() - start) * 1000, **labels)
+            first = False
+        yield item
+    metrics.observe(f"{name}_total", (time.perf_counter() - start) * 1000, **labels)
+
+
+class TracedEmbeddings:
+    """给 embedding 模型加上耗时追踪（query embedding / 文档批量 embedding），其余属性透传"""
+    def __init__(self, embeddings):
+        self._embeddings = embeddings
+
+    def embed_query(self, text: str):
+        with span("embed_query"):
+            return self._embeddings.embed_query(text)
+
+    def embed_documents(self, texts):
+        with span("embed_documents"):
+            return self._embeddings.embed_documents(texts)
+
+    def embed_queries(self, texts):
+        from batching import embed_queries
+        with span("embed_queries"):
+            return embed_queries(self._embeddings, texts)
+
+    def __getattr__(self, name):
+        return getattr(self._embeddings, name)
@@ -0,0 +1,371 @@
+"""
+用户上传的存储生命周期：配额、过期与孤儿回收。
+每次上传在清单（SQLite，默认在向量库根目录下的 uploads.db）里登记一行，记录原始文件、向量数、导入的 CSV 表，
+文件、向量和表总是一起删除：
+    - 配额：写入向量之前先按用户预留（字节数、向量块数），超过时拒绝本次上传（QuotaExceeded）
+    - 过期：上传超过 UPLOAD_TTL_DAYS 天后删除
+    - 回收（后台每 UPLOAD_GC_INTERVAL 秒一次）：
+        超时未完成的上传（进程在上传中途退出）回滚；删除到一半的上传重新删除；
+        清单里没有的文件、向量和 CSV 表作为孤儿删除
+删除的顺序是 标记为 deleting -> 删向量 -> 删表 -> 删文件 -> 删清单行，每一步都可以重复执行，中途失败由下一次回收继续。
+登记在写入向量之前、回收时先扫描向量和文件再读清单，所以正在进行的上传不会被当成孤儿。
+引入清单之前的旧数据在第一次回收时按 (用户, 文件名) 登记（adopt），不会被当成孤儿删除。
+管理接口：GET /uploads.json（挂在指标服务上）按用户汇总占用。
+配置：
+    UPLOADS_DB_PATH           清单路径（默认 <向量库根目录>/uploads.db）
+    UPLOAD_QUOTA_MB           每个用户的文件总大小上限（默认 100，0 表示不限）
+    UPLOAD_QUOTA_CHUNKS       每个用户的向量块数上限（默认 5000，0 表示不限）
+    UPLOAD_TTL_DAYS           上传保留天数（默认 30，0 表示不过期）
+    UPLOAD_GC_INTERVAL        后台回收间隔秒数（默认 3600，0 表示不启动）
+    UPLOAD_PENDING_TIMEOUT    上传超过这么多秒仍未完成视为中断（默认 3600）
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from collections import defaultdict
+
+from tracing import metrics
+
+logger = logging.getLogger(__name__)
+
+QUOTA_MB = float(os.getenv("UPLOAD_QUOTA_MB", "100"))
+QUOTA_CHUNKS = int(os.getenv("UPLOAD_QUOTA_CHUNKS", "5000"))
+TTL_DAYS = float(os.getenv("UPLOAD_TTL_DAYS", "30"))
+GC_INTERVAL = float(os.getenv("UPLOAD_GC_INTERVAL", "3600"))
+PENDING_TIMEOUT = float(os.getenv("UPLOAD_PENDING_TIMEOUT", "3600"))
+SCAN_PAGE = 1000  # 扫描向量库时每页的条数
+
+_managers = weakref.WeakSet()
+
+
+class QuotaExceeded(Exception):
+    """用户的上传配额不足"""
+
+
+class UploadLifecycle:
+    def __init__(self, rag, db_path: str, upload_directory: str, quota_mb: float = QUOTA_MB,
+                 quota_chunks: int = QUOTA_CHUNKS, ttl_days: float = TTL_DAYS):
+        """
+        :param rag: RAGProcess，通过它的 user_writes / user_vector_store / csv_tables 删除向量和表
+        """
+        self.rag = rag
+        self.db_path = db_path
+        self.upload_directory = upload_directory
+        self.quota_bytes = int(quota_mb * 1024 * 1024)
+        self.quota_chunks = quota_chunks
+        self.ttl_s = ttl_days * 86400
+        self.last_gc = None
+        self._local = threading.local()
+        self._gc_lock = threading.Lock()
+        self._thread = None
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                upload_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                original_file TEXT NOT NULL,
+                saved_path TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                table_name TEXT,
+                bytes INTEGER NOT NULL,
+                chunks INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_uploads_user ON uploads (user_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_uploads_status ON uploads (status, created_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS upload_meta (key TEXT PRIMARY KEY, value TEXT)")
+        _managers.add(self)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if os.path.dirname(self.db_path):
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    # ---------- 上传 ----------
+    def reserve(self, user_id: str, original_file: str, size: int, chunks: int, kind: str = "document") -> dict:
+        """
+        检查配额并登记一次进行中的上传（未完成的上传也计入配额，并发上传不会一起超额）。
+        返回 {"upload_id", "saved_path"}：向量的 metadata 带上 upload_id，原始文件保存到 saved_path。
+        """
+        upload_id = str(uuid.uuid4())
+        saved_path = os.path.join(self.upload_directory, f"{user_id}_{upload_id}_{original_file}")
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            used_bytes, used_chunks = conn.execute(
+                "SELECT COALESCE(SUM(bytes), 0), COALESCE(SUM(chunks), 0) FROM uploads "
+                "WHERE user_id = ? AND status != 'deleting'", (user_id,)).fetchone()
+            if self.quota_bytes and used_bytes + size > self.quota_bytes:
+                metrics.inc("upload_quota_rejected", kind="bytes")
+                raise QuotaExceeded(f"上传空间不足：已使用 {used_bytes / 1024 / 1024:.1f}MB，"
+                                    f"{original_file} 需要 {size / 1024 / 1024:.1f}MB，"
+                                    f"上限 {self.quota_bytes / 1024 / 1024:.0f}MB；请先删除不需要的文件")
+            if self.quota_chunks and used_chunks + chunks > self.quota_chunks:
+                metrics.inc("upload_quota_rejected", kind="chunks")
+                raise QuotaExceeded(f"上传内容过多：已有 {used_chunks} 个片段，{original_file} 需要 {chunks} 个，"
+                                    f"上限 {self.quota_chunks}；请先删除不需要的文件")
+            conn.execute("INSERT INTO uploads VALUES (?, ?, ?, ?, ?, NULL, ?, ?, 'pending', ?)",
+                         (upload_id, user_id, original_file, saved_path, kind, size, chunks, time.time()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return {"upload_id": upload_id, "saved_path": saved_path}
+
+    def activate(self, upload_id: str):
+        """向量和文件都已写好，上传完成"""
+        self._conn().execute("UPDATE uploads SET status = 'active' WHERE upload_id = ?", (upload_id,))
+
+    def attach_table(self, upload_id: str, table_name: str):
+        """登记上传导入的 CSV 表，之后删除上传时一起删除"""
+        self._conn().execute("UPDATE uploads SET table_name = ? WHERE upload_id = ?", (table_name, upload_id))
+
+    def abort(self, upload_id: str):
+        """上传失败或取消：删除已经写入的部分"""
+        self._remove(self._row(upload_id), "aborted")
+
+    # ---------- 删除 ----------
+    def _row(self, upload_id: str):
+        cursor = self._conn().execute("SELECT * FROM uploads WHERE upload_id = ?", (upload_id,))
+        row = cursor.fetchone()
+        return dict(zip([c[0] for c in cursor.description], row)) if row else None
+
+    def _rows(self, where: str, params=()):
+        cursor = self._conn().execute(f"SELECT * FROM uploads WHERE {where}", params)
+        names = [c[0] for c in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def _remove(self, row, reason: str) -> bool:
+        if row is None:
+            return False
+        self._conn().execute("UPDATE uploads SET status = 'deleting' WHERE upload_id = ?", (row["upload_id"],))
+        self.rag.user_writes.delete(where={"upload_id": row["upload_id"]})
+        if row["table_name"]:
+            self.rag.csv_tables.drop_table(row["table_name"])
+        if os.path.exists(row["saved_path"]):
+            os.remove(row["saved_path"])
+        self._conn().execute("DELETE FROM uploads WHERE upload_id = ?", (row["upload_id"],))
+        metrics.inc("uploads_removed", reason=reason)
+        return True
+
+    def _remove_all(self, rows, reason: str) -> int:
+        removed = 0
+        for row in rows:
+            try:
+                removed += self._remove(row, reason)
+            except Exception as e:
+                # 行保持 deleting 状态，下一次回收继续删除
+                logger.warning("删除上传 %s（%s）失败: %s", row["upload_id"], row["original_file"], e)
+        return removed
+
+    def delete(self, user_id: str, original_file: str = None) -> int:
+        """删除用户已完成的上传（某个文件或全部），返回删除的上传数"""
+        if original_file is None:
+            rows = self._rows("user_id = ? AND status = 'active'", (user_id,))
+        else:
+            rows = self._rows("user_id = ? AND original_file = ? AND status = 'active'", (user_id, original_file))
+        return self._remove_all(rows, "deleted")
+
+    def expire(self, now: float = None) -> int:
+        """删除超过保留期限的上传"""
+        if not self.ttl_s:
+            return 0
+        cutoff = (now or time.time()) - self.ttl_s
+        return self._remove_all(self._rows("status = 'active' AND created_at < ?", (cutoff,)), "expired")
+
+    # ---------- 回收 ----------
+    def _scan_vectors(self):
+        """逐页读取用户库的 (向量ID, metadata)"""
+        collection = self.rag.user_vector_store._collection
+        offset = 0
+        while True:
+            page = collection.get(include=["metadatas"], limit=SCAN_PAGE, offset=offset)
+            if not page["ids"]:
+                return
+            yield from zip(page["ids"], page["metadatas"])
+            offset += len(page["ids"])
+
+    def _adopted(self) -> bool:
+        row = self._conn().execute("SELECT value FROM upload_meta WHERE key = 'adopted'").fetchone()
+        return row is not None
+
+    def _claim_adoption(self) -> bool:
+        """
+        多个进程同时回收时只让一个进程登记旧上传（否则同一文件会登记多行，配额重复计算）。
+        认领超过 UPLOAD_PENDING_TIMEOUT 秒仍未完成（进程中途退出）时可以重新认领。
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            claims = dict(conn.execute("SELECT key, value FROM upload_meta WHERE key IN ('adopted', 'adopting')"))
+            if "adopted" in claims or ("adopting" in claims and time.time() - float(claims["adopting"]) < PENDING_TIMEOUT):
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("INSERT OR REPLACE INTO upload_meta VALUES ('adopting', ?)", (str(time.time()),))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def adopt(self) -> int:
+        """把引入清单之前的上传按 (用户, 文件名) 登记：合并为一个 upload_id，从现在开始计算保留期限"""
+        if not self._claim_adoption():
+            return 0
+        try:
+            return self._adopt()
+        except BaseException:
+            # 放弃认领，下一轮（或其他进程）重新登记；已改写 upload_id 但没有清单行的向量仍按旧上传处理
+            self._conn().execute("DELETE FROM upload_meta WHERE key = 'adopting'")
+            raise
+
+    def _adopt(self) -> int:
+        legacy = defaultdict(list)
+        known = {row[0] for row in self._conn().execute("SELECT upload_id FROM uploads")}
+        for vector_id, metadata in self._scan_vectors():
+            metadata = metadata or {}
+            if metadata.get("upload_id") not in known and "user_id" in metadata:
+                legacy[(metadata["user_id"], metadata.get("original_file", ""))].append((vector_id, metadata))
+        files = os.listdir(self.upload_directory) if os.path.isdir(self.upload_directory) else []
+        collection = self.rag.user_vector_store._collection
+        for (user_id, original_file), vectors in legacy.items():
+            upload_id = str(uuid.uuid4())
+            # 旧的保存文件名为 <用户>_<uuid>_<原文件名>
+            saved = next((os.path.join(self.upload_directory, name) for name in files
+                          if name.startswith(f"{user_id}_") and name.endswith(f"_{original_file}")
+                          and len(name) == len(user_id) + len(original_file) + 38), "")
+            table_name = next((m.get("table") for _, m in vectors if m.get("kind") == "csv_table"), None)
+            for i in range(0, len(vectors), SCAN_PAGE):
+                page = vectors[i:i + SCAN_PAGE]
+                collection.update(ids=[v for v, _ in page], metadatas=[{**m, "upload_id": upload_id} for _, m in page])
+            self._conn().execute(
+                "INSERT INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'active', ?)",
+                (upload_id, user_id, original_file, saved, "csv_table" if table_name else "document", table_name,
+                 os.path.getsize(saved) if saved else 0, len(vectors), time.time()))
+        self._conn().execute("INSERT OR REPLACE INTO upload_meta VALUES ('adopted', ?)", (str(time.time()),))
+        self._conn().execute("DELETE FROM upload_meta WHERE key = 'adopting'")
+        if legacy:
+            logger.info("登记了 %d 个引入清单之前的上传", len(legacy))
+        return len(legacy)
+
+    def gc(self, now: float = None) -> dict:
+        """回滚中断的上传、重试删除到一半的上传、删除孤儿文件/向量/表，返回各项数量"""
+        with self._gc_lock:
+            start = time.perf_counter()
+            now = now or time.time()
+            result = {"adopted": 0 if self._adopted() else self.adopt()}
+            result["stale"] = self._remove_all(
+                self._rows("status = 'pending' AND created_at < ?", (now - PENDING_TIMEOUT,)), "stale")
+            result["retried"] = self._remove_all(self._rows("status = 'deleting'"), "retried")
+            if not self._adopted():
+                # 另一个进程正在登记旧上传：它们的向量还不在清单中，本轮不回收孤儿，以免误删
+                result["ms"] = round((time.perf_counter() - start) * 1000, 1)
+                self.last_gc = {"at": now, **result}
+                return result
+
+            # 先扫描再读清单：扫描之后才登记的上传不会出现在扫描结果里
+            vectors = dict(self._scan_vectors())
+            files = [name for name in os.listdir(self.upload_directory)
+                     if os.path.isfile(os.path.join(self.upload_directory, name))] if os.path.isdir(self.upload_directory) else []
+            tables = self.rag.csv_tables.all_tables()
+            rows = self._rows("1 = 1")
+            upload_ids = {r["upload_id"] for r in rows}
+            saved = {os.path.basename(r["saved_path"]) for r in rows}
+            table_names = {r["table_name"] for r in rows if r["table_name"]}
+
+            orphan_vectors = [v for v, metadata in vectors.items() if (metadata or {}).get("upload_id") not in upload_ids]
+            # 文件在向量写完之后才移动进来；刚修改过的文件留到下一轮再判断
+            orphan_files = [name for name in files if name not in saved
+                            and now - os.path.getmtime(os.path.join(self.upload_directory, name)) > PENDING_TIMEOUT]
+            orphan_tables = [t for t, created_at in tables.items()
+                             if t not in table_names and now - created_at > PENDING_TIMEOUT]
+            for i in range(0, len(orphan_vectors), SCAN_PAGE):
+                self.rag.user_writes.delete(ids=orphan_vectors[i:i + SCAN_PAGE])
+            for name in orphan_files:
+                os.remove(os.path.join(self.upload_directory, name))
+            for table in orphan_tables:
+                self.rag.csv_tables.drop_table(table)
+            for kind, items in (("vectors", orphan_vectors), ("files", orphan_files), ("tables", orphan_tables)):
+                result[f"orphan_{kind}"] = len(items)
+                if items:
+                    metrics.inc("upload_gc_orphans", len(items), kind=kind)
+            result["ms"] = round((time.perf_counter() - start) * 1000, 1)
+            self.last_gc = {"at": now, **result}
+            logger.info("上传回收: %s", result)
+            return result
+
+    def start(self, interval: float = GC_INTERVAL):
+        """后台定期过期与回收（interval 为 0 时不启动）"""
+        if not interval or self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.expire()
+                    self.gc()
+                except Exception:
+                    logger.exception("上传回收出错")
+
+        self._thread = threading.Thread(target=loop, name="upload-gc", daemon=True)
+        self._thread.start()
+
+    # ---------- 统计 ----------
+    def usage(self, user_id: str) -> dict:
+        files, size, chunks = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(chunks), 0) FROM uploads "
+            "WHERE user_id = ? AND status != 'deleting'", (user_id,)).fetchone()
+        return {"files": files, "bytes": size, "chunks": chunks,
+                "quota_bytes": self.quota_bytes, "quota_chunks": self.quota_chunks}
+
+    def report(self, top: int = 50) -> dict:
+        """按用户汇总占用（按字节数降序），以及各状态的上传数和上一次回收的结果"""
+        conn = self._conn()
+        users = conn.execute(
+            "SELECT user_id, COUNT(*), SUM(bytes), SUM(chunks), MIN(created_at) FROM uploads "
+            "WHERE status = 'active' GROUP BY user_id ORDER BY SUM(bytes) DESC").fetchall()
+        statuses = dict(conn.execute("SELECT status, COUNT(*) FROM uploads GROUP BY status").fetchall())
+        total_bytes = sum(u[2] for u in users)
+        metrics.set_gauge("upload_bytes", total_bytes)
+        return {
+            "users": len(users),
+            "files": sum(u[1] for u in users),
+            "bytes": total_bytes,
+            "chunks": sum(u[3] for u in users),
+            "statuses": statuses,
+            "largest": [{
+                "user_id": user_id, "files": files, "bytes": size, "chunks": chunks,
+                "bytes_pct": round(100 * size / self.quota_bytes, 1) if self.quota_bytes else None,
+                "chunks_pct": round(100 * chunks / self.quota_chunks, 1) if self.quota_chunks else None,
+                "oldest": oldest,
+                "next_expiry": oldest + self.ttl_s if self.ttl_s else None,
+            } for user_id, files, size, chunks, oldest in users[:top]],
+            "config": {"quota_bytes": self.quota_bytes, "quota_chunks": self.quota_chunks,
+                       "ttl_days": self.ttl_s / 86400, "gc_interval": GC_INTERVAL},
+            "last_gc": self.last_gc,
+        }
+
+
+def _register_routes():
+    from urllib.parse import parse_qs, urlsplit
+    from metrics_server import MetricsHandler
+
+    def route(handler):
+        top = int(parse_qs(urlsplit(handler.path).query).get("top", ["50"])[-1])
+        return {m.db_path: m.report(top) for m in list(_managers)}
+
+    MetricsHandler.routes["/uploads.json"] = route
+
+
+_register_routes()
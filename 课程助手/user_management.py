@@ -1,11 +1,14 @@
+import os
 from langchain_community.utilities import SQLDatabase
 import gradio as gr
+from state_backend import get_state_backend
 # from ai_respond import AIRespond
 class User:
-    username = None  # 用于存储当前登录用户的用户名
+    # 登录身份不再保存在共享的 User 实例上：登录成功后在状态后端生成令牌，令牌保存在浏览器里，
+    # 界面的每个请求都用 current_user 从令牌解析用户，多进程部署时任意进程都能恢复登录
     # ai_respond = AIRespond(None)
     def __init__(self):
-      self.db = SQLDatabase.from_uri("sqlite:///课程助手/课程助手.db") #sqlite:///是固定连接方法 后面跟文件路径
+      self.db = SQLDatabase.from_uri(os.getenv("HISTORY_DB_URI", "sqlite:///课程助手/课程助手.db")) #sqlite:///是固定连接方法 后面跟文件路径
       # -- 创建用户表
       self.db.run("""
               CREATE TABLE IF NOT EXISTS users (
@@ -48,21 +51,27 @@ class User:
         
         # 如果查询结果不为空，说明登录成功
         if result.strip():
-            self.username = username  # 用于聊天界面显示当前用户
+            token = get_state_backend().create_login(username)
             # self.ai_respond = AIRespond(username) #登陆成功更新回复ai
-            return self.username, "登录成功!", gr.update(selected="chat")
+            return username, "登录成功!", gr.update(selected="chat"), token
         else:
-            return None, "用户名或密码错误!",gr.update(selected="login")
-    def logout_user(self):
+            return None, "用户名或密码错误!",gr.update(selected="login"), None
+    def logout_user(self, token=None):
         # print("点击了退出按钮")
-        self.username = None
+        if token:
+            get_state_backend().revoke_login(token)
         # self.ai_respond = AIRespond(None)
         
-        return None,gr.update(selected="login")
+        return None,gr.update(selected="login"), None
+
+    @staticmethod
+    def current_user(token):
+        """根据登录令牌返回用户名，令牌无效或过期返回 None"""
+        return get_state_backend().resolve_login(token) if token else None
 
 if __name__ == "__main__":  
     user= User()
     # print(user.register_user("lna01", "123"))
     # print(user.login_user("lna01", "1234"))
-    print(user.login_user("lna01", "123"))
-    print(user.username)  # 输出当前登录用户的用户名
\ No newline at end of file
+    username, message, _, token = user.login_user("lna01", "123")
+    print(message, User.current_user(token))  # 输出当前登录用户的用户名
\ No newline at end of file
@@ -0,0 +1,278 @@
+"""
+联网搜索结果的会话级临时索引。
+"联网搜索"模式下 web_scraping 抓到的网页和 Tavily 的搜索结果按句子分块，放进当前会话的内存词法索引
+（字符二元组 + 英文单词的 BM25，不计算 embedding）。追问同一篇文章时：
+    - 缓存覆盖了问题的大部分关键词时，直接用缓存内容回答，不再进入 ReAct 循环（见 AgentRouter._handle_search_stream）
+    - 否则 Agent 可以先调用 web_cache_search 工具查缓存，找不到再联网
+配置：
+    WEB_CACHE_TTL             缓存内容的存活秒数（默认 1800）
+    WEB_CACHE_SESSION_CHARS   每个会话最多缓存的字符数，超出时淘汰最早的网页（默认 200000）
+    WEB_CACHE_MAX_SESSIONS    最多保留的会话数，超出时淘汰最久未使用的会话（默认 500）
+    WEB_CACHE_DIRECT_COVERAGE 直接用缓存回答所需的关键词覆盖率（默认 0.6，设为 0 关闭直接回答）
+"""
+import contextvars
+import hashlib
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from tracing import metrics
+
+TTL = float(os.getenv("WEB_CACHE_TTL", "1800"))
+SESSION_CHARS = int(os.getenv("WEB_CACHE_SESSION_CHARS", "200000"))
+MAX_SESSIONS = int(os.getenv("WEB_CACHE_MAX_SESSIONS", "500"))
+DIRECT_COVERAGE = float(os.getenv("WEB_CACHE_DIRECT_COVERAGE", "0.6"))
+CHUNK_CHARS = 400
+BM25_K1, BM25_B = 1.2, 0.75
+
+_WORD = re.compile(r"[a-z0-9]+")
+_CJK_RUN = re.compile(r"[㐀-鿿]+")
+_STOP_TERMS = {"什么", "怎么", "如何", "请问", "一下", "这个", "那个", "里面", "文章", "网页", "刚才", "上面", "提到", "关于"}
+# 含虚词的二元组（"型的""是多"）对检索没有帮助，还会拉低覆盖率
+_STOP_CHARS = set("的了吗呢吧啊呀是在和与及或就都也还又么")
+
+# 当前正在处理的会话（工具在 Agent 内部被调用，拿不到会话 ID）
+_session = contextvars.ContextVar("web_cache_session", default=None)
+
+
+def terms(text: str):
+    """检索用的词项：中文取字符二元组，英文和数字取整词"""
+    text = text.lower()
+    result = _WORD.findall(text)
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            result.append(run)
+        result.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return [t for t in result if t not in _STOP_TERMS and not (_STOP_CHARS & set(t))]
+
+
+class _Chunk:
+    __slots__ = ("text", "url", "title", "tf", "length", "added_at")
+
+    def __init__(self, text, url, title, added_at):
+        self.text = text
+        self.url = url
+        self.title = title
+        self.tf = Counter(terms(text))
+        self.length = sum(self.tf.values()) or 1
+        self.added_at = added_at
+
+
+class SessionIndex:
+    """单个会话的网页内容索引：按网页（url）整体加入和淘汰"""
+    def __init__(self, max_chars: int = SESSION_CHARS, ttl: float = TTL):
+        self.max_chars = max_chars
+        self.ttl = ttl
+        self.pages = OrderedDict()  # url -> [_Chunk]，按加入顺序
+        self.chars = 0
+
+    def add(self, url: str, title: str, text: str) -> int:
+        from chunkers import ChineseSentenceChunker
+        if not text or url in self.pages:
+            return 0
+        now = time.time()
+        chunks = [_Chunk(part, url, title, now) for part in ChineseSentenceChunker(CHUNK_CHARS, overlap=0).split_text(text)]
+        self.pages[url] = chunks
+        self.chars += sum(len(c.text) for c in chunks)
+        # 超出字符上限：淘汰最早加入的网页（至少保留刚加入的这一篇）
+        while self.chars > self.max_chars and len(self.pages) > 1:
+            self._drop(next(iter(self.pages)))
+        return len(chunks)
+
+    def _drop(self, url: str):
+        chunks = self.pages.pop(url, [])
+        self.chars -= sum(len(c.text) for c in chunks)
+
+    def expire(self, now: float = None):
+        now = now or time.time()
+        for url in [u for u, chunks in self.pages.items() if chunks and now - chunks[0].added_at > self.ttl]:
+            self._drop(url)
+
+    def search(self, query: str, k: int = 4):
+        """BM25 排序，返回 ([(分数, _Chunk)], 覆盖率)；覆盖率为问题词项出现在前 k 个块中的比例"""
+        self.expire()
+        query_terms = set(terms(query))
+        chunks = [c for page in self.pages.values() for c in page]
+        if not query_terms or not chunks:
+            return [], 0.0
+        avg_len = sum(c.length for c in chunks) / len(chunks)
+        df = {t: sum(1 for c in chunks if t in c.tf) for t in query_terms}
+        scored = []
+        for c in chunks:
+            score = 0.0
+            for t in query_terms:
+                tf = c.tf.get(t)
+                if not tf:
+                    continue
+                idf = math.log(1 + (len(chunks) - df[t] + 0.5) / (df[t] + 0.5))
+                score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * c.length / avg_len))
+            if score > 0:
+                scored.append((score, c))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        top = scored[:k]
+        covered = {t for _, c in top for t in query_terms if t in c.tf}
+        return top, len(covered) / len(query_terms)
+
+
+class WebCache:
+    """所有会话的索引，按最近使用顺序淘汰"""
+    def __init__(self, max_sessions: int = MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _index(self, session_id: str, create: bool = False):
+        index = self._sessions.get(session_id)
+        if index is None and create:
+            index = self._sessions[session_id] = SessionIndex()
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        if index is not None:
+            self._sessions.move_to_end(session_id)
+        return index
+
+    def add(self, session_id: str, url: str, title: str, text: str) -> int:
+        with self._lock:
+            added = self._index(session_id, create=True).add(url, title or url, text)
+        if added:
+            metrics.inc("web_cache_pages")
+        return added
+
+    def search(self, session_id: str, query: str, k: int = 4):
+        with self._lock:
+            index = self._index(session_id)
+            if index is None:
+                return [], 0.0
+            results, coverage = index.search(query, k)
+        metrics.inc("web_cache_hits" if results else "web_cache_misses")
+        return results, coverage
+
+    def drop(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sessions": len(self._sessions),
+                    "pages": sum(len(i.pages) for i in self._sessions.values()),
+                    "chars": sum(i.chars for i in self._sessions.values())}
+
+    def memory_report(self) -> dict:
+        from memory_accounting import approx_size
+        with self._lock:
+            sessions = {sid: approx_size(index.pages) for sid, index in self._sessions.items()}
+            pages = sum(len(i.pages) for i in self._sessions.values())
+        return {"bytes": sum(sessions.values()), "items": pages, "sessions": sessions}
+
+    def evict(self, pressure: float) -> dict:
+        """内存紧张时淘汰最久未使用的一部分会话"""
+        with self._lock:
+            count = math.ceil(len(self._sessions) * pressure)
+            for _ in range(count):
+                self._sessions.popitem(last=False)
+        return {"sessions": count}
+
+
+web_cache = WebCache()
+
+
+def current_session():
+    return _session.get()
+
+
+def session_stream(stream, session_id: str):
+    """包装生成器：每次推进时设置当前会话，Agent 内部调用的工具据此读写该会话的缓存"""
+    iterator = iter(stream)
+    try:
+        while True:
+            token = _session.set(session_id)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                _session.reset(token)
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+
+
+def format_results(results) -> str:
+    return "\n\n".join(f"[{i + 1}] {c.title}（{c.url}）\n{c.text}" for i, (_, c) in enumerate(results))
+
+
+def remember(url: str, title: str, text: str) -> int:
+    """把抓取到的内容加入当前会话的缓存（不在会话上下文中时忽略）"""
+    session_id = current_session()
+    if session_id is None:
+        return 0
+    return web_cache.add(session_id, url, title, text)
+
+
+def _search_results(args, result):
+    """从搜索工具的返回值中取出 (url, 标题, 正文)；args 是工具的输入（参数 dict，或 ReAct 直接传入的字符串）"""
+    if isinstance(result, dict):
+        for r in result.get("results", []):
+            text = r.get("raw_content") or r.get("content")
+            if r.get("url") and text:
+                yield r["url"], r.get("title"), text
+    elif isinstance(result, str) and result:
+        query = args if isinstance(args, str) else str(args.get("query", ""))
+        digest = hashlib.md5(result.encode("utf-8")).hexdigest()[:8]
+        yield f"search:{query}:{digest}", f"搜索：{query}", result
+
+
+# web_scraping 自己在 my_tools 中写入完整正文（返回给 Agent 的是截断后的内容），这里不再包装
+_EXTRACTORS = {"tavily_search": _search_results}
+
+
+def _indexing_tool(tool, extract):
+    """包装联网工具：结果照常返回给 Agent，同时写入当前会话的缓存"""
+    from langchain_core.tools import StructuredTool
+
+    def run(*args, **kwargs):
+        # ReAct Agent 把输入作为一个字符串位置参数传入，函数调用式 Agent 传关键字参数
+        tool_input = args[0] if args else kwargs
+        result = tool.invoke(tool_input)
+        for url, title, text in extract(tool_input, result):
+            remember(url, title, text)
+        return result
+
+    return StructuredTool.from_function(func=run, name=tool.name, description=tool.description,
+                                        args_schema=tool.args_schema)
+
+
+def _build_search_tool():
+    from langchain_core.tools import tool
+
+    @tool
+    def web_cache_search(query: str) -> str:
+        """在本会话之前搜索和抓取过的网页内容中查找信息。追问之前查过的新闻或网页时先用它，找不到再联网搜索。"""
+        session_id = current_session()
+        results, _ = web_cache.search(session_id, query) if session_id else ([], 0.0)
+        if not results:
+            return "本会话的网页缓存中没有相关内容，请使用联网搜索。"
+        return format_results(results)
+
+    return web_cache_search
+
+
+def with_web_cache(tools):
+    """给联网工具加上缓存写入，并加入缓存检索工具（放在最前面，Agent 优先考虑）"""
+    wrapped = [_indexing_tool(t, _EXTRACTORS[t.name]) if t.name in _EXTRACTORS else t for t in tools]
+    return [_build_search_tool()] + wrapped
+
+
+def _register_routes():
+    from memory_accounting import memory
+    from metrics_server import MetricsHandler
+    MetricsHandler.routes["/web_cache.json"] = lambda handler: web_cache.stats()
+    memory.register("web_cache", web_cache.memory_report, evict=web_cache.evict, evict_session=web_cache.drop)
+
+
+_register_routes()
@@ -0,0 +1,134 @@
+"""
+向量库写入协调器（group commit）。
+多个学生同时上传时，各自的 add_documents / 删除不再分别写库、分别 persist：
+embedding 仍在调用方线程里并行计算，写入请求交给协调器，短时间内到达的写入合并成一组，
+按到达顺序执行（相邻的写入合并成一次 upsert），整组只 persist 一次。
+每个调用在自己所在的组提交之后才返回，所以上传者随后的检索一定能看到刚写入的内容（read-your-writes）。
+组的触发条件：攒满 VECTOR_COMMIT_MAX_OPS 个写入（默认 32），或第一个写入已等待 VECTOR_COMMIT_WAIT_MS（默认 50ms）。
+VECTOR_GROUP_COMMIT=0 时每次写入直接提交。
+"""
+import logging
+import os
+import time
+import uuid
+from typing import List
+
+from batching import MicroBatcher
+from tracing import metrics
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("VECTOR_GROUP_COMMIT", "1") == "1"
+MAX_OPS = int(os.getenv("VECTOR_COMMIT_MAX_OPS", "32"))
+MAX_WAIT_MS = float(os.getenv("VECTOR_COMMIT_WAIT_MS", "50"))
+
+
+def _write(store, documents, vectors, ids) -> List[str]:
+    """写入已经算好 embedding 的文档：紧凑索引用 add_embeddings，Chroma 直接 upsert 到底层 collection"""
+    if hasattr(store, "add_embeddings"):
+        return store.add_embeddings(documents, vectors)
+    store._collection.upsert(ids=ids, embeddings=[list(v) for v in vectors],
+                             metadatas=[d.metadata for d in documents],
+                             documents=[d.page_content for d in documents])
+    return ids
+
+
+def _delete(store, ids=None, where=None):
+    store._collection.delete(ids=ids, where=where)
+
+
+def _rollback(store):
+    """撤销未提交的写入：紧凑索引丢弃 pending 缓冲；Chroma 的 upsert/删除已落库且可重复执行，无需处理"""
+    rollback = getattr(store, "rollback", None)
+    if rollback is not None:
+        rollback()
+
+
+class VectorWriteCoordinator:
+    def __init__(self, store, embeddings, name: str = "vector_writes",
+                 max_ops: int = MAX_OPS, max_wait_ms: float = MAX_WAIT_MS, enabled: bool = ENABLED):
+        """
+        :param store: Chroma 或 CompactVectorIndex
+        :param embeddings: 与 store 相同的 embedding 模型，在调用方线程里计算
+        """
+        self.store = store
+        self.embeddings = embeddings
+        self.name = name
+        self.enabled = enabled
+        self._batcher = MicroBatcher(self._commit, max_batch=max_ops, max_wait_ms=max_wait_ms, name=name) if enabled else None
+
+    def add_documents(self, documents) -> List[str]:
+        """计算 embedding 后加入写入组，组提交后返回文档 ID"""
+        if not documents:
+            return []
+        vectors = self.embeddings.embed_documents([d.page_content for d in documents])
+        ids = [str(uuid.uuid4()) for _ in documents]
+        return self._submit(("add", (documents, vectors, ids)))
+
+    def delete(self, ids: List[str] = None, where: dict = None):
+        """按 ID 或元数据条件删除，组提交后返回"""
+        if not ids and not where:
+            return None
+        if not hasattr(self.store, "_collection"):
+            # 紧凑索引的 ID 是行号，删除会让后面的 ID 全部移位，只能重新导出
+            raise TypeError(f"{type(self.store).__name__} 不支持按 ID 删除：请删除 Chroma 课程库中的文档后用 refresh_course_index 重新导出")
+        return self._submit(("delete", (ids, where)))
+
+    def _submit(self, op):
+        result = self._batcher(op) if self.enabled else self._commit([op])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _commit(self, ops):
+        """执行一组写入并 persist 一次；整组失败时先撤销未提交的部分再逐个重试，只让出错的那个写入失败"""
+        start = time.perf_counter()
+        try:
+            results = self._apply(ops)
+            self._persist()
+        except Exception as e:
+            logger.warning("[%s] 分组写入失败，逐个重试: %s", self.name, e)
+            _rollback(self.store)
+            results = []
+            for op in ops:
+                try:
+                    results.extend(self._apply([op]))
+                    self._persist()
+                except Exception as err:
+                    _rollback(self.store)
+                    results.append(err)
+        metrics.observe("vector_commit", (time.perf_counter() - start) * 1000, store=self.name)
+        metrics.inc("vector_commit_ops", len(ops), store=self.name)
+        return results
+
+    def _apply(self, ops):
+        """按到达顺序执行：相邻的写入合并成一次 upsert，遇到删除先提交前面的写入"""
+        results, pending = [None] * len(ops), []  # pending: [(在 ops 中的位置, (文档, 向量, ID))]
+
+        def flush():
+            if not pending:
+                return
+            written = _write(self.store,
+                             [d for _, (docs, _, _) in pending for d in docs],
+                             [v for _, (_, vectors, _) in pending for v in vectors],
+                             [i for _, (_, _, ids) in pending for i in ids])
+            # 按原来的请求拆分返回的 ID
+            offset = 0
+            for index, (docs, _, _) in pending:
+                results[index] = written[offset:offset + len(docs)]
+                offset += len(docs)
+            pending.clear()
+
+        for index, (kind, payload) in enumerate(ops):
+            if kind == "add":
+                pending.append((index, payload))
+            else:
+                flush()
+                _delete(self.store, *payload)
+        flush()
+        return results
+
+    def _persist(self):
+        persist = getattr(self.store, "persist", None)
+        if persist is not None:
+            persist()
@@ -1,19 +1,26 @@
-import os
-import shutil
+"""
+清理用户上传：文件、向量和导入的表一起删除（见 upload_lifecycle.py）。
+    python 课程助手/清理缓存.py           删除过期的上传并回收孤儿文件/向量/表
+    python 课程助手/清理缓存.py --all     删除所有用户的全部上传
+"""
+import argparse
+import json
 
-def clean_gradio_tmp():
-    directory_path = "课程助手/user_uploads"   
-    for item in os.listdir(directory_path):
-        item_path = os.path.join(directory_path, item)     
-        try:
-            if os.path.isfile(item_path) or os.path.islink(item_path):
-                os.remove(item_path)  # 删除文件或符号链接
-                print(f"已删除文件: {item_path}")
-            elif os.path.isdir(item_path):
-                shutil.rmtree(item_path)  # 删除整个文件夹
-                print(f"已删除文件夹: {item_path}")
-        except Exception as e:
-            print(f"删除 {item_path} 失败: {e}")
+from rag_process import RAGProcess
 
-# 调用函数
-clean_gradio_tmp()
\ No newline at end of file
+
+def clean_uploads(remove_all: bool = False):
+    uploads = RAGProcess().uploads
+    if remove_all:
+        users = [row[0] for row in uploads._conn().execute("SELECT DISTINCT user_id FROM uploads").fetchall()]
+        print(f"已删除上传: {sum(uploads.delete(user_id) for user_id in users)}")
+    else:
+        print(f"已删除过期上传: {uploads.expire()}")
+    print(f"回收: {uploads.gc()}")
+    print(json.dumps(uploads.report(top=10), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="清理用户上传")
+    parser.add_argument("--all", action="store_true", help="删除所有用户的全部上传")
+    clean_uploads(parser.parse_args().all)
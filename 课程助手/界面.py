@@ -2,106 +2,118 @@ import gradio as gr
 from user_management import User
 from ai_respond import AIRespond
 from history_management import HistoryManager
+from stream_coalescer import stream_to_message
+from state_backend import get_state_backend
+from cancellation import turns, cancellable
+from scheduler import scheduled_stream
+from web_cache import web_cache
+from memory_accounting import chat_histories, memory
 import os
 import uuid
+import logging
+import threading
 from datetime import date
 # 创建可写的临时目录
 os.makedirs("课程助手/gradio_tmp", exist_ok=True)
 os.environ["GRADIO_TEMP_DIR"] = "课程助手/gradio_tmp"
+logger = logging.getLogger(__name__)
+
+SESSION_PAGE_SIZE = int(os.getenv("SESSION_PAGE_SIZE", "10")) # 侧边栏每页显示的会话数
+# 纯文本对话与带文件的上传在同一个事件中按有无文件分流：事件的处理槽位为两者之和，
+# 带文件的消息另外占用上传槽位，最多等待 UPLOAD_WAIT 秒，上传不会占满对话的处理槽位
+CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY", "16"))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "2"))
+UPLOAD_WAIT = float(os.getenv("UPLOAD_WAIT", "10"))
+_upload_slots = threading.BoundedSemaphore(UPLOAD_CONCURRENCY)
+
+
+def welcome_messages(user_id):
+    return [
+        {"role": "assistant", "content": "欢迎使用lna的课程咨询助手！"},
+        {"role": "assistant", "content": f"{user_id}您好！很高兴为你服务！"},
+    ]
+
+
+def _session_when(last_response_date) -> str:
+    """把最后回答日期显示为 今天/昨天/N天前"""
+    days = (date.today() - date.fromisoformat(str(last_response_date))).days
+    if days <= 0:
+        return "今天"
+    if days == 1:
+        return "昨天"
+    return f"{days}天前"
+
+
+def load_session_page(history_manager, username, page, guest_sessions, query: str = ""):
+    """
+    从历史库中按页读取会话列表，只查询当前页的数据；query 不为空时按相关度列出搜索命中的会话。
+    返回 (会话列表组件的更新, 页码说明, 修正后的页码)
+    """
+    user_id = username if username else "访客"
+    # 访客共用一个 user_id，只能看到自己本次打开页面后创建的会话
+    chat_ids = None if username else list(guest_sessions or [])
+    query = (query or "").strip()
+    if query:
+        total = history_manager.count_search_sessions(user_id, query, chat_ids)
+    else:
+        total = history_manager.count_sessions(user_id, chat_ids)
+    pages = max((total + SESSION_PAGE_SIZE - 1) // SESSION_PAGE_SIZE, 1)
+    page = min(max(page, 0), pages - 1)
+    samples = []
+    if query:
+        for item in history_manager.search_sessions(user_id, query, page * SESSION_PAGE_SIZE, SESSION_PAGE_SIZE, chat_ids):
+            samples.append([f"🔎{item['snippet']}", _session_when(item['last_response_date']), item['chat_id']])
+        page_info = f"第 {page + 1}/{pages} 页，共 {total} 个会话包含“{query}”"
+        return gr.update(samples=samples), page_info, page
+    for item in history_manager.list_sessions(user_id, page * SESSION_PAGE_SIZE, SESSION_PAGE_SIZE, chat_ids):
+        title = (item['title'] or "新会话").strip().replace("\n", " ")
+        title = title[:18] + "…" if len(title) > 18 else title
+        samples.append([f"💬{title}", _session_when(item['last_response_date']), item['chat_id']])
+    page_info = f"第 {page + 1}/{pages} 页，共 {total} 个会话"
+    return gr.update(samples=samples), page_info, page
+
 
-MAX_SESSIONS = 10 # 最大会话数
 # 更新顶部导航栏以及历史聊天记录的函数
 def update_info(username):
     user_id = username if username else "访客"
-    welcome_prompt = gr.update(value=[
-                                        {"role": "assistant", "content": "欢迎使用lna的课程咨询助手！"},
-                                        {"role": "assistant", "content": f"{user_id}您好！很高兴为你服务！"},
-                                    ], label="课程咨询助手" )
+    welcome_prompt = gr.update(value=welcome_messages(user_id), label="课程咨询助手")
+    session_list, page_info, page = load_session_page(HistoryManager(), username, 0, [])
     if username:
-        history_manager = HistoryManager()
-        # 获取用户的所有历史记录
-        history = history_manager.get_all_history(username)
-        today = date.today()
-        chat = {}
-        for item in history:
-            date_ = (today -date.fromisoformat(item['last_response_date'])).days
-            chat[item['chat_id']] = date_#键存储会话ID，值存储最后一次响应日期
-        update_buttons = [[0] * MAX_SESSIONS for _ in range(3)]
-        count_today,count_yesterday,count_last_week = MAX_SESSIONS-1,MAX_SESSIONS-1,MAX_SESSIONS-1
-        for id,time in chat.items():
-            if time >= 7:
-                update_buttons[2][count_last_week] = id
-                count_last_week -= 1
-            elif time == 1:
-                update_buttons[1][count_yesterday] = id
-                count_yesterday -= 1
-            else:
-                update_buttons[0][count_today] = id
-                count_today -= 1
-        updates = []
-        # 更新按钮状态
-        for i in range(3):
-            for occupied in update_buttons[i]:
-                if occupied != 0:
-                    updates.append(gr.update(visible=True))
-                else:
-                    updates.append(gr.update(visible=False))
-
-        return gr.update(value=f"""
+        top_nav = gr.update(value=f"""
         <div style="background-color: #ffffff; padding: 10px; color: white; font-size: 22px;">
             <span>欢迎你, {username}!</span>
         </div>
-        """),update_buttons,welcome_prompt,None,*updates,*updates  # 返回更新后的导航栏和按钮状态
+        """)
     else:
-        update_buttons = [[0] * MAX_SESSIONS for _ in range(3)]
-        updates = []
-        # 登出时关闭所有按钮
-        for i in range(3*MAX_SESSIONS):
-             updates.append(gr.update(visible=False))           
-        return gr.update(value="""
+        top_nav = gr.update(value="""
         <div style="background-color: #ffffff; padding: 10px; color: white; font-size: 22px;">
             <span>欢迎你, 访客!请先登录以查看聊天记录。</span>
         </div>
-        """),update_buttons,welcome_prompt,None,*updates,*updates  # 返回更新后的导航栏和按钮状态
-    
+        """)
+    # 返回更新后的导航栏、聊天窗口、当前会话、访客会话列表、页码、会话列表和清空的搜索框
+    return top_nav, welcome_prompt, None, [], page, session_list, page_info, ""
+
 
-# 定义左侧聊天记录区域（支持点击）
-def chat_history_section():    
+# 定义左侧聊天记录区域：一个数据驱动的分页会话列表，点击某一行即发出携带 chat_id 的事件
+def chat_history_section():
     with gr.Column() as chat_col:
         new_conversation_button = gr.Button("新建对话", variant="primary")
         gr.Markdown("### 📝 聊天记录")
-        today_chat_buttons = []  # 用于存储今天的聊天按钮
-        today_del_buttons = []  # 用于存储今天的删除按钮
-        gr.Markdown("#### 今天")
+        search_box = gr.Textbox(placeholder="搜索聊天记录（回车搜索，清空后回车显示全部）", show_label=False)
+        session_list = gr.Dataset(
+            components=["textbox", "textbox", "textbox"],
+            headers=["会话", "时间", "会话ID"],
+            samples=[],
+            samples_per_page=SESSION_PAGE_SIZE,
+            type="values",
+            label="",
+        )
         with gr.Row():
-            for i in range(MAX_SESSIONS):
-                # 创建多个按钮，初始不可见
-                chat = gr.Button(f"💬会话 {MAX_SESSIONS-i}", variant="secondary", visible=False,scale=3,min_width= 250)
-                delete = gr.Button("❌", variant="secondary", visible=False,scale=1,min_width= 50)  # 删除按钮
-                today_chat_buttons.append(chat)  # 将按钮添加到列表中
-                today_del_buttons.append(delete)  # 将删除按钮添加到列表中
-        gr.Markdown("#### 昨天")
-        yesterday_chat_buttons = []  # 用于存储昨天的聊天按钮
-        yesterday_del_buttons = []  # 用于存储昨天的删除按钮
-        with gr.Row():
-            for i in range(MAX_SESSIONS):
-                chat = gr.Button(f"💬会话 {MAX_SESSIONS-i}", variant="secondary", visible=False,scale=3,min_width= 250)
-                delete = gr.Button("❌", variant="secondary", visible=False,scale=1,min_width= 50)  # 删除按钮
-                yesterday_chat_buttons.append(chat)  # 将按钮添加到列表中
-                yesterday_del_buttons.append(delete)  # 将删除按钮添加到列表中
-        gr.Markdown("#### 前7天")
-        last_week_chat_buttons = []  # 用于存储前7天的聊天按钮
-        last_week_del_buttons = []  # 用于存储前7天的删除按钮
-        with gr.Row():
-            for i in range(MAX_SESSIONS):
-                chat = gr.Button(f"💬会话 {MAX_SESSIONS-i}", variant="secondary", visible=False,scale=3,min_width= 250)
-                delete = gr.Button("❌", variant="secondary", visible=False,scale=1,min_width= 50)  # 删除按钮
-                last_week_chat_buttons.append(chat)  # 将按钮添加到列表中
-                last_week_del_buttons.append(delete)  # 将删除按钮添加到列表中
-        # 预先创建所有按钮，初始不可见
-        chat_buttons = [today_chat_buttons, yesterday_chat_buttons, last_week_chat_buttons]
-        del_buttons = [today_del_buttons, yesterday_del_buttons, last_week_del_buttons]
-    return chat_col, new_conversation_button, chat_buttons, del_buttons  # 返回按钮列表用于绑定事件
+            prev_button = gr.Button("上一页", size="sm")
+            next_button = gr.Button("下一页", size="sm")
+        page_info = gr.Markdown("")
+        delete_button = gr.Button("❌ 删除当前会话", variant="secondary")
+    return chat_col, new_conversation_button, search_box, session_list, prev_button, next_button, page_info, delete_button
 
 # 定义右侧聊天窗口
 def chat_window():
@@ -123,12 +135,12 @@ def input_area():
             msg = gr.MultimodalTextbox(
                 placeholder="请输入你的问题（支持上传文件）",
                 show_label=False,
-                file_types=[".pdf", ".docx", ".txt", ".pptx", ".html", ".ipynb"], # 限制文件类型
+                file_types=[".pdf", ".docx", ".txt", ".pptx", ".html", ".ipynb", ".csv"], # 限制文件类型
                 file_count="multiple", # 允许多文件上传
                 # lines=1, # 可以根据需要调整文本框行数
             )
             intention = gr.Radio(
-                choices=["普通对话", "联网搜索", "课程咨询", "文件上传"],
+                choices=["普通对话", "联网搜索", "课程咨询", "文件上传", "自动识别"],
                 value="普通对话",  # 默认选中
                 show_label=False,
                 interactive=True,
@@ -170,10 +182,14 @@ def main_interface():
     """
 
     with gr.Blocks(css=css) as demo:
-        user_id_state = gr.State(None)# 当前用户ID状态
+        user_id_state = gr.State(None)# 当前用户ID状态（只用于显示，处理请求时以登录令牌为准）
+        # 登录令牌：保存在浏览器本地，令牌本身在状态后端，任意进程都能据此恢复登录；旧版 Gradio 没有 BrowserState 时只保存在页面里
+        login_token = (gr.BrowserState(None, storage_key="course_login_token")
+                       if hasattr(gr, "BrowserState") else gr.State(None))
         cur_chat_id = gr.State(None)  # 当前会话ID状态
         # ai_respond = gr.State(AIRespond(None))  # 当前AI响应对象状态
-        chat_buttons_state = gr.State([[0] * MAX_SESSIONS for _ in range(3)])  # 存储聊天记录按钮状态
+        session_page = gr.State(0)  # 侧边栏会话列表当前页码
+        guest_sessions = gr.State([])  # 访客本次创建的会话ID
         gr.Markdown("## 👨‍🏫 💬+👩‍⚕️ 💡课程问答助手与医疗顾问")
         # 使用 Tabs
         with gr.Tabs() as tabs:
@@ -206,7 +222,7 @@ def main_interface():
                 login_button.click(
                     fn=user.login_user,
                     inputs=[login_username, login_password],
-                    outputs=[user_id_state, login_output, tabs]
+                    outputs=[user_id_state, login_output, tabs, login_token]
                 )
                 # gr.update(selected="chat")
 
@@ -218,32 +234,18 @@ def main_interface():
                     logout_button = gr.Button("退出",elem_classes="logout-btn",scale=0)
                 logout_button.click(
                     fn=user.logout_user,
-                    inputs=[],
-                    outputs=[user_id_state, tabs])
+                    inputs=[login_token],
+                    outputs=[user_id_state, tabs, login_token])
                 with gr.Row():
                     # 左侧聊天记录区域
                     with gr.Column(scale=1, elem_classes="left-panel") as left_col:
-                        chat_col,new_conversation_button,chat_buttons,del_buttons = chat_history_section()
-                        def add_session(occupied_list,user_id):
-                            if user_id is None:
-                                user_id = "访客"
-                            for i, occupied in reversed(list(enumerate(occupied_list[0]))):
-                                if occupied == 0:  # 找到第一个未占用的会话
-                                    occupied_list[0][i] = uuid.uuid4()  # 标记为已占用并设置唯一会话id
-                                    update_chatbot = gr.update(value=[
-                                        {"role": "assistant", "content": "欢迎使用lna的课程咨询助手！"},
-                                        {"role": "assistant", "content": f"{user_id}您好！很高兴为你服务！"},
-                                    ], label="当前会话id: " + str(occupied_list[0][i]))
-                                    update = []
-                                    for j in range(MAX_SESSIONS):
-                                        if j == i:  # 只显示当前会话按钮
-                                            update.append(gr.update(visible=True))                                          
-                                        else:
-                                            update.append(gr.update())
-                                    update = update + update
-                                    return occupied_list, update_chatbot, occupied_list[0][i], *update  # 返回新会话和所有按钮状态
-                             # 全部占用
-                            raise gr.Error("已达最大会话数，无法创建更多会话！")                                                   
+                        chat_col,new_conversation_button,search_box,session_list,prev_button,next_button,page_info,delete_button = chat_history_section()
+                        def new_session(user_id):
+                            """新建会话：只生成新的会话ID并清空聊天窗口，第一条消息保存后会出现在会话列表中"""
+                            user_id = user_id if user_id is not None else "访客"
+                            chat_id = str(uuid.uuid4())
+                            update_chatbot = gr.update(value=welcome_messages(user_id), label="当前会话id: " + chat_id)
+                            return update_chatbot, chat_id
 
                     # 右侧聊天主窗口
                     with gr.Column(scale=5):
@@ -253,154 +255,225 @@ def main_interface():
 
                         # 回复函数 (修改以处理 MultimodalTextbox 的输出)
                         # MultimodalTextbox 的输出是一个 dict: {"text": "...", "files": [...]}
-                        def respond_stream(multimodal_data, chat_history, intention_state,occupied_list, user_id,chat_id):
-                            cur_chat_id = chat_id
-                            update = []
-                            for _ in range(MAX_SESSIONS):
-                                update.append(gr.update())
-                            update = update + update
+                        def start_turn(multimodal_data, token, chat_id, guest_ids):
+                            """发送消息前的准备：当前没有会话时先新建会话（不参与流式输出）"""
+                            user_id = User.current_user(token)
+                            user_text = multimodal_data.get("text", "")
+                            user_files = multimodal_data.get("files", [])
+                            if not (user_text.strip() or user_files):
+                                return chat_id, gr.update(), guest_ids
+                            update_chatbot = gr.update()
+                            if chat_id is not None:
+                                # 最新一轮优先：同一会话上一轮还在输出时立即取消，让出处理槽位
+                                turns.cancel_session(str(chat_id), "superseded")
+                            if chat_id is None:
+                                _, chat_id = new_session(user_id)
+                                update_chatbot = gr.update(label="当前会话id: " + chat_id)
+                            if user_id is None and chat_id not in guest_ids:
+                                guest_ids = guest_ids + [chat_id]
+                            return chat_id, update_chatbot, guest_ids
+
+                        def respond_stream(multimodal_data, chat_history, intention_state, login, chat_id,
+                                           request: gr.Request = None):
+                            """
+                            流式回复：token 先按帧率合并(STREAM_MAX_FPS)，每帧只改动最后一条助手消息，
+                            Gradio 按增量把变化发送给浏览器；输出只包含输入框和聊天窗口。
+                            同一会话发送新消息、删除会话或关闭页面时，本轮被取消并停止上游的模型/工具调用。
+                            """
+                            user_id = User.current_user(login)
                             user_text = multimodal_data.get("text", "")
                             user_files = multimodal_data.get("files", [])
-                            print(f"用户输入文本: {user_text}")
-                            print(f"上传的文件: {user_files}")
+                            logger.debug("用户输入文本: %s", user_text)
+                            logger.debug("上传的文件: %s", user_files)
                             if user_text.strip() or user_files: # 检查是否有文本或文件
                                 ai_respond = AIRespond(str(chat_id))
-                                #新建一个对话
-                                if cur_chat_id is None:
-                                    occupied_list, update_chatbot, cur_chat_id, *update = add_session(occupied_list, user_id)
-                                    update_chatbot = gr.update(label="当前会话id: " + str(cur_chat_id))
-                                    yield {"text": "", "files": []}, update_chatbot, occupied_list, cur_chat_id, *update
-                                    ai_respond = AIRespond(str(chat_id))
                                 chat_history.append({"role": "user", "content": user_text}) # 可以考虑如何处理文件
                                 chat_history.append({"role": "assistant", "content": ''})
-                                yield {"text": "", "files": []}, chat_history, occupied_list, cur_chat_id,*update  # 清空输入框并刷新界面
+                                yield {"text": "", "files": []}, chat_history  # 清空输入框并刷新界面
 
-                                # 2. 创建 AIRespond 实例
-                                # ai_respond = user.ai_respond
-                                # 3. 流式生成回复
+                                # 流式生成回复（空白 token 也保留，保证换行等排版正确）
                                 bot_response = ""
-                                # try:
-                                # ✅ 调用流式方法，逐个接收 token
-                                # 假设 ai_respond.respond_stream 可以处理文件列表
-                                for token in ai_respond.respond_stream(user_files, user_text, intention_state):
-                                    if token and token.strip():  # 避免空字符
-                                        bot_response += token
+                                client = request.session_hash if request else None
+                                token = turns.start(str(chat_id), client=client)
+                                # 模型调用按用户公平调度：登录用户按用户名，访客按浏览器会话
+                                tokens = scheduled_stream(
+                                    ai_respond.respond_stream(user_files, user_text, intention_state, cancel_token=token),
+                                    user=user_id or client or str(chat_id))
+                                try:
+                                    for bot_response, _ in stream_to_message(cancellable(tokens, token, stage="ui")):
                                         # 更新 chatbot 的最后一条消息
-                                        chat_history[-1]={"role": "assistant", "content": bot_response}
-                                        yield {"text": "", "files": []}, chat_history, occupied_list, cur_chat_id,*update  # 清空输入框并逐步更新界面
-                                        # 添加对话到数据库
+                                        chat_history[-1] = {"role": "assistant", "content": bot_response}
+                                        yield gr.update(), chat_history
+                                finally:
+                                    turns.finish(str(chat_id), token)
+                                if token.cancelled:
+                                    if token.reason == "deleted":
+                                        return
+                                    bot_response += "\n\n（回答已中断）"
+                                    chat_history[-1] = {"role": "assistant", "content": bot_response}
+                                    yield gr.update(), chat_history
+                                # 添加对话到数据库
                                 today = date.today()
                                 history_manager.add_history({
-                                    "chat_id": str(cur_chat_id),
+                                    "chat_id": str(chat_id),
                                     "user_id": user_id if user_id is not None else '访客',
                                     "user_question": user_text,
                                     "ai_response": bot_response,
                                     "last_response_date": today
                                 })
+                                chat_histories.record(str(chat_id), chat_history, client)
                             else:
                                 # 如果没有输入，也清空输入框
-                                 yield {"text": "", "files": []}, chat_history, occupied_list, cur_chat_id,*update
+                                yield {"text": "", "files": []}, chat_history
+
+                        def respond(multimodal_data, chat_history, intention_state, login, chat_id,
+                                    request: gr.Request = None):
+                            """按有无文件分流：纯文本直接回答；带文件的消息先占用上传槽位，等不到时提示稍后再试（输入框保留文件）"""
+                            if not multimodal_data.get("files"):
+                                yield from respond_stream(multimodal_data, chat_history, intention_state, login, chat_id, request)
+                                return
+                            if not _upload_slots.acquire(timeout=UPLOAD_WAIT):
+                                chat_history.append({"role": "assistant", "content": "当前上传的文件较多，请稍后再试。"})
+                                yield gr.update(), chat_history
+                                return
+                            try:
+                                yield from respond_stream(multimodal_data, chat_history, intention_state, login, chat_id, request)
+                            finally:
+                                _upload_slots.release()
                         # 绑定意图选择事件  
                         intent_state = gr.State("normal")
                         def process_choice(choice):
-                            print(f"您选择了: {choice}")
+                            logger.debug("您选择了: %s", choice)
                             intent_map = {
                                 "联网搜索": "联网搜索",
                                 "课程咨询": "课程咨询",
-                                "文件上传": "文件上传"
+                                "文件上传": "文件上传",
+                                "自动识别": "自动识别"
                             }
                             return intent_map.get(choice, "normal")
                         intention.change(fn=process_choice,inputs=intention,outputs=intent_state)
                         
                         # 更新事件绑定，使用 MultimodalTextbox
                         # MultimodalTextbox.submit 会在用户按下 Enter 时触发
+                        def refresh_sessions(token, page, guest_ids, query):
+                            return load_session_page(history_manager, User.current_user(token), page, guest_ids, query)
+
+                        respond_inputs = [multimodal_input, chatbot, intent_state, login_token, cur_chat_id] # 输入是 MultimodalTextbox 组件
                         multimodal_input.submit(
-                            fn=respond_stream,
-                            inputs=[multimodal_input, chatbot, intent_state,chat_buttons_state,user_id_state,cur_chat_id], # 输入是 MultimodalTextbox 组件
-                            outputs=[multimodal_input, chatbot,chat_buttons_state,cur_chat_id]+chat_buttons[0]+del_buttons[0] # 输出更新 MultimodalTextbox(清空) 和 Chatbot
+                            fn=start_turn,
+                            inputs=[multimodal_input, login_token, cur_chat_id, guest_sessions],
+                            outputs=[cur_chat_id, chatbot, guest_sessions]
+                        ).then(
+                            fn=respond,
+                            inputs=respond_inputs,
+                            outputs=[multimodal_input, chatbot], # 流式阶段只输出 MultimodalTextbox(清空) 和 Chatbot
+                            concurrency_limit=CHAT_CONCURRENCY + UPLOAD_CONCURRENCY,
+                            concurrency_id="chat"
+                        ).then(
+                            fn=refresh_sessions,  # 回答保存后刷新当前页会话列表
+                            inputs=[login_token, session_page, guest_sessions, search_box],
+                            outputs=[session_list, page_info, session_page]
                         )
                         #新建会话按钮点击事件               
                         new_conversation_button.click(
-                            fn=add_session,  # 点击后显示新会话按钮,清空当前会话
-                            inputs=[chat_buttons_state,user_id_state],  # 当前聊天记录按钮状态
-                            outputs=[chat_buttons_state,chatbot,cur_chat_id]+chat_buttons[0]+del_buttons[0]  # 更新所有聊天按钮的可见性
+                            fn=lambda token: new_session(User.current_user(token)),  # 清空当前会话并生成新的会话ID
+                            inputs=[login_token],
+                            outputs=[chatbot, cur_chat_id]
                         )
-                        # 绑定聊天记录按钮的点击事件
-                        def load_chat_buttons(occupied_list,index, user_id):
-                            i,j = index[0],index[1]
-                            cur_chat_id = occupied_list[i][j]  # 获取对应的 UUID
-                            # update_chatbot = gr.update(value=[{"role": "assistant", "content": f"加载会话 {uuid_str}"}],
-                            #                             label="当前会话id: " + str(uuid_str))
-                            user_id = user_id if user_id is not None else '访客'
+                        # 会话列表点击事件：一行数据为 [标题, 时间, chat_id]
+                        def load_session(row):
+                            chat_id = row[2]
                             chat_history = []
-                            for item in history_manager.get_solo_history(str(cur_chat_id)):
+                            for item in history_manager.get_solo_history(str(chat_id)):
                                 chat_history.append({"role": "user", "content": item['user_question']})
                                 chat_history.append({"role": "assistant", "content": item['ai_response']})
-                            update_chatbot = gr.update(value=chat_history, label="当前会话id: " + str(cur_chat_id))
-                            return  update_chatbot, cur_chat_id
-                        def load_del_buttons(occupied_list,index,user_id,cur_chat_id):
-                            i,j = index[0],index[1]
-                            chat_id = occupied_list[i][j]  # 获取对应的 UUID
-                            user_id = user_id if user_id is not None else '访客'
-                            history_manager.delete_history(user_id,str(chat_id))
-                            if j == 0:  
-                                occupied_list[i][0] = 0
-                            else:
-                                occupied_list[i][1:j+1] = occupied_list[i][0:j]  # 删除当前会话
-                                occupied_list[i][0] = 0  # 标记为未占用
-                            updates = []
-                            # 更新按钮状态
-                            for occupied in occupied_list[i]:
-                                if occupied != 0:
-                                    updates.append(gr.update(visible=True))
-                                else:
-                                    updates.append(gr.update(visible=False))
-                            # 返回更新后的状态和按钮
-                            if chat_id == cur_chat_id:
-                                welcome_prompt = gr.update(value=[
-                                        {"role": "assistant", "content": "欢迎使用lna的课程咨询助手！"},
-                                        {"role": "assistant", "content": f"{user_id}您好！很高兴为你服务！"},
-                                    ], label="课程咨询助手" )
-                                return occupied_list,welcome_prompt,None,*updates,*updates                           
-                            return occupied_list,gr.update(),cur_chat_id,*updates,*updates
-                            
-                        for i in range(len(chat_buttons)):
-                            for j in range(len(chat_buttons[i])):
-                                chat_button = gr.State([i,j]) # 存储按钮的索引
-                                # 绑定每个聊天按钮的点击事件
-                                chat_buttons[i][j].click(
-                                    fn=load_chat_buttons,
-                                    inputs=[chat_buttons_state,chat_button,user_id_state],
-                                    outputs=[chatbot,cur_chat_id]  # 更新状态
-                                )                                                             
-                                # 绑定删除按钮的点击事件
-                                del_buttons[i][j].click(
-                                    fn=load_del_buttons,
-                                    inputs=[chat_buttons_state, chat_button,user_id_state,cur_chat_id],
-                                    outputs=[chat_buttons_state,chatbot,cur_chat_id]+chat_buttons[i]+del_buttons[i] # 更新状态
-                                )
-                # 当页面加载或状态改变时更新导航栏
+                            update_chatbot = gr.update(value=chat_history, label="当前会话id: " + str(chat_id))
+                            return update_chatbot, chat_id
+                        session_list.click(
+                            fn=load_session,
+                            inputs=[session_list],
+                            outputs=[chatbot, cur_chat_id]
+                        )
+                        # 删除当前会话
+                        def delete_session(token, chat_id, page, guest_ids, query):
+                            user_id = User.current_user(token)
+                            if chat_id is None:
+                                raise gr.Error("请先在左侧选择要删除的会话！")
+                            user_id_ = user_id if user_id is not None else '访客'
+                            turns.cancel_session(str(chat_id), "deleted")
+                            history_manager.delete_history(user_id_, str(chat_id))
+                            get_state_backend().clear_messages(str(chat_id))
+                            web_cache.drop(str(chat_id))
+                            chat_histories.forget(str(chat_id))
+                            guest_ids = [c for c in guest_ids if c != chat_id]
+                            welcome_prompt = gr.update(value=welcome_messages(user_id_), label="课程咨询助手")
+                            session_update, info, page = load_session_page(history_manager, user_id, page, guest_ids, query)
+                            return welcome_prompt, None, guest_ids, session_update, info, page
+                        delete_button.click(
+                            fn=delete_session,
+                            inputs=[login_token, cur_chat_id, session_page, guest_sessions, search_box],
+                            outputs=[chatbot, cur_chat_id, guest_sessions, session_list, page_info, session_page]
+                        )
+                        # 翻页：只加载目标页的会话（搜索时翻的是搜索结果）
+                        prev_button.click(
+                            fn=lambda token, page, guest_ids, query: refresh_sessions(token, page - 1, guest_ids, query),
+                            inputs=[login_token, session_page, guest_sessions, search_box],
+                            outputs=[session_list, page_info, session_page]
+                        )
+                        next_button.click(
+                            fn=lambda token, page, guest_ids, query: refresh_sessions(token, page + 1, guest_ids, query),
+                            inputs=[login_token, session_page, guest_sessions, search_box],
+                            outputs=[session_list, page_info, session_page]
+                        )
+                        # 搜索聊天记录：从第一页开始列出命中的会话，点击后与普通会话一样加载
+                        search_box.submit(
+                            fn=lambda token, guest_ids, query: refresh_sessions(token, 0, guest_ids, query),
+                            inputs=[login_token, guest_sessions, search_box],
+                            outputs=[session_list, page_info, session_page]
+                        )
+                # 关闭页面时取消该浏览器会话中仍在进行的回答
+                def on_unload(request: gr.Request):
+                    # 页面关闭后 Gradio 释放该页面的 gr.State，相应会话不再统计
+                    turns.cancel_client(request.session_hash, "closed")
+                    chat_histories.forget_client(request.session_hash)
+                demo.unload(on_unload)
+                # 当页面加载或状态改变时更新导航栏；加载页面时按浏览器保存的令牌恢复登录（令牌失效则为访客）
                 demo.load(
+                    fn=User.current_user,
+                    inputs=[login_token],
+                    outputs=[user_id_state]
+                ).then(
                     fn=update_info,
                     inputs=[user_id_state],
-                    outputs=[top_nav_html,chat_buttons_state,chatbot,cur_chat_id]
-                    + chat_buttons[0]+chat_buttons[1]+chat_buttons[2]
-                    + del_buttons[0]+del_buttons[1]+del_buttons[2]
+                    outputs=[top_nav_html,chatbot,cur_chat_id,guest_sessions,session_page,session_list,page_info,search_box]
                 )
                 user_id_state.change(
                     fn=update_info,
                     inputs=[user_id_state],
-                    outputs=[top_nav_html,chat_buttons_state,chatbot,cur_chat_id]
-                    + chat_buttons[0]+chat_buttons[1]+chat_buttons[2]
-                    + del_buttons[0]+del_buttons[1]+del_buttons[2]  # 更新导航栏和按钮状态
+                    outputs=[top_nav_html,chatbot,cur_chat_id,guest_sessions,session_page,session_list,page_info,search_box]  # 更新导航栏和会话列表
                 )
-                
-
-
 
     return demo
 
 # 启动应用
 if __name__ == "__main__":
+    from agent_with_tools import AgentRouter
+    from metrics_server import start_metrics_server
+    # 日志级别：LOG_LEVEL=DEBUG 时输出意图、SQL、Agent 事件等调试信息
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # 本地指标服务：/metrics (Prometheus) 与 /metrics.json；内存报告与 tracemalloc 见 /memory.json
+    start_metrics_server()
+    # 定期更新内存指标，超过高水位时回收缓存（MEMORY_HIGH_WATER_MB）
+    memory.start()
+    # 定期删除过期上传、回收孤儿文件与向量（UPLOAD_GC_INTERVAL），占用见 /uploads.json
+    AgentRouter.my_rag.uploads.start()
     demo = main_interface()
-    demo.launch(share=True)
\ No newline at end of file
+    # 可选预热：例如 WARMUP_COMPONENTS=rag,tools，在后台线程中进行，不阻塞首屏
+    warmup = [c.strip() for c in os.getenv("WARMUP_COMPONENTS", "").split(",") if c.strip()]
+    if warmup:
+        AgentRouter.warm_up(components=warmup, background=True)
+    # 排队上限：超过后新请求直接提示繁忙（模型调用的准入控制见 scheduler.py）
+    demo.queue(max_size=int(os.getenv("GRADIO_QUEUE_SIZE", "200")))
+    # 多进程部署时由 serve_workers.py 设置 GRADIO_SERVER_PORT 并关闭公网分享
+    demo.launch(share=os.getenv("GRADIO_SHARE", "1") == "1")
\ No newline at end of file